@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+gurlpath benchmarks, against a local stand-in server (server.py)
+
+    python benchmarks/run.py [--quick] [--output results.json]
+                             [--compare old_results.json]
+
+Measures:
+
+    read:       read_bytes() throughput by file size, in memory and streamed
+    cache_hit:  latency of read_bytes() when the file is in the cache
+    login:      reads behind the redirect login, first and later
+    database:   CacheDatabase write / read / lookup time by number of entries
+    listing:    listdir() and glob() time, with and without cached listings
+    urls:       URL construction rate and memory per URL, by how it is made
+    manifest:   which of many URLs are cached: cached_subset() against
+                a stat() per URL
+
+Results are written as JSON: 'meta' (versions, git commit, time) and
+'results', a list of {name, params, value, unit}. With --compare, each
+result is shown against the same one in an earlier results file.
+'''
+
+__author__    = "P. Lewis"
+__email__     = "p.lewis@ucl.ac.uk"
+__date__      = "28 Aug 2020"
+__copyright__ = "Copyright 2020-2022 P. Lewis"
+__license__   = "MIT License"
+
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import tracemalloc
+import subprocess
+from pathlib import Path
+
+# benchmark the working tree, not an installed gurlpath
+sys.path.insert(0,str(Path(__file__).absolute().parent.parent))
+sys.path.insert(0,str(Path(__file__).absolute().parent))
+
+from server import BenchServer, make_files
+from gurlpath import URL
+from gurlpath import gurlpath as gp
+from gurlpath.db import CacheDatabase
+from gurlpath.session import close_sessions
+from gurlpath.cache import cached_subset
+
+# settings for all URLs: no cookies saved in ~/.cylog
+SETTINGS = {'persist_cookies':False}
+
+
+class Results():
+    '''
+    Collects benchmark results
+    '''
+    def __init__(self):
+        self.results = []
+
+    def add(self,name,value,unit,**params):
+        """
+        Record (and print) one result
+
+        :param name: str: benchmark name
+        :param value: float: measured value
+        :param unit: str: unit of value
+        :param params: benchmark parameters
+        :return: None
+        """
+        self.results.append({'name':name,'params':params,'value':value,'unit':unit})
+        args = ' '.join(f'{k}={v}' for k,v in params.items())
+        print(f'{name:<28s} {args:<36s} {value:12.4g} {unit}',file=sys.stderr)
+
+
+def timed(fn,repeat=1):
+    """
+    Call fn() repeat times
+
+    :return: list of float: seconds for each call
+    """
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return times
+
+
+def fresh():
+    """
+    Forget the listings, access strategies and sessions
+    held in this process, so the next request starts cold
+
+    :return: None
+    """
+    gp._listings.clear()
+    gp._strategies.clear()
+    close_sessions()
+
+
+def bench_read(results,base,sizes,repeat,tmp):
+    for size in sizes:
+        for stream in (False,True):
+            def read():
+                d = tempfile.mkdtemp(dir=tmp)
+                data = URL(f'{base}/data/sizes/{size}.bin',cachedir=d,**SETTINGS).read_bytes(stream=stream)
+                assert len(data) == size
+                shutil.rmtree(d)
+            t = statistics.median(timed(read,repeat))
+            results.add('read',size / t / 1e6,'MB/s',size=size,stream=stream)
+
+
+def bench_cache_hit(results,base,n,tmp):
+    d = tempfile.mkdtemp(dir=tmp)
+    url = f'{base}/data/2003.12.01/f0000.hdf'
+    URL(url,cachedir=d,**SETTINGS).read_bytes()
+    t = timed(lambda: URL(url,cachedir=d,**SETTINGS).read_bytes(),n)
+    results.add('cache_hit',statistics.median(t) * 1e6,'us',what='read_bytes')
+    u = URL(url,cachedir=d,**SETTINGS)
+    t = timed(lambda: u.local_file().exists(),n)
+    results.add('cache_hit',statistics.median(t) * 1e6,'us',what='local_file')
+
+
+def bench_login(results,server,repeat,tmp):
+    base = server.url.replace('http://',f'http://{server.username}:{server.password}@')
+    url = f'{base}/protected/data/2003.12.01/f0000.hdf'
+    first,later = [],[]
+    for _ in range(repeat):
+        fresh()
+        d = tempfile.mkdtemp(dir=tmp)
+        first += timed(lambda: URL(url,cachedir=d,**SETTINGS).read_bytes())
+        d = tempfile.mkdtemp(dir=tmp)
+        later += timed(lambda: URL(url,cachedir=d,**SETTINGS).read_bytes())
+    results.add('login',statistics.median(first) * 1e3,'ms',read='first')
+    results.add('login',statistics.median(later) * 1e3,'ms',read='later')
+
+
+def bench_database(results,entries,tmp):
+    for backend in ('yaml','sqlite'):
+        for n in entries:
+            f = Path(tempfile.mkdtemp(dir=tmp),f'db.{backend}')
+            db = CacheDatabase(f.as_posix())
+            def write():
+                for i in range(n):
+                    db.update_entry(f'https://example.com/data/{i}.hdf',
+                                    local_file=f'/cache/data/{i}.hdf',size=i,atime=time.time())
+                db.write()
+            results.add('database',timed(write)[0] * 1e3,'ms',
+                        backend=backend,entries=n,op='write')
+            db.update_entry('https://example.com/data/0.hdf',size=-1)
+            results.add('database',timed(db.flush)[0] * 1e3,'ms',
+                        backend=backend,entries=n,op='flush_one')
+            results.add('database',timed(lambda: CacheDatabase(f.as_posix()).read())[0] * 1e3,'ms',
+                        backend=backend,entries=n,op='read')
+            lazy = CacheDatabase(f.as_posix(),lazy=True).read()
+            keys = [f'https://example.com/data/{i}.hdf' for i in range(0,n,max(1,n//1000))]
+            t = timed(lambda: [lazy.entry(k) for k in keys])[0]
+            results.add('database',t / len(keys) * 1e6,'us',
+                        backend=backend,entries=n,op='lookup')
+
+
+def bench_listing(results,base,ndirs,nfiles,repeat,tmp):
+    # listings are cached in the CacheDatabase: a new one starts cold
+    def db_file(cached):
+        d = (cached and tmp) or tempfile.mkdtemp(dir=tmp)
+        return (Path(d) / 'listing.sqlite').as_posix()
+    for cached in (False,True):
+        def glob():
+            if not cached:
+                fresh()
+            urls = URL(base,db_file=db_file(cached),**SETTINGS).glob('data/2003.12.*/f*.hdf')
+            assert len(urls) == ndirs * nfiles
+        def listdir():
+            if not cached:
+                fresh()
+            names = URL(f'{base}/data/2003.12.01/',db_file=db_file(cached),**SETTINGS).listdir()
+            assert len(names) == nfiles
+        glob()
+        t = statistics.median(timed(glob,repeat))
+        results.add('listing',t * 1e3,'ms',op='glob',cached=cached,files=ndirs * nfiles)
+        t = statistics.median(timed(listdir,repeat))
+        results.add('listing',t * 1e3,'ms',op='listdir',cached=cached,files=nfiles)
+
+
+def bench_urls(results,n):
+    base = URL('https://e4ftl01.cr.usgs.gov/MOTA/MCD15A3H.006/',cachedir='work',
+               db_file='db.sqlite',**SETTINGS)
+    names = [f'2003.12.{i%31+1:02d}/MCD15A3H.A2003345.h{i%36:02d}v{i%18:02d}.{i}.hdf'
+             for i in range(n)]
+    strs = [str(base) + name for name in names]
+    ways = {
+        'str':      lambda i: URL(strs[i]),
+        'kwargs':   lambda i: URL(strs[i],cachedir='work',db_file='db.sqlite',**SETTINGS),
+        'derive':   lambda i: base.derive(strs[i]),
+        'truediv':  lambda i: base / names[i],
+    }
+    for way,make in ways.items():
+        t = time.perf_counter()
+        urls = [make(i) for i in range(n)]
+        t = time.perf_counter() - t
+        results.add('urls',n / t,'URL/s',made=way)
+        del urls
+        tracemalloc.start()
+        urls = [make(i) for i in range(n)]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        results.add('urls',size / n,'B/URL',made=way)
+        del urls
+
+
+def bench_manifest(results,n,tmp):
+    d = Path(tempfile.mkdtemp(dir=tmp))
+    urls = [f'https://e4ftl01.cr.usgs.gov/MOTA/{i%100}/f{i}.hdf' for i in range(n)]
+    for i in range(0,n,2):
+        f = d / 'MOTA' / str(i%100) / f'f{i}.hdf'
+        f.parent.mkdir(parents=True,exist_ok=True)
+        f.touch()
+    def stat():
+        assert sum(URL(u,cachedir=d,**SETTINGS).local_file().exists() for u in urls) == n // 2
+    def manifest():
+        assert len(cached_subset(urls,cachedir=d,refresh=True)) == n // 2
+    results.add('manifest',timed(stat)[0] * 1e3,'ms',urls=n,how='stat')
+    results.add('manifest',timed(manifest)[0] * 1e3,'ms',urls=n,how='cached_subset')
+
+
+def metadata():
+    """
+    :return: dict describing this run
+    """
+    root = Path(__file__).absolute().parent.parent
+    try:
+        commit = subprocess.run(['git','rev-parse','HEAD'],cwd=root,capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'time':time.strftime('%Y-%m-%dT%H:%M:%S%z'),'git_commit':commit,
+            'python':platform.python_version(),'platform':platform.platform()}
+
+
+def compare(results,old_file):
+    """
+    Print each result against the same one in old_file
+
+    :param results: list of result dicts
+    :param old_file: str: earlier results JSON file
+    :return: None
+    """
+    key = lambda r: (r['name'],json.dumps(r['params'],sort_keys=True))
+    old = {key(r):r for r in json.loads(Path(old_file).read_text())['results']}
+    print(f'\ncompared with {old_file}:',file=sys.stderr)
+    for r in results:
+        o = old.get(key(r))
+        if o and o['value']:
+            args = ' '.join(f'{k}={v}' for k,v in r['params'].items())
+            print(f"{r['name']:<28s} {args:<36s} {r['value']/o['value']:8.2f} x",file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output',default='benchmark_results.json',
+                        help='results file (default benchmark_results.json)')
+    parser.add_argument('--compare',help='earlier results file to compare with')
+    parser.add_argument('--quick',action='store_true',help='small sizes, for a quick check')
+    parser.add_argument('--repeat',type=int,default=5)
+    args = parser.parse_args()
+
+    if args.quick:
+        sizes,entries,ndirs,nfiles,hits,nurls = [10**4,10**6],[100,1000],2,10,100,10000
+    else:
+        sizes,entries,ndirs,nfiles,hits,nurls = [10**4,10**6,10**7,10**8],[100,1000,10000,100000],\
+                                                8,50,1000,200000
+
+    server = BenchServer(make_files(ndirs,nfiles,size=10**5,sizes=sizes))
+    base = server.start()
+    tmp = Path(tempfile.mkdtemp(prefix='gurlpath_bench_'))
+    results = Results()
+    try:
+        bench_read(results,base,sizes,args.repeat,tmp)
+        bench_cache_hit(results,base,hits,tmp)
+        bench_login(results,server,args.repeat,tmp)
+        bench_database(results,entries,tmp)
+        bench_listing(results,base,ndirs,nfiles,args.repeat,tmp)
+        bench_urls(results,nurls)
+        bench_manifest(results,nurls,tmp)
+    finally:
+        server.stop()
+        shutil.rmtree(tmp,ignore_errors=True)
+
+    Path(args.output).write_text(json.dumps({'meta':metadata(),'results':results.results},indent=1))
+    print(f'results written to {args.output}',file=sys.stderr)
+    if args.compare:
+        compare(results.results,args.compare)
+
+
+if __name__ == "__main__":
+    main()
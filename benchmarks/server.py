@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+local HTTP stand-in for a NASA DAAC server, for benchmarks
+
+Serves synthetic files of given sizes under /data/, with
+Apache-style directory listings, ETag and Range support, and
+the same files under /protected/ behind a redirect login
+(like Earthdata URS): an unauthenticated request is redirected
+to /login, which needs HTTP basic auth, sets a session cookie
+and redirects back.
+
+    python benchmarks/server.py --port 8000
+
+serves until interrupted.
+'''
+
+__author__    = "P. Lewis"
+__email__     = "p.lewis@ucl.ac.uk"
+__date__      = "28 Aug 2020"
+__copyright__ = "Copyright 2020-2022 P. Lewis"
+__license__   = "MIT License"
+
+import os
+import sys
+import base64
+import hashlib
+import argparse
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+COOKIE = 'urs_session=benchmark'
+
+
+def make_files(ndirs=4,nfiles=10,size=100000,sizes=None):
+    """
+    Synthetic file tree: ndirs date directories of nfiles files
+    of size bytes, plus one file of each of sizes in /data/sizes/
+
+    :param ndirs: int: number of date directories
+    :param nfiles: int: files per directory
+    :param size: int: bytes per file
+    :param sizes: list of int: sizes of extra files
+    :return: dict of {path: bytes}
+    """
+    block = os.urandom(max([size] + list(sizes or [])) + nfiles)
+    files = {}
+    for d in range(ndirs):
+        for i in range(nfiles):
+            files[f'/data/2003.12.{d+1:02d}/f{i:04d}.hdf'] = block[i:i+size]
+    for s in sizes or []:
+        files[f'/data/sizes/{s}.bin'] = block[:s]
+    return files
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately: without this,
+    # small responses wait for a delayed ACK
+    disable_nagle_algorithm = True
+    # set by BenchServer
+    files = {}
+    dirs = {}
+    etags = {}
+    auth = ''
+
+    def log_message(self,*args):
+        pass
+
+    def send(self,code,body=b'',headers=None):
+        self.send_response(code)
+        for k,v in (headers or {}).items():
+            self.send_header(k,v)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        path,_,query = self.path.partition('?')
+        path = urllib.parse.unquote(path)
+        if path == '/login':
+            return self.login(query)
+        if path.startswith('/protected/'):
+            if COOKIE not in (self.headers.get('Cookie') or ''):
+                target = urllib.parse.quote(self.path)
+                return self.send(302,headers={'Location':f'/login?next={target}'})
+            path = path[len('/protected'):]
+        if path in self.files:
+            return self.data(path)
+        if path.rstrip('/') + '/' in self.dirs:
+            if not path.endswith('/'):
+                return self.send(301,headers={'Location':path + '/'})
+            return self.listing(path)
+        self.send(404)
+
+    def login(self,query):
+        if self.headers.get('Authorization') != self.auth:
+            return self.send(401,headers={'WWW-Authenticate':'Basic realm="benchmark"'})
+        target = urllib.parse.parse_qs(query).get('next',['/'])[0]
+        self.send(302,headers={'Location':target,'Set-Cookie':f'{COOKIE}; Path=/'})
+
+    def data(self,path):
+        data = self.files[path]
+        etag = self.etags[path]
+        if self.headers.get('If-None-Match') == etag:
+            return self.send(304,headers={'ETag':etag})
+        headers = {'ETag':etag,'Accept-Ranges':'bytes'}
+        byte_range = self.headers.get('Range')
+        if self.headers.get('If-Range') not in (None,etag):
+            byte_range = None
+        if not byte_range:
+            return self.send(200,data,headers)
+        start,_,end = byte_range.split('=',1)[1].partition('-')
+        start = int(start)
+        end = min(int(end),len(data)-1) if end else len(data)-1
+        if start >= len(data):
+            return self.send(416,headers={'Content-Range':f'bytes */{len(data)}'})
+        headers['Content-Range'] = f'bytes {start}-{end}/{len(data)}'
+        self.send(206,data[start:end+1],headers)
+
+    def listing(self,path):
+        rows = ''.join(f'<tr><td><a href="{urllib.parse.quote(n)}">{n}</a></td>'
+                       f'<td>2021-07-12 10:00</td><td>-</td></tr>\n'
+                       for n in self.dirs[path])
+        body = ('<html><head><title>Index of {0}</title></head><body>'
+                '<h1>Index of {0}</h1><table>'
+                '<tr><th><a href="?C=N;O=D">Name</a></th><th>Last modified</th></tr>\n'
+                '<tr><td><a href="../">Parent Directory</a></td></tr>\n'
+                '{1}</table></body></html>').format(path,rows)
+        self.send(200,body.encode(),{'Content-Type':'text/html'})
+
+
+class BenchServer():
+    '''
+    Local HTTP server for the files from make_files(),
+    run in a background thread
+    '''
+    def __init__(self,files,username='user',password='pass',port=0):
+        """
+        :param files: dict of {path: bytes}
+        :param username: str: login for /protected/
+        :param password: str: password for /protected/
+        :param port: int: port (0: any free port)
+        """
+        dirs = {}
+        for path in files:
+            parts = path.split('/')
+            for i in range(1,len(parts)):
+                parent = '/'.join(parts[:i]) + '/'
+                child = parts[i] + ('/' if i < len(parts) - 1 else '')
+                dirs.setdefault(parent,set()).add(child)
+        for parent in list(dirs):
+            dirs['/protected' + parent] = dirs[parent]
+        token = base64.b64encode(f'{username}:{password}'.encode()).decode()
+        handler = type('BenchHandler',(Handler,),{
+            'files':files,
+            'dirs':{k:sorted(v) for k,v in dirs.items()},
+            'etags':{k:'"%s"'%hashlib.md5(v).hexdigest() for k,v in files.items()},
+            'auth':f'Basic {token}'})
+        self.username = username
+        self.password = password
+        self.httpd = ThreadingHTTPServer(('127.0.0.1',port),handler)
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.httpd.server_address[1]}'
+
+    def start(self):
+        """
+        Start serving in a background thread
+
+        :return: str: base URL of the server
+        """
+        self.thread = threading.Thread(target=self.httpd.serve_forever,daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        """
+        Stop serving
+
+        :return: None
+        """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port',type=int,default=8000)
+    parser.add_argument('--ndirs',type=int,default=4)
+    parser.add_argument('--nfiles',type=int,default=10)
+    parser.add_argument('--size',type=int,default=100000)
+    args = parser.parse_args()
+    server = BenchServer(make_files(args.ndirs,args.nfiles,args.size),port=args.port)
+    print(f'serving on {server.url} (login {server.username}:{server.password})',file=sys.stderr)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import sys
-import yaml
-import os
-import urlpath
-import stat
-
-from pathlib import PosixPath, _PosixFlavour, PurePath
-from pathlib import Path
-
-import collections.abc
-import functools
-import re
-import urllib.parse
-import requests
-from bs4 import BeautifulSoup
-import fnmatch
-import numpy as np
-import io
-import tempfile
-from argparse import Namespace
+import importlib
 
 #from cylog import Cylog
 #from database import Database,ginit
@@ -36,3 +17,27 @@ __date__      = "12 July 2021"
 __copyright__ = "Copyright 2020-2022 P. Lewis"
 __license__   = "MIT License"
 
+# public names, and the modules they are imported
+# from on first use (so 'import gurlpath' is quick)
+_lazy = {
+    'URL':           'gurlpath.gurlpath',
+    'fetch_many':    'gurlpath.fetch',
+    'FetchResult':   'gurlpath.fetch',
+    'cache_usage':   'gurlpath.cache',
+    'cached_subset': 'gurlpath.cache',
+    'cached_sizes':  'gurlpath.cache',
+}
+
+__all__ = list(_lazy)
+
+
+def __getattr__(name):
+    if name in _lazy:
+        value = getattr(importlib.import_module(_lazy[name]),name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy))
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+asyncio interface to URL reads, using aiohttp
+
+These mirror URL.read() / URL.pull_file() / URL.get_login()
+and use the same cache files (URL.local_file()) and the
+same 2-pass login, so one event loop can keep many
+transfers in flight without a thread per request.
+
+The aiohttp session is shared by the reads in an event loop:
+close it (URL.aclose() or close_session()) before the loop
+ends, e.g.
+
+    async def main(urls):
+        try:
+            return await asyncio.gather(*[u.aread_bytes() for u in urls])
+        finally:
+            await urls[0].aclose()
+
+    data = asyncio.run(main([URL(u) for u in names]))
+
+aiohttp is only needed if these are used.
+'''
+
+__author__    = "P. Lewis"
+__email__     = "p.lewis@ucl.ac.uk"
+__date__      = "28 Aug 2020"
+__copyright__ = "Copyright 2020-2022 P. Lewis"
+__license__   = "MIT License"
+
+import asyncio
+import fnmatch
+import os
+import tempfile
+import time
+import weakref
+from pathlib import Path
+from glob import has_magic
+
+try:
+    import aiohttp
+except ModuleNotFoundError:
+    aiohttp = None
+
+try:
+    import gurlpath.metrics as metrics
+except ModuleNotFoundError:
+    import metrics
+
+# one aiohttp.ClientSession per event loop
+_sessions = weakref.WeakKeyDictionary()
+# seconds between tries for a URL.partial_lock() held elsewhere
+LOCK_POLL = 0.1
+
+
+def check_aiohttp():
+    """
+    Raise ModuleNotFoundError if aiohttp is not available
+
+    :return: None
+    """
+    if aiohttp is None:
+        raise ModuleNotFoundError('aiohttp is required for the asyncio ' +
+                                  'interface: pip install aiohttp')
+
+
+def get_session(pool_size=None):
+    """
+    Get the shared aiohttp.ClientSession for the running event loop,
+    creating it if needed
+
+    :param pool_size: int: maximum connections per host
+                      (default: no per-host limit)
+    :return: aiohttp.ClientSession
+    """
+    check_aiohttp()
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit_per_host=pool_size or 0)
+        # unsafe allows cookies from hosts given as IP addresses
+        session = aiohttp.ClientSession(connector=connector,
+                                        cookie_jar=aiohttp.CookieJar(unsafe=True))
+        _sessions[loop] = session
+    return session
+
+
+async def close_session():
+    """
+    Close the shared session for the running event loop
+    (see URL.aclose()). Call this before the loop ends.
+
+    :return: None
+    """
+    session = _sessions.pop(asyncio.get_running_loop(),None)
+    if session is not None:
+        await session.close()
+
+
+async def stream_to_file(url,r,local_file,expected=None):
+    """
+    async version of URL.stream_to_file()
+
+    :param url: URL
+    :param r: aiohttp.ClientResponse
+    :param local_file: Path local file name for storage
+    :param expected: (algorithm, value) checksum to verify against
+    :return: Path to local_file OR None on failure
+    """
+    nbytes = 0
+    try:
+        f,hashers = url.start_partial(local_file,r.status,r.headers,expected)
+        if f is None:
+            return None
+        with f:
+            async for chunk in r.content.iter_chunked(url.chunk_size):
+                f.write(chunk)
+                nbytes += len(chunk)
+                for h in hashers.values():
+                    h.update(chunk)
+    except (OSError,aiohttp.ClientError,asyncio.TimeoutError) as e:
+        url.msg(f'failure streaming {url.path} to {local_file}: {e}')
+        url.keep_partial(local_file)
+        return None
+    finally:
+        metrics.inc('bytes_downloaded',nbytes,host=url.host_key())
+    return url.finish_partial(local_file,r.status,r.headers,hashers,expected)
+
+
+async def request(url,session,target,**kwargs):
+    """
+    async version of URL.request(): get target, rate limited
+    and retried as for url (see URL.retry_policy(), URL.rate_limiter())
+
+    :param url: URL
+    :param session: aiohttp.ClientSession
+    :param target: str or yarl.URL to get
+    :param kwargs: passed through to session.get()
+    :return: aiohttp.ClientResponse, to be used with async with
+    """
+    policy = url.retry_policy()
+    bucket = url.rate_limiter()
+    host = url.host_key()
+    attempt = 0
+    while True:
+        await asyncio.sleep(bucket.reserve())
+        start = time.perf_counter()
+        try:
+            r = await session.get(target,**kwargs)
+        except (aiohttp.ClientConnectionError,asyncio.TimeoutError) as e:
+            metrics.inc('request_errors',host=host,error=type(e).__name__)
+            if not policy.retry(attempt):
+                raise
+            url.msg(f'failure requesting {url.path}: {e}')
+            r = None
+        if r is not None:
+            metrics.inc('requests',host=host,status=r.status)
+            metrics.observe('request_seconds',time.perf_counter() - start,host=host)
+            if not policy.retry(attempt,r.status):
+                return r
+        metrics.inc('retries',host=host,status=getattr(r,'status','error'))
+        delay = policy.delay(attempt,getattr(r,'headers',None))
+        if r is not None:
+            url.msg(f'status code for {url.path} {r.status}: retrying in {delay:.1f} s')
+            r.release()
+            bucket.pause(delay)
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def get_response(url,handle,skipper=False,headers=None):
+    """
+    async version of URL.get_response()
+
+    Try a simple get() and if that fails, the same 2-pass
+    login as URL.get_login(). The first good response is
+    passed to handle, while it is open. The last response
+    is kept as url.r (None if there was none), as for
+    URL.get_response().
+
+    :param url: URL
+    :param handle: coroutine function taking the aiohttp.ClientResponse
+    :param skipper: bool: skip the simple get()
+    :param headers: dict: extra request headers
+    :return: result of handle OR None on failure
+    """
+    url.r = None
+    session = get_session(url.pool_size)
+    timeout = aiohttp.ClientTimeout(total=url.timeout)
+    # credentials are passed explicitly, not in the url
+    target = url.cache_key()
+    # hosts known to need a login (see URL.strategy())
+    skipper = skipper or ((url.strategy() in ('basic','login')) and url.has_credentials())
+    try:
+        if not skipper:
+            url.msg('trying get() ...')
+            async with await request(url,session,target,headers=headers,timeout=timeout) as r:
+                url.r = r
+                if r.status in (200,206,304):
+                    url.set_strategy('anonymous')
+                    return await handle(r)
+                url.msg(f'status code for {url.path} {r.status}')
+                if (r.status == 416) or (r.status in url.retry_policy().statuses):
+                    # not a login problem
+                    return None
+
+        # unauthorised: try with a login
+        if not skipper:
+            metrics.inc('login_fallbacks',host=url.host_key())
+        url.msg('getting login and password')
+        auth = url.credentials()
+        if auth is None:
+            return None
+        auth = aiohttp.BasicAuth(*auth)
+        url.msg(f'logging in to {url.anchor}')
+        async with await request(url,session,target,auth=auth,headers=headers,
+                                 timeout=timeout) as r1:
+            url.r = r1
+            if r1.status in (200,206,304):
+                url.msg(f'status good for {url.path}')
+                url.set_strategy('basic')
+                return await handle(r1)
+            next_url = r1.url
+        url.msg(f'trying to access data for {url.path}')
+        async with await request(url,session,next_url,auth=auth,headers=headers,
+                                 timeout=timeout) as r2:
+            url.r = r2
+            if r2.status in (200,206,304):
+                url.msg(f'data read for {url.path}')
+                url.set_strategy('login')
+                return await handle(r2)
+            url.msg(f'status code poor for {url.path}: {r2.status}')
+    except (aiohttp.ClientError,asyncio.TimeoutError) as e:
+        url.msg(f'failure reading data from {url.anchor}: {e}')
+    return None
+
+
+async def pull_file(url,local_file,skipper=False,headers=None,expected=None):
+    """
+    async version of URL.pull_file(), streaming to local_file
+
+    :param url: URL
+    :param local_file: Path local file name for storage
+    :param skipper: bool: skip the simple get()
+    :param headers: dict: extra request headers e.g. from URL.resume_headers()
+                    or URL.validators(). On a 304 (not modified) response,
+                    local_file is used
+    :param expected: (algorithm, value) checksum to verify against
+    :return: Path to local_file OR None on failure
+    """
+    async def handle(r):
+        if r.status == 304:
+            url.msg(f'{url.path} not modified: using {local_file}')
+            return local_file
+        return await stream_to_file(url,r,local_file,expected)
+    return await get_response(url,handle,skipper=skipper,headers=headers)
+
+
+async def listdir(url):
+    """
+    async version of URL.listdir(), sharing its cache
+
+    :param url: URL
+    :return: list of str names (empty on failure)
+    """
+    # imported here as gurlpath.gurlpath imports this module
+    try:
+        from gurlpath.gurlpath import parse_listing
+    except ModuleNotFoundError:
+        from gurlpath import parse_listing
+
+    names = url.cached_listing()
+    if names is not None:
+        url.msg(f'using cached listing of {url.path}')
+        return names
+
+    # the listing URL, keeping any username and password
+    target = url.derive(str(url).rstrip('/') + '/')
+    status = target.negative()
+    if status is not None:
+        url.msg(f'listing {url.path} recently failed ({status}): not trying again')
+        return []
+
+    async def handle(r):
+        if r.status != 200:
+            return None
+        return parse_listing(await r.text(),str(r.url))
+    names = await get_response(target,handle)
+    url.r = target.r
+    if names is None:
+        url.msg(f'failed to list {url.path}')
+        target.record_negative(url.r)
+        return []
+    url.store_listing(names)
+    return names
+
+
+async def glob(url,pattern,pre_filter=True):
+    """
+    async version of URL.glob(), listing the directories
+    at each level concurrently
+
+    :param url: URL
+    :param pattern: str: e.g. 'MOT*/MCD15A3H.006/2003.12.11/*0.hdf'
+    :param pre_filter: bool: see URL.glob()
+    :return: list of URL
+    """
+    current = [url]
+    for part in [p for p in str(pattern).split('/') if p]:
+        if pre_filter and (not has_magic(part)):
+            current = [u.derive(u / part) for u in current]
+            continue
+        listings = await asyncio.gather(*[listdir(u) for u in current])
+        current = [u.derive(u / name) for u,names in zip(current,listings)
+                   for name in names if fnmatch.fnmatch(name,part)]
+    return current
+
+
+async def read(url,cachedir=None,ftype='binary',skipper=False,output='data',checksum=None):
+    """
+    async version of URL.read()
+
+    Downloads are always streamed to the cache file
+    (or a temporary file if url.nocache is set), and
+    interrupted downloads are resumed as for URL.read().
+    Checksums, validators, failures and cache usage are
+    recorded as for URL.read() (see URL.record_download()).
+
+    :param url: URL
+    :param cachedir: override url.cachedir
+    :param ftype: str: file type ('text' or 'binary')
+    :param skipper: bool: skip the simple get()
+    :param output: str: 'data', 'path' or 'file' (see URL.read())
+    :param checksum: str: expected checksum (see URL.read())
+    :return: data from url (or Path or file object, see output)
+             OR None on failure
+    """
+    check_aiohttp()
+    loop = asyncio.get_running_loop()
+    local_file = url.local_file(cachedir)
+    headers = {}
+    if (not url.nocache) and local_file.exists() and url.readable(local_file):
+        if not url.refreshcache:
+            metrics.inc('cache_hits')
+            url.cache_manager().touch(url.cache_key())
+            return await loop.run_in_executor(None,url.output,local_file,ftype,output)
+        # only download again if it has changed
+        headers = url.validators()
+    status = url.negative()
+    if status is not None:
+        metrics.inc('negative_hits')
+        url.msg(f'{url.path} recently failed ({status}): not trying again')
+        return None
+    metrics.inc('cache_misses')
+    if url.checksum_sidecar and not checksum:
+        # fetches the published checksum
+        expected = await loop.run_in_executor(None,url.expected_checksum)
+    else:
+        expected = url.expected_checksum(checksum)
+    if url.nocache:
+        fd,tmp = tempfile.mkstemp(suffix=f'.{local_file.name}')
+        os.close(fd)
+        local_file = Path(tmp)
+        path = await pull_file(url,local_file,skipper=skipper,expected=expected)
+        url.record_download(url.r,path)
+    else:
+        # one process, thread or task at a time (see URL.partial_lock())
+        lock = url.partial_lock(local_file)
+        while not lock.acquire(blocking=False):
+            await asyncio.sleep(LOCK_POLL)
+        try:
+            if lock.waited and (not headers) and local_file.exists():
+                url.msg(f'{url.path} was downloaded while waiting for {lock.path}')
+                return await loop.run_in_executor(None,url.output,local_file,ftype,output)
+            if (not headers) and url.link_duplicate(expected,local_file):
+                return await loop.run_in_executor(None,url.output,local_file,ftype,output)
+            headers.update(url.resume_headers(local_file))
+            path = await pull_file(url,local_file,skipper=skipper,headers=headers,
+                                   expected=expected)
+            if (path is None) and ('Range' in headers) and (getattr(url.r,'status',None) == 416):
+                # the partial file is no use: start again
+                url.discard_partial(local_file)
+                del headers['Range'],headers['If-Range']
+                path = await pull_file(url,local_file,skipper=skipper,headers=headers,
+                                       expected=expected)
+            url.record_download(url.r,path)
+        finally:
+            lock.release()
+    if path is None:
+        if url.nocache:
+            local_file.unlink(missing_ok=True)
+        return None
+    result = await loop.run_in_executor(None,url.output,local_file,ftype,output)
+    if url.nocache and output != 'path':
+        local_file.unlink()
+    return result
@@ -0,0 +1,636 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+size-bounded management of the download cache
+
+The cached files of a CacheDatabase are tracked in its
+entries (local_file, size, atime, pinned), and the least
+recently used files are removed when a new download
+would take the cache over max_bytes or max_files.
+
+A Manifest indexes the files under a cache directory in
+memory, so that many URLs can be checked against the cache
+(cached_subset(), cached_sizes()) without a stat() for each.
+
+A PartialLock lets only one process or thread at a time
+download (or resume) a cache file.
+'''
+
+__author__    = "P. Lewis"
+__email__     = "p.lewis@ucl.ac.uk"
+__date__      = "28 Aug 2020"
+__copyright__ = "Copyright 2020-2022 P. Lewis"
+__license__   = "MIT License"
+
+import os
+import time
+import threading
+import collections
+from pathlib import Path
+
+try:
+    from gurlpath.db import get_database
+    import gurlpath.tracing as tracing
+    from gurlpath.checksum import ALGORITHMS
+except ModuleNotFoundError:
+    from db import get_database
+    import tracing
+    from checksum import ALGORITHMS
+try:
+    import fcntl
+except ModuleNotFoundError:
+    # no advisory locking (e.g. on Windows)
+    fcntl = None
+
+# CacheManager objects shared within this process, see get_manager()
+_managers = {}
+_lock = threading.Lock()
+
+# Manifest objects shared within this process, see get_manifest()
+# {absolute cache directory: Manifest}
+_manifests = {}
+
+# files in the cache that are not (yet) cached URLs:
+# partial downloads and RemoteFile blocks
+PARTIAL_SUFFIXES = ('.part','.part.yaml','.part.lock','.blocks','.blocks.idx')
+
+
+class PartialLock():
+    '''
+    Exclusive advisory lock on the download of a cache file,
+    held on the file with .part.lock appended, which is removed
+    on release. Use as a context manager, or with acquire() and
+    release(). If locking is not possible, e.g. in a read-only
+    directory, no lock is taken.
+    '''
+    def __init__(self,local_file):
+        """
+        :param local_file: Path of cache file
+        """
+        local_file = Path(local_file)
+        self.path = local_file.with_name(local_file.name + '.part.lock')
+        self.file = None
+        # True if the lock was held by someone else when asked for
+        self.waited = False
+
+    def acquire(self,blocking=True):
+        """
+        Take the lock
+
+        :param blocking: bool: wait for the lock
+        :return: True if taken (or locking is not possible),
+                 False if held by someone else and not blocking
+        """
+        if fcntl is None:
+            return True
+        while True:
+            try:
+                self.path.parent.mkdir(parents=True,exist_ok=True)
+                f = open(self.path,'a')
+            except OSError:
+                return True
+            try:
+                fcntl.flock(f,fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self.waited = True
+                if not blocking:
+                    f.close()
+                    return False
+                with tracing.span('partial wait',path=str(self.path)):
+                    fcntl.flock(f,fcntl.LOCK_EX)
+            # the holder we waited for removes the file: lock the new one
+            try:
+                if os.fstat(f.fileno()).st_ino == os.stat(self.path).st_ino:
+                    self.file = f
+                    return True
+            except FileNotFoundError:
+                pass
+            f.close()
+
+    def release(self):
+        """
+        Release the lock, if held
+
+        :return: None
+        """
+        f,self.file = self.file,None
+        if f is not None:
+            self.path.unlink(missing_ok=True)
+            fcntl.flock(f,fcntl.LOCK_UN)
+            f.close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        self.release()
+        return False
+
+
+class CacheManager():
+    '''
+    Track the files in the download cache in a CacheDatabase
+    and keep them within max_bytes / max_files by removing the
+    least recently used ones. Pinned files are never removed.
+
+    Entries are keyed by URL (URL.cache_key()), with fields:
+
+        local_file: str: cache file
+        size:       int: size in bytes
+        atime:      float: time of last download or cache hit
+        pinned:     bool: exempt from eviction
+        inode:      str: '<device>:<inode>' of local_file
+
+    Files hard linked to each other (see URL.dedup) are counted
+    once in the total size, and only free space when the last
+    of them is evicted.
+    '''
+    def __init__(self,db,max_bytes=None,max_files=None):
+        """
+        :param db: CacheDatabase
+        :param max_bytes: int: maximum total size of cached files (None: no limit)
+        :param max_files: int: maximum number of cached files (None: no limit)
+        """
+        self.db = db
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.lock = threading.RLock()
+        # {key: (size, atime, pinned)} for entries with a local_file
+        self.files = {}
+        # {key: inode} and {inode: number of keys}, see count()
+        self.inodes = {}
+        self.links = collections.Counter()
+        self.total = 0
+        for key,entry in db.items().items():
+            if isinstance(entry,dict) and ('local_file' in entry):
+                self.files[key] = (entry.get('size',0),entry.get('atime',0),
+                                   entry.get('pinned',False))
+                # entries from before inodes were recorded count on their own
+                self.count(key,entry.get('size',0),entry.get('inode',key))
+
+    def count(self,key,size,inode):
+        """
+        Add the file of key to self.total, unless another key
+        has the same inode (a hard link to it)
+
+        :param key: str: URL key
+        :param size: int: size in bytes
+        :param inode: str: inode of the file
+        :return: None
+        """
+        self.inodes[key] = inode
+        self.links[inode] += 1
+        if self.links[inode] == 1:
+            self.total += size
+
+    def uncount(self,key):
+        """
+        Remove the file of key from self.files and self.total
+
+        :param key: str: URL key
+        :return: int: bytes freed (0 if other keys have the same inode)
+        """
+        size = self.files.pop(key,(0,0,False))[0]
+        inode = self.inodes.pop(key,None)
+        if inode is None:
+            return 0
+        self.links[inode] -= 1
+        if self.links[inode] > 0:
+            return 0
+        del self.links[inode]
+        self.total -= size
+        return size
+
+    @tracing.traced('cache record')
+    def record(self,key,local_file):
+        """
+        Record a new or refreshed cache file
+
+        :param key: str: URL key
+        :param local_file: Path of cache file
+        :return: None
+        """
+        st = Path(local_file).stat()
+        inode = f'{st.st_dev}:{st.st_ino}'
+        with self.lock:
+            self.uncount(key)
+            entry = self.db.update_entry(key,local_file=str(Path(local_file).absolute()),
+                                         size=st.st_size,atime=time.time(),inode=inode)
+            # pinned (see pin()) perhaps before it was downloaded
+            self.files[key] = (st.st_size,entry['atime'],entry.get('pinned',False))
+            self.count(key,st.st_size,inode)
+
+    def touch(self,key):
+        """
+        Update the access time of a cache file on a cache hit
+
+        :param key: str: URL key
+        :return: None
+        """
+        with self.lock:
+            if key in self.files:
+                size,atime,pinned = self.files[key]
+                atime = time.time()
+                self.db.update_entry(key,atime=atime)
+                self.files[key] = (size,atime,pinned)
+
+    def pin(self,key,pinned=True):
+        """
+        Pin (or unpin) a cache file, so that it is never evicted
+
+        :param key: str: URL key
+        :param pinned: bool
+        :return: None
+        """
+        with self.lock:
+            self.db.update_entry(key,pinned=pinned or None)
+            if key in self.files:
+                size,atime,_ = self.files[key]
+                self.files[key] = (size,atime,pinned)
+
+    def evict(self,key):
+        """
+        Remove a cache file and its tracking information
+
+        :param key: str: URL key
+        :return: int: bytes freed (0 while other keys link to the file)
+        """
+        with self.lock:
+            entry = self.db.entry(key)
+            if 'local_file' in entry:
+                drop_index(self.db,entry,entry['local_file'])
+                Path(entry['local_file']).unlink(missing_ok=True)
+                manifest_discard(entry['local_file'])
+            self.db.update_entry(key,local_file=None,size=None,atime=None,inode=None)
+            return self.uncount(key)
+
+    @tracing.traced('make room')
+    def make_room(self,nbytes=0,keep=None):
+        """
+        Evict least recently used, unpinned files until a new file
+        of nbytes fits within max_bytes and max_files
+
+        :param nbytes: int: size of the new file (0 if unknown)
+        :param keep: str: URL key not to evict (e.g. the one being refreshed)
+        :return: int: number of files evicted
+        """
+        if (self.max_bytes is None) and (self.max_files is None):
+            return 0
+        with self.lock:
+            def over():
+                nfiles = len(self.files) + (keep not in self.files)
+                return ((self.max_bytes is not None) and (self.total + nbytes > self.max_bytes)) or \
+                       ((self.max_files is not None) and (nfiles > self.max_files))
+            if not over():
+                return 0
+            candidates = sorted((atime,key) for key,(size,atime,pinned) in self.files.items()
+                                if (not pinned) and (key != keep))
+            evicted = 0
+            for atime,key in candidates:
+                if not over():
+                    break
+                self.evict(key)
+                evicted += 1
+            return evicted
+
+    def usage(self):
+        """
+        Report current cache usage
+
+        :return: dict with bytes, files, pinned_bytes, pinned_files,
+                 max_bytes, max_files
+        """
+        with self.lock:
+            pinned = [key for key,(size,atime,p) in self.files.items() if p]
+            # hard links count once
+            pinned_bytes = sum({self.inodes[k]:self.files[k][0] for k in pinned}.values())
+            return {'bytes':self.total,'files':len(self.files),
+                    'pinned_bytes':pinned_bytes,'pinned_files':len(pinned),
+                    'max_bytes':self.max_bytes,'max_files':self.max_files}
+
+
+def file_stamp(f):
+    """
+    Size and modification time of a file, to tell if it has been
+    replaced since (cache files are replaced, never rewritten in place)
+
+    :param f: str or Path
+    :return: (int size, int mtime in ns) OR None if it does not exist
+    """
+    try:
+        st = os.stat(f)
+    except OSError:
+        return None
+    return st.st_size,st.st_mtime_ns
+
+
+def drop_index(db,digests,local_file):
+    """
+    Remove the dedup index entries ('<algorithm>:<value>', see
+    URL.record_checksums()) of digests that point to local_file,
+    before it is replaced or removed
+
+    :param db: CacheDatabase
+    :param digests: dict including {algorithm: value} e.g. a URL entry
+    :param local_file: str or Path of cache file
+    :return: None
+    """
+    local_file = str(Path(local_file).absolute())
+    for algorithm,value in digests.items():
+        key = f'{algorithm}:{value}'
+        if (algorithm in ALGORITHMS) and (db.entry(key).get('path') == local_file):
+            db.delete(key)
+
+
+def get_manager(db,max_bytes=None,max_files=None):
+    """
+    Get the CacheManager for CacheDatabase db, shared within
+    this process. Limits that are given replace the current ones.
+
+    :param db: CacheDatabase
+    :param max_bytes: int: maximum total size of cached files
+    :param max_files: int: maximum number of cached files
+    :return: CacheManager
+    """
+    with _lock:
+        manager = _managers.get(id(db))
+        if manager is None or manager.db is not db:
+            manager = CacheManager(db)
+            _managers[id(db)] = manager
+    if max_bytes is not None:
+        manager.max_bytes = max_bytes
+    if max_files is not None:
+        manager.max_files = max_files
+    return manager
+
+
+def cache_usage(db_file=None):
+    """
+    Report the usage of the download cache tracked in db_file
+
+    :param db_file: str: CacheDatabase file (see URL db_file)
+    :return: dict (see CacheManager.usage())
+    """
+    db = (db_file and get_database(db_file)) or get_database()
+    return get_manager(db).usage()
+
+
+class Manifest():
+    '''
+    In-memory index of the files under a cache directory,
+    {relative path: size}. A directory is read (with one
+    os.scandir()) when a file in it is first asked about, so
+    only the directories holding the files asked about are
+    read, not the whole tree (for the default cachedir '.',
+    the whole working directory). Sizes are found (with a
+    stat()) when first asked for.
+
+    Files written or evicted through gurlpath in this process
+    are added and removed as that happens. Use rebuild() to
+    see changes made by other processes.
+    '''
+    def __init__(self,root):
+        """
+        :param root: str: cache directory
+        """
+        self.root = os.path.abspath(root)
+        self.lock = threading.Lock()
+        self.files = {}
+        # directories read so far, relative to root ('' for root)
+        self.dirs = set()
+        self.built = time.time()
+
+    def rebuild(self):
+        """
+        Read the directories read so far (see scan()) again
+
+        :return: int: number of files in them
+        """
+        with self.lock:
+            dirs = self.dirs
+            self.files = {}
+            self.dirs = set()
+        for reldir in dirs:
+            self.scan(reldir)
+        self.built = time.time()
+        return len(self.files)
+
+    def scan(self,reldir):
+        """
+        Index the files in a directory
+
+        :param reldir: str: directory relative to self.root
+        :return: None
+        """
+        files = {}
+        try:
+            with os.scandir(os.path.join(self.root,reldir)) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file() and not entry.name.endswith(PARTIAL_SUFFIXES):
+                            files[os.path.join(reldir,entry.name)] = None
+                    except OSError:
+                        continue
+        except OSError:
+            pass
+        with self.lock:
+            for rel in files:
+                self.files.setdefault(rel,None)
+            self.dirs.add(reldir)
+
+    def relative(self,local_file):
+        """
+        :param local_file: str or Path: file under self.root
+        :return: str: path of local_file relative to self.root OR None
+        """
+        path = os.path.abspath(local_file)
+        if path.startswith(self.root + os.sep):
+            return path[len(self.root) + 1:]
+        return None
+
+    def __contains__(self,rel):
+        if (rel not in self.files) and (os.path.dirname(rel) not in self.dirs):
+            self.scan(os.path.dirname(rel))
+        return rel in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+    def size(self,rel):
+        """
+        Size of a file in the index
+
+        :param rel: str: path relative to self.root
+        :return: int OR None if not in the index (or gone)
+        """
+        if rel not in self.files:
+            return None
+        size = self.files.get(rel)
+        if size is None:
+            try:
+                size = os.stat(os.path.join(self.root,rel)).st_size
+            except OSError:
+                self.discard(rel)
+                return None
+            with self.lock:
+                if rel in self.files:
+                    self.files[rel] = size
+        return size
+
+    def add(self,rel,size=None):
+        """
+        :param rel: str: path relative to self.root
+        :param size: int: size in bytes (None: find when asked)
+        :return: None
+        """
+        with self.lock:
+            self.files[rel] = size
+
+    def discard(self,rel):
+        """
+        :param rel: str: path relative to self.root
+        :return: None
+        """
+        with self.lock:
+            self.files.pop(rel,None)
+
+
+def get_manifest(cachedir='.',refresh=False):
+    """
+    Get the Manifest for cachedir, shared within this process,
+    building it on first use
+
+    :param cachedir: str: cache directory
+    :param refresh: bool: rebuild the manifest if it exists
+    :return: Manifest
+    """
+    root = os.path.abspath(cachedir)
+    with _lock:
+        manifest = _manifests.get(root)
+        if manifest is None:
+            manifest = _manifests[root] = Manifest(root)
+            return manifest
+    if refresh:
+        manifest.rebuild()
+    return manifest
+
+
+def manifest_add(local_file,size=None):
+    """
+    Add a new cache file to any manifests it is under
+
+    :param local_file: str or Path
+    :param size: int: size in bytes, if known
+    :return: None
+    """
+    if not _manifests:
+        return
+    for manifest in list(_manifests.values()):
+        rel = manifest.relative(local_file)
+        if rel is not None:
+            manifest.add(rel,size)
+
+
+def manifest_discard(local_file):
+    """
+    Remove a cache file from any manifests it is under
+
+    :param local_file: str or Path
+    :return: None
+    """
+    if not _manifests:
+        return
+    for manifest in list(_manifests.values()):
+        rel = manifest.relative(local_file)
+        if rel is not None:
+            manifest.discard(rel)
+
+
+def cache_location(url,cachedir=None):
+    """
+    Where url is cached, as for URL.local_file(), without
+    making a URL from it if it is a str
+
+    :param url: str or URL
+    :param cachedir: str: override the cachedir of url (default '.' for str)
+    :return: (cache directory, path relative to it) OR
+             (None, local path) for a local file URL
+    """
+    if isinstance(url,str):
+        scheme,sep,rest = url.partition('://')
+        path = ('/' in rest and rest[rest.index('/'):]) or ''
+        path = path.split('?',1)[0].split('#',1)[0]
+        if (not sep) or (scheme == 'file') or ('%' in path):
+            # local file, or quoted: as URL() does it
+            try:
+                from gurlpath.gurlpath import URL
+            except ModuleNotFoundError:
+                from gurlpath import URL
+            url = URL(url)
+        else:
+            return (cachedir or '.'),os.path.normpath(path.lstrip('/'))
+    if url.isfile():
+        return None,str(url.local_file())
+    return (cachedir or url.cachedir),os.path.normpath(url.path.lstrip('/'))
+
+
+def cached_sizes(urls,cachedir=None,refresh=False):
+    """
+    Sizes of those of urls that are in the cache, from the
+    manifests of their cache directories (see Manifest)
+
+    :param urls: iterable of str or URL
+    :param cachedir: str: override the cachedir of each URL
+                     (default '.' for those given as str)
+    :param refresh: bool: rebuild the manifests first
+    :return: dict of {url: size in bytes}, in the order of urls
+    """
+    sizes = {}
+    manifests = {}
+    for url in urls:
+        root,rel = cache_location(url,cachedir)
+        if root is None:
+            # a local file
+            try:
+                sizes[url] = os.stat(rel).st_size
+            except OSError:
+                pass
+            continue
+        manifest = manifests.get(root)
+        if manifest is None:
+            manifest = manifests[root] = get_manifest(root,refresh=refresh)
+        if rel in manifest:
+            size = manifest.size(rel)
+            if size is not None:
+                sizes[url] = size
+    return sizes
+
+
+def cached_subset(urls,cachedir=None,refresh=False):
+    """
+    Those of urls that are in the cache, from the manifests of
+    their cache directories (see Manifest), so that each
+    directory holding them is read only once
+
+    :param urls: iterable of str or URL
+    :param cachedir: str: override the cachedir of each URL
+                     (default '.' for those given as str)
+    :param refresh: bool: rebuild the manifests first
+    :return: list of the cached urls, in order
+    """
+    cached = []
+    manifests = {}
+    for url in urls:
+        root,rel = cache_location(url,cachedir)
+        if root is None:
+            if os.path.isfile(rel):
+                cached.append(url)
+            continue
+        manifest = manifests.get(root)
+        if manifest is None:
+            manifest = manifests[root] = get_manifest(root,refresh=refresh)
+        if rel in manifest:
+            cached.append(url)
+    return cached
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+checksums for verifying downloads
+
+hashlib algorithms (md5, sha1, sha256, ...) plus the POSIX
+cksum CRC used in NASA LP DAAC .xml metadata (ChecksumType CKSUM)
+'''
+
+__author__    = "P. Lewis"
+__email__     = "p.lewis@ucl.ac.uk"
+__date__      = "28 Aug 2020"
+__copyright__ = "Copyright 2020-2022 P. Lewis"
+__license__   = "MIT License"
+
+import hashlib
+import zlib
+
+# algorithm implied by the length of a hex digest
+DIGEST_LENGTHS = {32:'md5',40:'sha1',64:'sha256',128:'sha512'}
+
+# names of the algorithms new() supports
+ALGORITHMS = hashlib.algorithms_available | {'cksum'}
+
+
+# each byte with its bits reversed
+_REVERSED = bytes(int(f'{i:08b}'[::-1],2) for i in range(256))
+
+
+def _reverse32(x):
+    return int(f'{x:032b}'[::-1],2)
+
+
+class Cksum():
+    '''
+    POSIX cksum CRC, with the same interface as hashlib objects.
+    hexdigest() gives the decimal value that cksum prints.
+
+    This is the CRC-32 of zlib.crc32() with the bits taken the other
+    way round, so is computed by zlib.crc32() on bit-reversed bytes.
+    '''
+    name = 'cksum'
+
+    def __init__(self):
+        self.crc = 0
+        self.length = 0
+
+    def update(self,data):
+        # zlib.crc32() inverts the crc before and after
+        crc = zlib.crc32(bytes(data).translate(_REVERSED),_reverse32(self.crc) ^ 0xFFFFFFFF)
+        self.crc = _reverse32(crc ^ 0xFFFFFFFF)
+        self.length += len(data)
+
+    def hexdigest(self):
+        n = self.length
+        # cksum then takes in the length, least significant byte first
+        length = n.to_bytes((n.bit_length() + 7)//8,'little')
+        crc = zlib.crc32(length.translate(_REVERSED),_reverse32(self.crc) ^ 0xFFFFFFFF)
+        return str(_reverse32(crc ^ 0xFFFFFFFF) ^ 0xFFFFFFFF)
+
+
+def new(algorithm):
+    """
+    New hash object for algorithm
+
+    :param algorithm: str: hashlib name, or 'cksum'
+    :return: hash object with update() and hexdigest()
+    """
+    algorithm = algorithm.lower()
+    if algorithm == 'cksum':
+        return Cksum()
+    return hashlib.new(algorithm)
+
+
+def parse_checksum(checksum,algorithm=None):
+    """
+    Split a checksum into (algorithm, value)
+
+    :param checksum: str: 'md5:<hex>', 'sha256:<hex>', 'cksum:<decimal>'
+                     or a hex digest (algorithm from its length)
+    :param algorithm: str: algorithm if not given in checksum
+    :return: (str algorithm, str value) OR None
+    """
+    if not checksum:
+        return None
+    checksum = str(checksum).strip()
+    if ':' in checksum:
+        algorithm,checksum = checksum.split(':',1)
+    algorithm = algorithm or DIGEST_LENGTHS.get(len(checksum))
+    if algorithm is None:
+        return None
+    algorithm = algorithm.lower().replace('-','')
+    if algorithm != 'cksum':
+        checksum = checksum.lower()
+    return algorithm,checksum
@@ -6,12 +6,89 @@ import numpy as np
 from pathlib import Path
 from getpass import getpass
 import sys
+import threading
 
 __author__ = "P Lewis"
 __copyright__ = "Copyright 2018-2022 P Lewis"
 __license__ = "GPLv3"
 __email__ = "p.lewis@ucl.ac.uk"
 
+# decrypted (username, password) per (key file, site), for this process
+# {keyfile: (mtime_ns, {site: (username, password)})}
+# an entry is dropped when its key file changes
+_credentials = {}
+# {keyfile: (mtime_ns, key)}
+_keys = {}
+_lock = threading.RLock()
+
+def cached_login(keyfile,site):
+    '''
+    (username, password) for site from the in-process cache,
+    or None if not cached or keyfile has changed since
+    '''
+    try:
+        mtime = keyfile.stat().st_mtime_ns
+    except OSError:
+        return None
+    with _lock:
+        entry = _credentials.get(str(keyfile))
+        if (entry is None) or (entry[0] != mtime):
+            return None
+        return entry[1].get(site)
+
+def cache_login(keyfile,site,uinfo):
+    '''store (username, password) for site in the in-process cache'''
+    try:
+        mtime = keyfile.stat().st_mtime_ns
+    except OSError:
+        return
+    with _lock:
+        entry = _credentials.get(str(keyfile))
+        if (entry is None) or (entry[0] != mtime):
+            entry = _credentials[str(keyfile)] = (mtime,{})
+        entry[1][site] = uinfo
+
+def stored_login(keyfile,site):
+    '''
+    True if (username, password) for site are cached or stored
+    in keyfile. Unlike Cylog(), this never creates keyfile.
+    '''
+    site = str(site).rstrip('/')
+    if cached_login(keyfile,site) is not None:
+        return True
+    if not keyfile.exists():
+        return False
+    with np.load(keyfile.as_posix()) as data:
+        return (f'ciphered_user_{site}' in data) and \
+               (f'ciphered_pass_{site}' in data)
+
+def key_file(destination_folder='.cylog'):
+    '''the key file ~/{destination_folder}/.cylog.npz'''
+    return Path.home().joinpath(destination_folder,'.cylog.npz')
+
+def clear_cache():
+    '''forget all cached credentials'''
+    with _lock:
+        _credentials.clear()
+        _keys.clear()
+
+def cylog_key(destination_folder='.cylog'):
+    '''
+    The Fernet key from ~/{destination_folder}/.cylog.npz,
+    generating the key file if needed. Used to encrypt other
+    private data (e.g. login cookies) kept next to it.
+    '''
+    keyfile = key_file(destination_folder)
+    with _lock:
+        if not keyfile.exists():
+            Cylog('key',destination_folder=destination_folder)
+        mtime = keyfile.stat().st_mtime_ns
+        entry = _keys.get(str(keyfile))
+        if (entry is None) or (entry[0] != mtime):
+            key = bytes(np.atleast_1d(np.load(keyfile.as_posix())['key'])[0])
+            entry = _keys[str(keyfile)] = (mtime,key)
+    return entry[1]
+
 class  Cylog():
     '''
     cylog provides a mechanism to partially hide username and
@@ -187,6 +264,16 @@ class  Cylog():
         p.chmod(0o600)
         self.msg(f"--> done writing ciphers to file")
 
+    def stored(self,site=None):
+        '''
+        True if (username,password) for site (or self.site) are
+        stored, so that login() would not need to prompt for them
+        '''
+        site = self.sort_list(site)
+        if site is None:
+           return False
+        return stored_login(self.dest_path.joinpath('.cylog.npz'),site[0])
+
     def login(self,site=None,force=False,destination_folder='.cylog'):
         '''
         Reads encrypted information from ~/{dest_path}/.cylog.npz
@@ -210,6 +297,24 @@ class  Cylog():
         force = force 
 
         keyfile = self.dest_path.joinpath('.cylog.npz')
+        if not force:
+            # repeat logins are served from memory
+            uinfo = cached_login(keyfile,site[0])
+            if uinfo is not None:
+                return uinfo
+
+        # one thread at a time loads (or prompts for) credentials
+        with _lock:
+            return self._login(site,keyfile,force=force,
+                               destination_folder=destination_folder)
+
+    def _login(self,site,keyfile,force=False,destination_folder='.cylog'):
+        '''load and decrypt (username,password) for site[0] from keyfile'''
+        if not force:
+            uinfo = cached_login(keyfile,site[0])
+            if uinfo is not None:
+                return uinfo
+
         if not keyfile.exists():
             self.msg(f"key file {keyfile.as_posix()} doesn't exist")
             self._init(site=site,destination_folder=destination_folder)
@@ -235,8 +340,11 @@ class  Cylog():
             self._setup(site=site)
             return self.login(site=site)
 
-        return (Fernet(data['key']).decrypt(np.atleast_1d(data[f'ciphered_user_{site[0]}'])[0]),\
-                Fernet(data['key']).decrypt(np.atleast_1d(data[f'ciphered_pass_{site[0]}'])[0]))
+        cipher_suite = Fernet(key)
+        uinfo = (cipher_suite.decrypt(np.atleast_1d(data[f'ciphered_user_{site[0]}'])[0]),\
+                 cipher_suite.decrypt(np.atleast_1d(data[f'ciphered_pass_{site[0]}'])[0]))
+        cache_login(keyfile,site[0],uinfo)
+        return uinfo
 
 def modlog():
     sites = ['https://n5eil01u.ecs.nsidc.org',\
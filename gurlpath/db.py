@@ -7,7 +7,23 @@ written for UCL MSc remote sensing course
 but has other uses.
 
 This class loads / writes a yaml database file.
-It can be quite slow, so dont call unless you need to
+It can be quite slow, so dont call unless you need to.
+
+Database files ending in .sqlite, .sqlite3 or .sdb (or any
+existing SQLite file) are held in SQLite instead, which
+is indexed on key and writes entries individually.
+Use import_yaml() to convert an existing yaml database.
+
+Entries changed through update_entry(), set() or delete() are
+tracked, and flush() writes only those: to SQLite directly, or
+appended to a journal file (the yaml file with .journal appended)
+which read() replays and which is compacted back into the yaml
+file every compact_after entries.
+
+Several processes can share a database file. yaml files are
+read and written under an advisory lock (the file with .lock
+appended), and write() merges the entries on disk with those in
+memory rather than overwriting them. SQLite does its own locking.
 '''
 
 __author__ = 'P. Lewis'
@@ -16,15 +32,37 @@ __date__ = '28 Aug 2021'
 __copyright__ = 'Copyright 2020-2022 P. Lewis'
 __license__ = 'GPLv3'
 
-import yaml
 from pathlib import Path
 import os
-import numpy as np
+import stat
+import json
+import sqlite3
+import tempfile
+import threading
+import contextlib
+try:
+    from gurlpath.metrics import MessageLog
+    import gurlpath.tracing as tracing
+except ModuleNotFoundError:
+    from metrics import MessageLog
+    import tracing
+try:
+    import fcntl
+except ModuleNotFoundError:
+    # no advisory locking (e.g. on Windows)
+    fcntl = None
+
+# CacheDatabase objects shared within this process, see get_database()
+_databases = {}
+_lock = threading.Lock()
+
+# file suffixes for the SQLite backend
+SQLITE_SUFFIXES = ('.sqlite','.sqlite3','.sdb')
 
 
 class CacheDatabase():
 
-    def __init__(self,*args,dbdir=None,data=None):
+    def __init__(self,*args,dbdir=None,data=None,lazy=False,compact_after=1000):
         """
         initialise database class.
 
@@ -32,9 +70,23 @@ class CacheDatabase():
         :param dbdir:         str: cache directory. Get dbdir from dbdir,
                               default '.'
         :param data:          Dict : dataset to be loaded
+        :param lazy:          bool: dont load SQLite files in read(),
+                              but look keys up when needed (see lookup())
+        :param compact_after: int: number of journal entries after which
+                              flush() rewrites the yaml file
         """
         #
-        self.msgs = []
+        self.msgs = MessageLog()
+        self.lazy = lazy
+        self.compact_after = compact_after
+        self.journal_entries = 0
+        self.dirty = set()
+        self.deleted = set()
+        # keys known to be in write_file (read from or written to it),
+        # with a snapshot() of the value there: {key: str}
+        self.stored = {}
+        self.connections = {}
+        self.lock = threading.RLock()
         self.dbdir = None
         self.write_file = None
         self.db_logic(dbdir)
@@ -51,22 +103,22 @@ class CacheDatabase():
         '''
 
         # sort file names/locations
-        for f in files:
-            self.files.append(self.locate_file(f))
-        self.files = np.array(self.files)
+        self.files = list(self.files) + [self.locate_file(f) for f in files]
 
         # resolve directories for files
-        not_exists = np.array([not f.exists() for f in self.files])
-        for i,f in enumerate(self.files):
-            if not_exists[i]:
+        exists = []
+        for f in self.files:
+            ok = f.exists()
+            if not ok:
                 try:
                     f.parent.mkdir(parents=True, exist_ok=True)
-                    not_exists[i] = False
+                    ok = True
                 except FileNotFoundError as e:
                     # the user has requested a db directory that cant be made
                     self.msg(f"error creating directory {f.parent}: {e}")
+            exists.append(ok)
 
-        self.files = self.files[np.logical_not(not_exists)]
+        self.files = [f for f,ok in zip(self.files,exists) if ok]
 
         # find the first writeable or non-existent file
         for i, f in enumerate(self.files):
@@ -78,12 +130,10 @@ class CacheDatabase():
                 pass
 
         # tidy up self.files for reading
-        exists = np.array([f.exists() for f in self.files])
-        self.files = self.files[exists]
+        self.files = [f for f in self.files if f.exists()]
 
         # check files are readable
-        readable = np.array([self.readable(f) for f in self.files])
-        self.files = self.files[readable]
+        self.files = [f for f in self.files if self.readable(f)]
         return self.files
 
     def locate_file(self,filename):
@@ -128,29 +178,387 @@ class CacheDatabase():
         self.dbdir = Path(self.dbdir).expanduser()
         return self.dbdir
 
+    @tracing.traced('database write',lambda db: {'file':str(db.write_file)})
     def write(self):
         """
         write the database in data to yaml file self.write_file
         if self.write_file is set. To set a self.write_file
         you must specify a db location/file that is writeable.
 
+        Only the entries changed here (see pending()) are written,
+        so entries written to the file by other processes since it
+        was read are kept, including newer values of keys read here.
+        Remove entries with delete() rather than from self.data.
+
         :return:      True if saved, False if not
         """
         if self.write_file:
-            with open(self.write_file , "w") as write_file:
-                yaml.safe_dump(self.data, write_file)
+            with self.lock:
+                if self.is_sqlite(self.write_file):
+                    new = [k for k in self.data if not (k in self.dirty or k in self.stored)]
+                    keys = self.pending(self.sqlite_items(self.write_file,new))
+                    self.upsert({k:self.data[k] for k in keys},self.deleted)
+                    self.remember(keys)
+                else:
+                    with self.file_lock(self.write_file):
+                        self.merge_write()
+                self.dirty.clear()
+                self.deleted.clear()
                 return True
         return False
 
+    def pending(self,disk):
+        """
+        Keys of self.data to write to write_file: those changed through
+        set() or update_entry(), those changed in self.data since they
+        were read from or written to it, and any others (e.g. put
+        straight into self.data) that were neither read from it nor
+        are in disk
+
+        :param disk: keys now in write_file (dict or set)
+        :return: set of str
+        """
+        stored = self.stored
+        return self.dirty | {k for k,v in self.data.items() if (k not in self.dirty) and
+                             ((stored[k] != snapshot(v)) if k in stored else (k not in disk))}
+
+    def remember(self,keys):
+        """
+        Note that the values of keys in self.data are now in
+        write_file, and that self.deleted are not
+
+        :param keys: iterable of str
+        :return: None
+        """
+        for k in keys:
+            if k in self.data:
+                self.stored[k] = snapshot(self.data[k])
+        for k in self.deleted:
+            self.stored.pop(k,None)
+
+    def merge_write(self):
+        """
+        Merge the pending entries of self.data (see pending()) and
+        self.deleted into the yaml write_file and its journal,
+        and rewrite the file.
+        Call this holding self.file_lock(self.write_file).
+
+        :return: None
+        """
+        import yaml
+        disk = self.load_yaml(self.write_file)
+        for k in self.deleted:
+            disk.pop(k,None)
+            self.data.pop(k,None)
+        for k in self.pending(disk):
+            disk[k] = self.data[k]
+        self.data.update(disk)
+        self.stored = {k:snapshot(v) for k,v in disk.items()}
+        # write to a temporary file then rename, so readers
+        # never see a partly written file
+        wf = Path(self.write_file)
+        fd,tmp = tempfile.mkstemp(dir=wf.parent,prefix=f'.{wf.name}.')
+        with os.fdopen(fd,'w') as write_file:
+            yaml.safe_dump(disk, write_file)
+        os.chmod(tmp,wf.stat().st_mode & 0o777)
+        os.replace(tmp,wf)
+        # the journal is now in the yaml file
+        self.journal_file().unlink(missing_ok=True)
+        self.journal_entries = 0
+
+    @contextlib.contextmanager
+    def file_lock(self,f,shared=False):
+        """
+        Context manager holding an advisory lock on database file f
+        (using the file f with .lock appended). If locking is not
+        possible, e.g. in a read-only directory, no lock is taken.
+
+        :param f: Path filename
+        :param shared: bool: take a shared (read) lock
+        :return: None
+        """
+        f = Path(f)
+        lockfile = None
+        if fcntl is not None:
+            try:
+                lockfile = open(f.with_name(f.name + '.lock'),'a')
+                fcntl.flock(lockfile,(shared and fcntl.LOCK_SH) or fcntl.LOCK_EX)
+            except OSError:
+                lockfile = lockfile and lockfile.close()
+        try:
+            yield
+        finally:
+            if lockfile:
+                fcntl.flock(lockfile,fcntl.LOCK_UN)
+                lockfile.close()
+
+    def load_yaml(self,f):
+        """
+        Load yaml database file f and replay its journal
+
+        :param f: Path filename
+        :return: dict
+        """
+        import yaml
+        with open(Path(f).as_posix(), "r") as rfile:
+            data = yaml.safe_load(rfile) or {}
+        n = self.read_journal(f,data)
+        if f == self.write_file:
+            self.journal_entries = n
+        return data
+
+    @tracing.traced('database flush',lambda db: {'file':str(db.write_file)})
+    def flush(self):
+        """
+        Write the entries changed (through update_entry(), set() or
+        delete()) since the last flush() or write().
+
+        For an SQLite write_file, these are upserted in one
+        transaction. For a yaml write_file, they are appended
+        to the journal file, and every self.compact_after
+        journal entries the yaml file is rewritten.
+
+        :return:      True if saved, False if not
+        """
+        if not self.write_file:
+            return False
+        with self.lock:
+            if not (self.dirty or self.deleted):
+                return True
+            if self.is_sqlite(self.write_file):
+                self.upsert({k:self.data[k] for k in self.dirty},self.deleted)
+                self.remember(self.dirty)
+            else:
+                if self.journal_entries + len(self.dirty) + len(self.deleted) \
+                        > self.compact_after:
+                    return self.write()
+                lines = [json.dumps({'key':k,'value':self.data[k]},default=str)
+                         for k in self.dirty] + \
+                        [json.dumps({'key':k,'deleted':True}) for k in self.deleted]
+                with self.file_lock(self.write_file):
+                    with open(self.journal_file(),'a') as jfile:
+                        jfile.write('\n'.join(lines) + '\n')
+                self.journal_entries += len(lines)
+                self.remember(self.dirty)
+            self.dirty.clear()
+            self.deleted.clear()
+            return True
+
+    def journal_file(self,f=None):
+        """
+        Name of the journal file for yaml database file f
+
+        :param f: Path filename (default self.write_file)
+        :return: Path
+        """
+        f = Path(f or self.write_file)
+        return f.with_name(f.name + '.journal')
+
+    def read_journal(self,f,data):
+        """
+        Replay the journal of yaml database file f into data
+
+        :param f: Path filename
+        :param data: dict to update
+        :return: int: number of journal entries
+        """
+        journal = self.journal_file(f)
+        if not journal.exists():
+            return 0
+        n = 0
+        with open(journal,'r') as jfile:
+            for line in jfile:
+                try:
+                    item = json.loads(line)
+                except json.JSONDecodeError:
+                    # e.g. a partly written last line
+                    self.msg(f"read warning: bad line in journal {journal}")
+                    continue
+                if item.get('deleted'):
+                    data.pop(item['key'],None)
+                else:
+                    data[item['key']] = item['value']
+                n += 1
+        return n
+
+    def is_sqlite(self,f):
+        """
+        Return True if f is (or will be) an SQLite database
+
+        :param f: str filename
+        :return: bool
+        """
+        f = Path(f)
+        if f.suffix.lower() in SQLITE_SUFFIXES:
+            return True
+        try:
+            with open(f,'rb') as rfile:
+                return rfile.read(16) == b'SQLite format 3\x00'
+        except OSError:
+            return False
+
+    def connect(self,f):
+        """
+        Get the (cached) connection to SQLite database file f,
+        creating the table if needed and f is writeable
+
+        :param f: Path filename
+        :return: sqlite3.Connection
+        """
+        with self.lock:
+            conn = self.connections.get(f)
+            if conn is None:
+                if self.writeable(f):
+                    conn = sqlite3.connect(f.as_posix(),check_same_thread=False,
+                                           timeout=60)
+                    conn.execute('CREATE TABLE IF NOT EXISTS cache ' +
+                                 '(key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+                    conn.commit()
+                else:
+                    conn = sqlite3.connect(f'file:{f.as_posix()}?mode=ro',uri=True,
+                                           check_same_thread=False,timeout=60)
+                self.connections[f] = conn
+            return conn
+
+    def sqlite_items(self,f,keys=None):
+        """
+        Read entries from SQLite database file f
+
+        :param f: Path filename
+        :param keys: list of str: keys to read (default all)
+        :return: dict
+        """
+        with self.lock:
+            conn = self.connect(f)
+            try:
+                if keys is None:
+                    rows = conn.execute('SELECT key, value FROM cache').fetchall()
+                else:
+                    rows = []
+                    for key in keys:
+                        rows += conn.execute('SELECT key, value FROM cache WHERE key = ?',
+                                             (key,)).fetchall()
+            except sqlite3.OperationalError as e:
+                # e.g. empty read-only file with no table
+                self.msg(f"read warning: failed to read {f} as sqlite: {e}")
+                return {}
+        return {k:json.loads(v) for k,v in rows}
+
+    def upsert(self,items,deleted=()):
+        """
+        Insert or update items in the SQLite write_file,
+        and delete keys in deleted, in a single transaction
+
+        :param items: dict of key: value
+        :param deleted: iterable of str: keys to delete
+        :return: None
+        """
+        with self.lock:
+            conn = self.connect(self.write_file)
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)',
+                                 [(k,json.dumps(v,default=str)) for k,v in items.items()])
+                conn.executemany('DELETE FROM cache WHERE key = ?',
+                                 [(k,) for k in deleted])
+
+    def items(self):
+        """
+        All entries, including any not yet loaded from
+        SQLite files (later files take precedence, as for read())
+
+        :return: dict
+        """
+        with self.lock:
+            items = {}
+            for f in self.files:
+                if self.is_sqlite(f) and self.lazy:
+                    items.update(self.sqlite_items(f))
+            items.update(self.data)
+            for k in self.deleted:
+                items.pop(k,None)
+            return items
+
+    def lookup(self,key):
+        """
+        Get the value stored under key, from self.data or,
+        if not yet loaded, from the SQLite files (later files
+        take precedence, as for read())
+
+        :param key: str: key
+        :return: value OR None
+        """
+        with self.lock:
+            if key in self.data:
+                return self.data[key]
+            for f in self.files[::-1]:
+                if self.is_sqlite(f):
+                    value = self.sqlite_items(f,[key]).get(key)
+                    if value is not None:
+                        self.data[key] = value
+                        if f == self.write_file:
+                            self.stored[key] = snapshot(value)
+                        return value
+        return None
+
+    def entry(self,key):
+        """
+        Get a copy of the dictionary stored under key
+
+        :param key: str: key e.g. a URL
+        :return: dict (empty if key not present)
+        """
+        with self.lock:
+            return dict(self.lookup(key) or {})
+
+    def update_entry(self,key,**fields):
+        """
+        Update the dictionary stored under key with fields.
+        A field set to None is removed.
+
+        :param key: str: key e.g. a URL
+        :param fields: values to set
+        :return: dict: the updated entry
+        """
+        with self.lock:
+            entry = dict(self.lookup(key) or {})
+            entry.update(fields)
+            entry = {k:v for k,v in entry.items() if v is not None}
+            self.set(key,entry)
+            return dict(entry)
+
+    def set(self,key,value):
+        """
+        Set the value stored under key, and mark it for flush()
+
+        :param key: str: key
+        :param value: value to store
+        :return: None
+        """
+        with self.lock:
+            self.data[key] = value
+            self.dirty.add(key)
+            self.deleted.discard(key)
+
+    def delete(self,key):
+        """
+        Remove key, and mark it for flush()
+
+        :param key: str: key
+        :return: None
+        """
+        with self.lock:
+            self.data.pop(key,None)
+            self.dirty.discard(key)
+            self.deleted.add(key)
+
     def msg(self,msg):
         """
         Print message
         :return: None
         """
         # dont repeat
-        if msg not in self.msgs:
+        if self.msgs.add(msg):
             print(f'CacheDatabase: {msg}')
-            self.msgs.append(msg)
 
     def readable(self,f):
         """
@@ -159,18 +567,16 @@ class CacheDatabase():
         :param f: str filename
         :return:
         """
-        # play around with lstat to get octal permission
-        return bin(int(oct(Path(f).lstat().st_mode)[-3]))[-3:][0] == '1'
+        return bool(Path(f).lstat().st_mode & stat.S_IRUSR)
 
     def writeable(self, f):
         """
-        Return True if file is readable
+        Return True if file is writeable
 
         :param f: str filename
         :return:
         """
-        # play around with lstat to get octal permission
-        return bin(int(oct(Path(f).lstat().st_mode)[-3]))[-3:][1] == '1'
+        return bool(Path(f).lstat().st_mode & stat.S_IWUSR)
 
     def read(self):
         """
@@ -180,15 +586,74 @@ class CacheDatabase():
         """
         data = self.data
         for i,f in enumerate(self.files):
-            with open(f.as_posix(), "r") as rfile:
+            if self.is_sqlite(f):
+                if not self.lazy:
+                    items = self.sqlite_items(f)
+                    data.update(items)
+                    if f == self.write_file:
+                        self.stored.update({k:snapshot(v) for k,v in items.items()})
+                continue
+            import yaml
+            with self.file_lock(f,shared=True):
                 try:
-                    this_data = yaml.safe_load(rfile)
-                    data.update(this_data)
-                except TypeError:
+                    items = self.load_yaml(f)
+                    data.update(items)
+                    if f == self.write_file:
+                        self.stored.update({k:snapshot(v) for k,v in items.items()})
+                except (TypeError,ValueError,yaml.YAMLError):
                     self.msg("read warning: failed to read %s as yaml"%f)
                     pass
         return self
 
+def snapshot(value):
+    """
+    A copy of value to tell if it has been changed in place
+
+    :param value: database value
+    :return: str
+    """
+    return json.dumps(value,sort_keys=True,default=str)
+
+def get_database(*files,dbdir=None):
+    """
+    Get a CacheDatabase for files that is shared within this
+    process, reading it on first use. With no files, the database
+    is held in memory only. SQLite files are not loaded, but
+    looked up key by key.
+
+    :argument files: str: filename(s) for database
+    :param dbdir:    str: cache directory (see CacheDatabase)
+    :return:         CacheDatabase
+    """
+    key = (tuple(str(f) for f in files),dbdir and str(dbdir))
+    db = _databases.get(key)
+    if db is not None:
+        return db
+    with _lock:
+        db = _databases.get(key)
+        if db is None:
+            db = CacheDatabase(*files,dbdir=dbdir,lazy=True).read()
+            _databases[key] = db
+    return db
+
+def import_yaml(yaml_file,sqlite_file):
+    """
+    Copy the entries of a yaml database file into an
+    SQLite database file (created if needed)
+
+    :param yaml_file: str: yaml database filename
+    :param sqlite_file: str: SQLite database filename
+    :return: int: number of entries copied
+    """
+    import yaml
+    with open(yaml_file,'r') as rfile:
+        data = yaml.safe_load(rfile) or {}
+    db = CacheDatabase(sqlite_file)
+    if not (db.write_file and db.is_sqlite(db.write_file)):
+        raise ValueError(f'{sqlite_file} is not a writeable sqlite database file')
+    db.upsert(data)
+    return len(data)
+
 def fclean(f):
     """
     delete file f and try to delete directory if empty
@@ -197,6 +662,8 @@ def fclean(f):
     :return: None
     """
     f = Path(f)
+    for extra in ['.lock','.journal']:
+        f.with_name(f.name + extra).unlink(missing_ok=True)
     if f.exists():
         f.unlink()
         try:
@@ -342,6 +809,95 @@ test3: hello''')
 
     return True
 
+def test4(f='/tmp/tmp/database.sqlite',dbdir=None):
+    """
+    Create an SQLite database, write and re-read it,
+    look keys up lazily, and import a yaml database into it
+
+    :param f: str filename
+    :return: True if pass
+    """
+    fclean(f)
+
+    db = CacheDatabase(f, dbdir=dbdir)
+    assert db.is_sqlite(db.write_file)
+    db.data.update({'test': [1, 2, 3], 'test1': 'hello'})
+    db.write()
+
+    db = CacheDatabase(f, dbdir=dbdir).read()
+    assert db.data == {'test': [1, 2, 3], 'test1': 'hello'}
+
+    db = CacheDatabase(f, dbdir=dbdir, lazy=True).read()
+    assert db.data == {}
+    assert db.lookup('test1') == 'hello'
+    assert db.lookup('test2') is None
+
+    # import from yaml
+    y = Path(db.write_file).with_suffix('.yaml')
+    y.write_text('''test2:
+- 4
+- 5
+test3: there
+''')
+    assert import_yaml(y, db.write_file) == 2
+    db = CacheDatabase(f, dbdir=dbdir).read()
+    assert db.data == {'test': [1, 2, 3], 'test1': 'hello',
+                       'test2': [4, 5], 'test3': 'there'}
+
+    fclean(y)
+    fclean(f)
+    del db
+    return True
+
+def test6(f='/tmp/tmp/database.db',dbdir=None,nproc=4,nentries=25):
+    """
+    Several processes write to the same database file
+    at once: check that no entries are lost, and that a
+    process holding an old value of a shared key does not
+    write it back over a newer one
+
+    :param f: str filename
+    :return: True if pass
+    """
+    import multiprocessing
+    fclean(f)
+
+    for compact_after in [1000,10,1]:
+        db = CacheDatabase(f, dbdir=dbdir)
+        db.set('shared', 'old')
+        db.write()
+        barrier = multiprocessing.Barrier(nproc)
+        procs = [multiprocessing.Process(target=_test6_worker,
+                                         args=(f,dbdir,i,nentries,compact_after,barrier))
+                 for i in range(nproc)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+            assert p.exitcode == 0
+        db = CacheDatabase(f, dbdir=dbdir)
+        db.write()
+        data = CacheDatabase(f, dbdir=dbdir).read().data
+        assert len(data) == nproc*nentries + 1
+        assert data['shared'] == 'new', data['shared']
+        fclean(f)
+    return True
+
+def _test6_worker(f,dbdir,i,nentries,compact_after,barrier):
+    # every process reads shared = 'old' ...
+    db = CacheDatabase(f, dbdir=dbdir, compact_after=compact_after).read()
+    assert db.data['shared'] == 'old'
+    barrier.wait()
+    # ... then one changes it
+    if i == 0:
+        db.set('shared', 'new')
+        db.flush()
+    barrier.wait()
+    for j in range(nentries):
+        db.set(f'{i}-{j}', j)
+        db.flush()
+    db.write()
+
 def main():
     # absolute and relative pathname tests
     assert test1(f = '/tmp/tmp/database.db') == True
@@ -356,5 +912,13 @@ def main():
     # multiple files
     assert test3() == True
 
+    # sqlite backend
+    assert test4(f='/tmp/tmp/database.sqlite') == True
+    assert test4(f='tmp/database.sqlite', dbdir='/tmp') == True
+
+    # several processes
+    assert test6(f='/tmp/tmp/database.db') == True
+    assert test6(f='/tmp/tmp/database.sqlite') == True
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
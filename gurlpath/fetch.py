@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+concurrent bulk download of many URLs into the cache
+'''
+
+__author__    = "P. Lewis"
+__email__     = "p.lewis@ucl.ac.uk"
+__date__      = "28 Aug 2020"
+__copyright__ = "Copyright 2020-2022 P. Lewis"
+__license__   = "MIT License"
+
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    from gurlpath.gurlpath import URL
+    from gurlpath.settings import DEFAULTS
+except ModuleNotFoundError:
+    from gurlpath import URL
+    from settings import DEFAULTS
+
+# result of fetching one URL
+# url:    URL that was fetched
+# path:   Path of the local cache file (None on failure)
+# cached: True if this was a cache hit (no network access)
+# error:  None, or a str / Exception describing the failure
+FetchResult = collections.namedtuple('FetchResult',['url','path','cached','error'])
+
+
+def fetch_many(urls,cachedir=None,max_workers=8,per_host_limit=4,skipper=False,**kwargs):
+    """
+    Download many URLs into the local_file() cache on a thread pool
+
+    Cache hits are reported first, without any network access,
+    once the downloads have started. Downloads are streamed to the
+    cache (see URL.read()) and results are yielded as each one
+    finishes, in completion order. A failure is reported in the
+    error field of its result rather than stopping the batch.
+
+    Each host has its own queue, and no more than per_host_limit of
+    its downloads are given to the pool at a time, so a busy host
+    does not hold up the others. Downloads not yet started are
+    cancelled if the generator is closed early.
+
+    :param urls: iterable of str or URL
+    :param cachedir: override the cachedir of each URL
+    :param max_workers: int: number of download threads
+    :param per_host_limit: int: maximum concurrent downloads per host
+    :param skipper: bool: skip the anonymous get() and log in straight away
+    :param kwargs: passed to URL() for any urls given as str
+
+    :return: generator of FetchResult
+    """
+    if cachedir is not None:
+        kwargs['cachedir'] = cachedir
+    # one Settings, shared by all the new URLs
+    settings = DEFAULTS.replace(**kwargs)
+    urls = [(isinstance(u,URL) and u) or URL(u,settings=settings) for u in urls]
+
+    def fetch(url):
+        try:
+            path = url.read(cachedir=cachedir,skipper=skipper,output='path')
+        except Exception as e:
+            return FetchResult(url,None,False,e)
+        if path is None:
+            status = getattr(getattr(url,'r',None),'status_code',None)
+            return FetchResult(url,None,False,f'failed to read {url} (status {status})')
+        return FetchResult(url,path,False,None)
+
+    hits = []
+    # {host: deque of URLs to download}
+    queues = {}
+    for url in urls:
+        local_file = url.local_file(cachedir)
+        if (not url.nocache) and (not url.refreshcache) and local_file.exists():
+            hits.append(FetchResult(url,local_file,True,None))
+        else:
+            queues.setdefault(url.netloc,collections.deque()).append(url)
+
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    # {future: host}
+    running = {}
+
+    def submit(host):
+        url = queues[host].popleft()
+        running[pool.submit(fetch,url)] = host
+
+    try:
+        # start each host, in turn, up to per_host_limit
+        for i in range(max(per_host_limit,1)):
+            for host,queue in queues.items():
+                if queue:
+                    submit(host)
+        yield from hits
+        while running:
+            done,_ = wait(running,return_when=FIRST_COMPLETED)
+            for future in done:
+                host = running.pop(future)
+                if queues[host]:
+                    submit(host)
+                yield future.result()
+    finally:
+        # e.g. the generator was closed: don't wait for the rest
+        # (not shutdown(cancel_futures=True): Python 3.9+)
+        for future in running:
+            future.cancel()
+        pool.shutdown(wait=False)
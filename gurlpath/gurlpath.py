@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 
 import sys
-import yaml
 import os
 import urlpath
 import stat
@@ -12,22 +11,42 @@ from pathlib import Path
 
 import collections.abc
 import functools
+import importlib
 import re
 import urllib.parse
 import requests
-from bs4 import BeautifulSoup
 import fnmatch
-import numpy as np
+import glob
 import io
+import mmap
 import tempfile
+import time
+import threading
 from argparse import Namespace
 
+# yaml, bs4 and the modules for logins (cylog: cryptography, numpy)
+# and asyncio (aio: aiohttp) are imported when first needed,
+# to keep 'import gurlpath' quick
 try:
-    from gurlpath.cylog import Cylog
-    from gurlpath.db import CacheDatabase
+    from gurlpath.db import get_database
+    from gurlpath.session import get_session, save_cookies, cookie_file, get_bucket, \
+                                 RetryPolicy
+    from gurlpath.remotefile import RemoteFile
+    from gurlpath.cache import get_manager, manifest_add, PartialLock, file_stamp, drop_index
+    from gurlpath import checksum
+    from gurlpath import metrics
+    from gurlpath import tracing
+    from gurlpath.settings import DEFAULTS
 except ModuleNotFoundError:
-    from cylog import Cylog
-    from db import CacheDatabase
+    from db import get_database
+    from session import get_session, save_cookies, cookie_file, get_bucket, \
+                        RetryPolicy
+    from remotefile import RemoteFile
+    from cache import get_manager, manifest_add, PartialLock, file_stamp, drop_index
+    import checksum
+    import metrics
+    import tracing
+    from settings import DEFAULTS
 '''
 class derived from urlpath to provide pathlib-like
 interface to url data
@@ -39,6 +58,88 @@ __date__      = "28 Aug 2020"
 __copyright__ = "Copyright 2020-2022 P. Lewis"
 __license__   = "MIT License"
 
+def lazy_import(name):
+    """
+    Import the gurlpath module name on first use
+
+    :param name: str: module name e.g. 'aio'
+    :return: module
+    """
+    try:
+        return importlib.import_module(f'gurlpath.{name}')
+    except ModuleNotFoundError:
+        return importlib.import_module(name)
+
+# directory listings held in memory: {url: (time, [names])}
+_listings = {}
+_listings_lock = threading.Lock()
+
+# how to access each host, held in memory: {host: strategy}
+# (see URL.strategy())
+_strategies = {}
+
+
+def parse_listing(html,base):
+    """
+    Parse the names of the files and directories in an
+    HTTP directory listing (e.g. an Apache index page)
+
+    Only links to direct children of base are kept,
+    so parent, sort and absolute links are dropped.
+
+    :param html: str: listing page
+    :param base: str: URL of the listing (ending in /)
+    :return: list of str: unquoted names, without trailing /
+    """
+    from bs4 import BeautifulSoup
+    base_path = urllib.parse.urlsplit(base).path
+    if not base_path.endswith('/'):
+        base_path += '/'
+    names = []
+    for a in BeautifulSoup(html,'html.parser').find_all('a',href=True):
+        link = urllib.parse.urlsplit(urllib.parse.urljoin(base,a['href']))
+        if link.query or link.fragment or not link.path.startswith(base_path):
+            continue
+        name = link.path[len(base_path):].rstrip('/')
+        if name and ('/' not in name):
+            names.append(urllib.parse.unquote(name))
+    return sorted(set(names))
+
+
+def describe(url):
+    '''trace span args for url (see tracing.traced())'''
+    return {'url':url.cache_key()}
+
+
+def response_status(r):
+    """
+    HTTP status of response r
+
+    :param r: requests.models.Response or aiohttp.ClientResponse (or None)
+    :return: int status code (0 if r is None)
+    """
+    return getattr(r,'status_code',None) or getattr(r,'status',None) or 0
+
+
+def negative_class(status):
+    """
+    Class of a failed HTTP status, for URL.negative_ttl
+
+    :param status: int HTTP status code (0 or None: no response)
+    :return: str 'missing', 'denied' or 'error' OR None
+    """
+    if not status:
+        # no connection, or no login
+        return 'error'
+    if status in (404,410):
+        return 'missing'
+    if status in (401,403):
+        return 'denied'
+    if status >= 500:
+        return 'error'
+    return None
+
+
 class URL(urlpath.URL):
     '''
     Object-oriented URL library
@@ -50,16 +151,70 @@ class URL(urlpath.URL):
 
     param cachedir:         str: cache directory. Get dbdir from dbdir,
                             default '.'
+    param stream:           bool: stream downloads to the cache in chunks
+                            rather than holding them in memory. default False
+    param chunk_size:       int: chunk size in bytes for streaming.
+                            default 1 MB
+    param pool_size:        int: connections kept alive per host in the
+                            shared session. default session.POOL_SIZE
+    param db_file:          str: CacheDatabase file for information about
+                            cached URLs (e.g. ETag). Relative names are
+                            in $CACHE_FILE or '.'. default None: held
+                            in memory only
+    param listing_ttl:      float: seconds that a directory listing
+                            is cached for (see listdir()). default 1 day
+    param max_bytes:        int: maximum total size of the cached files
+                            tracked in the CacheDatabase. Least recently
+                            used files are removed to make room for new
+                            ones. default None: no limit
+    param max_files:        int: maximum number of cached files. default None
+    param hash_name:        str: hashlib algorithm for the checksum computed
+                            while downloading, stored in the CacheDatabase.
+                            default 'sha256'. None: no checksum
+    param checksum_sidecar: bool: verify downloads against a published
+                            checksum in a .sha256, .md5 or .xml (DAAC
+                            metadata) file next to the URL. default False
+    param dedup:            bool: store identical content reached through
+                            different URLs once, as hard links. default True
+    param persist_cookies:  bool: save login cookies for a host (encrypted,
+                            in ~/.cylog/cookies) and reuse them in later
+                            sessions, until they expire. default True
+    param negative_ttl:     dict: seconds that a failed read is remembered
+                            for, so it is not tried again, by class of
+                            HTTP status: 'missing' (404, 410), 'denied'
+                            (401, 403) and 'error' (5xx). default
+                            {'missing':86400,'denied':3600,'error':300}.
+                            None or 0: not remembered
+    param retries:          int: times to retry a request that fails to
+                            connect, or gets 429, 502, 503 or 504.
+                            default 3
+    param backoff:          float: base wait (s) between retries, doubled
+                            each time, with random jitter. A Retry-After
+                            from the server is used instead. default 1.0
+    param rate_limit:       float: maximum requests per second to a host,
+                            shared by all URLs and threads in this
+                            process. default None: no limit
+    param settings:         Settings: settings to start from, shared with
+                            other URLs (see url.settings). default DEFAULTS
+
+    The settings are held in one immutable Settings object, shared
+    by all URLs derived from this one (derive(), glob(), /, joinpath(),
+    parent, with_name() ...).
 
     '''
-    def __new__(cls,*args,**kwargs):
+    # settings shared with derived URLs (see settings.Settings):
+    # a setting assigned to a URL (e.g. url.verbose = True) is
+    # held by that URL and passed on to URLs derived from it
+    _settings = DEFAULTS
+
+    def __new__(cls,*args,settings=None,**kwargs):
         '''
         new URL
         makes call to init(**kwargs)
         '''
         self = super(URL, cls).__new__(cls,*args)
 
-        self.init(**kwargs)
+        self.init(settings,**kwargs)
         return self
 
     def defaults(self):
@@ -67,20 +222,88 @@ class URL(urlpath.URL):
         set defaults
         :return: None
         """
-        self.msgs = []
-        self.verbose = False
-        self.cachedir = "."
-        self.nocache = False
-        self.refreshcache = False
-        self.timeout = None
+        self._settings = DEFAULTS
 
-    def init(self, **kwargs):
+    def init(self,settings=None,**kwargs):
         """
+        :param settings: Settings to start from (default DEFAULTS)
         :param kwargs: pass any kw args through to object
         :return:
         """
-        self.defaults()
-        self.__dict__.update(**kwargs)
+        # tolerate URL(u,**url.__dict__)
+        settings = kwargs.pop('_settings',settings)
+        kwargs = {k:v for k,v in kwargs.items()
+                  if not (k.startswith('_') or k in ('msgs','r'))}
+        self._settings = (settings or DEFAULTS).replace(**kwargs)
+
+    def __getattr__(self,name):
+        # called for attributes not found otherwise: the shared settings
+        if not name.startswith('_'):
+            try:
+                return self._settings[name]
+            except KeyError:
+                pass
+        raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+
+    @property
+    def settings(self):
+        """
+        The settings of this URL, including any assigned to it
+
+        :return: Settings
+        """
+        d = self.__dict__
+        return self._settings.replace(**{k:d[k] for k in self._settings if k in d})
+
+    @property
+    def msgs(self):
+        """
+        Messages from msg(), made on first use
+
+        :return: metrics.MessageLog
+        """
+        msgs = self.__dict__.get('_msgs')
+        if msgs is None:
+            msgs = self.__dict__['_msgs'] = metrics.MessageLog()
+        return msgs
+
+    def inherit(self,url):
+        """
+        Give url (made from this URL) the same settings
+
+        :param url: URL or other result
+        :return: url
+        """
+        if isinstance(url,URL):
+            url._settings = self.settings
+        return url
+
+    def __reduce__(self):
+        # keep the settings when pickled (e.g. for multiprocessing)
+        return (self.__class__,tuple(self._parts),{'_settings':self.settings})
+
+    def __truediv__(self,key):
+        return self.inherit(super().__truediv__(key))
+
+    def __rtruediv__(self,key):
+        return self.inherit(super().__rtruediv__(key))
+
+    def joinpath(self,*args):
+        return self.inherit(super().joinpath(*args))
+
+    @property
+    def parent(self):
+        return self.inherit(super().parent)
+
+    def with_name(self,name):
+        return self.inherit(super().with_name(name))
+
+    def with_suffix(self,suffix):
+        return self.inherit(super().with_suffix(suffix))
+
+    def with_components(self,**kwargs):
+        # with_scheme(), with_query() etc. call this too
+        return self.inherit(super().with_components(**kwargs))
 
     def isfile(self):
         """
@@ -114,10 +337,256 @@ class URL(urlpath.URL):
         :return: None
         """
         # dont repeat
-        if msg not in self.msgs:
-            if self.verbose:
-                print(msg)
-            self.msgs.append(msg)
+        if self.msgs.add(msg) and self.verbose:
+            print(msg)
+
+    def cache_key(self):
+        """
+        Key for this URL in the CacheDatabase: the URL
+        without any username or password
+
+        :return: str
+        """
+        if self.username or self.password:
+            parts = urllib.parse.urlsplit(str(self))
+            return urllib.parse.urlunsplit(parts._replace(netloc=self.hostinfo))
+        return str(self)
+
+    def config(self):
+        """
+        The keyword settings of this URL (cachedir etc.)
+
+        :return: dict
+        """
+        return dict(self.settings)
+
+    def derive(self,url):
+        """
+        A new URL sharing the settings of this one
+
+        :param url: str or URL
+        :return: URL
+        """
+        return URL(url,settings=self.settings)
+
+    def database(self):
+        """
+        The CacheDatabase for self.db_file, shared within
+        this process
+
+        :return: CacheDatabase
+        """
+        if self.db_file:
+            return get_database(self.db_file)
+        return get_database()
+
+    def flush(self):
+        """
+        Write the CacheDatabase entries changed since the
+        last flush() to self.db_file
+
+        :return: True if saved, False if not
+        """
+        return self.database().flush()
+
+    def cache_manager(self):
+        """
+        The CacheManager tracking the cache files in the
+        CacheDatabase, with limits self.max_bytes / self.max_files
+
+        :return: CacheManager
+        """
+        return get_manager(self.database(),max_bytes=self.max_bytes,
+                           max_files=self.max_files)
+
+    def pin(self,pinned=True):
+        """
+        Pin (or unpin) the cache file for this URL, so that
+        it is never removed to make room for others
+
+        :param pinned: bool
+        :return: None
+        """
+        self.cache_manager().pin(self.cache_key(),pinned)
+
+    def unpin(self):
+        """
+        Unpin the cache file for this URL
+
+        :return: None
+        """
+        self.pin(False)
+
+    def validators(self):
+        """
+        Conditional request headers for refreshing the cache,
+        from the ETag and Last-Modified recorded in the CacheDatabase
+
+        :return: dict of headers
+        """
+        entry = self.database().entry(self.cache_key())
+        headers = {}
+        if 'etag' in entry:
+            headers['If-None-Match'] = entry['etag']
+        if 'last_modified' in entry:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    @tracing.traced('record validators',describe)
+    def record_validators(self,r):
+        """
+        Record ETag, Last-Modified and Content-Length from
+        response r in the CacheDatabase
+
+        :param r: requests.models.Response or aiohttp.ClientResponse
+        :return: None
+        """
+        self.database().update_entry(self.cache_key(),
+                            etag=r.headers.get('ETag'),
+                            last_modified=r.headers.get('Last-Modified'),
+                            content_length=self.expected_size(response_status(r),r.headers))
+
+    def listing_key(self):
+        """
+        Key for the directory listing of this URL in the
+        listing cache and CacheDatabase
+
+        :return: str: cache_key() ending in /
+        """
+        return self.cache_key().rstrip('/') + '/'
+
+    def cached_listing(self):
+        """
+        The cached directory listing of this URL, if there is
+        one younger than self.listing_ttl (and not self.refreshcache)
+
+        :return: list of str names OR None
+        """
+        if self.refreshcache:
+            return None
+        key = self.listing_key()
+        now = time.time()
+        cached = _listings.get(key)
+        if cached and (now - cached[0] < self.listing_ttl):
+            return list(cached[1])
+        entry = self.database().entry(key)
+        if ('listing' in entry) and (now - entry.get('listing_time',0) < self.listing_ttl):
+            with _listings_lock:
+                _listings[key] = (entry['listing_time'],entry['listing'])
+            return list(entry['listing'])
+        return None
+
+    def store_listing(self,names):
+        """
+        Cache the directory listing of this URL in memory
+        and in the CacheDatabase
+
+        :param names: list of str names
+        :return: None
+        """
+        key = self.listing_key()
+        now = time.time()
+        with _listings_lock:
+            _listings[key] = (now,list(names))
+        self.database().update_entry(key,listing=list(names),listing_time=now)
+
+    @tracing.traced('negative lookup',describe)
+    def negative(self):
+        """
+        The HTTP status of a recent failure to read this URL, if it
+        is still within self.negative_ttl (and not self.refreshcache)
+
+        :return: int status (0 if there was no response) OR None
+        """
+        if self.refreshcache:
+            return None
+        negative = self.database().entry(self.cache_key()).get('negative')
+        if not negative:
+            return None
+        ttl = (self.negative_ttl or {}).get(negative_class(negative['status']))
+        if ttl and (time.time() - negative['time'] < ttl):
+            return negative['status'] or 0
+        return None
+
+    def record_negative(self,r):
+        """
+        Remember a failure to read this URL (see negative())
+
+        :param r: requests.models.Response or aiohttp.ClientResponse
+                  of the failure OR None if there was no response
+        :return: None
+        """
+        status = response_status(r)
+        if not (self.negative_ttl or {}).get(negative_class(status)):
+            return
+        self.msg(f'remembering status {status} for {self.path}')
+        self.database().update_entry(self.cache_key(),
+                                     negative={'status':status,'time':time.time()})
+
+    def purge(self):
+        """
+        Forget any failure to read this URL, or list it
+        as a directory, so the next read tries again
+
+        :return: None
+        """
+        db = self.database()
+        for key in (self.cache_key(),self.listing_key()):
+            if 'negative' in db.entry(key):
+                db.update_entry(key,negative=None)
+
+    def listdir(self):
+        """
+        Names of the files and directories in the HTTP directory
+        listing of this URL. Listings are cached (see cached_listing())
+
+        :return: list of str names (empty on failure)
+        """
+        names = self.cached_listing()
+        if names is not None:
+            self.msg(f'using cached listing of {self.path}')
+            return names
+        # the listing URL, keeping any username and password
+        url = self.derive(str(self).rstrip('/') + '/')
+        status = url.negative()
+        if status is not None:
+            self.msg(f'listing {self.path} recently failed ({status}): not trying again')
+            return []
+        r = url.get_response()
+        self.r = url.r
+        if (r is None) or (r.status_code != 200):
+            self.msg(f'failed to list {self.path}')
+            url.record_negative(self.r)
+            return []
+        names = parse_listing(r.text,r.url)
+        self.store_listing(names)
+        url.purge()
+        return names
+
+    def glob(self,pattern,pre_filter=True):
+        """
+        Find the URLs below this one matching pattern, using the
+        HTTP directory listings (see listdir()).
+
+        The pattern is matched one path segment at a time, with
+        fnmatch, so subdirectories that do not match are never listed.
+
+        :param pattern: str: e.g. 'MOT*/MCD15A3H.006/2003.12.11/*0.hdf'
+        :param pre_filter: bool: if True, segments with no wildcards are
+                           assumed to exist rather than checked in the listing
+        :return: list of URL
+        """
+        current = [self]
+        for part in [p for p in str(pattern).split('/') if p]:
+            found = []
+            for url in current:
+                if pre_filter and (not glob.has_magic(part)):
+                    found.append(url.derive(url / part))
+                    continue
+                found.extend([url.derive(url / name) for name in url.listdir()
+                              if fnmatch.fnmatch(name,part)])
+            current = found
+        return current
 
     def readable(self,f):
         """
@@ -126,85 +595,898 @@ class URL(urlpath.URL):
         :param f: str filename
         :return:
         """
-        # play around with lstat to get octal permission
-        return bin(int(oct(Path(f).lstat().st_mode)[-3]))[-3:][0] == '1'
+        return bool(Path(f).lstat().st_mode & stat.S_IRUSR)
 
     def writeable(self, f):
         """
-        Return True if file is readable
+        Return True if file is writeable
 
         :param f: str filename
         :return:
         """
-        # play around with lstat to get octal permission
-        return bin(int(oct(Path(f).lstat().st_mode)[-3]))[-3:][1] == '1'
+        return bool(Path(f).lstat().st_mode & stat.S_IWUSR)
 
-    def get_login(self,head=True):
-        self.msg('getting login and password')
-        with requests.Session() as session:
+    def session(self):
+        """
+        The shared requests.Session for the scheme+host of this URL
+
+        Sessions are kept in a process-wide registry (see session.py)
+        so that connections (and login cookies) are reused across
+        URL instances and threads. With self.persist_cookies, a new
+        session starts with any saved login cookies for the host.
+
+        :return: requests.Session
+        """
+        return get_session(self,pool_size=self.pool_size,
+                           persist_cookies=self.persist_cookies)
+
+    def request(self,method,url=None,**kwargs):
+        """
+        Make a request through the shared session for this host
+
+        Requests are rate limited (self.rate_limit) and retried when
+        the server is busy or the connection fails (self.retries).
+        Each response is counted in metrics, with its latency.
+
+        :param method: str: HTTP method e.g. 'get'
+        :param url: str: url to request (default self)
+        :param kwargs: passed through to requests.Session.request()
+                       timeout defaults to self.timeout
+        :return: requests.models.Response
+        """
+        kwargs.setdefault('timeout',self.timeout)
+        if url is None:
+            # credentials are passed explicitly, not in the url,
+            # so that cookies are set for the host itself
+            url = self.cache_key()
             if self.username and self.password:
-                session.auth = self.username,self.password
-            else:
-                self.msg(f'getting login and password for {self.anchor} from cylog()')
-                uinfo = Cylog(self.anchor).login()
-                if uinfo == (None,None):
-                    return None
-                session.auth = uinfo[0].decode('utf-8'),uinfo[1].decode('utf-8')
-                self.msg(f'logging in to {self.anchor}')
+                kwargs.setdefault('auth',(self.username,self.password))
+        policy = self.retry_policy()
+        bucket = self.rate_limiter()
+        host = self.host_key()
+        attempt = 0
+        while True:
+            bucket.wait()
+            start = time.perf_counter()
             try:
-                self.msg(f'requesting get for {self.path}')
-                r1 = session.request('get',self)
-                if r1.status_code == 200:
-                    self.msg(f'status good for {self.path}')
-                    return r1
-                # try encoded login
-                if head:
-                    self.msg(f'trying to access head for {self.path}')
-                    r2 = session.head(r1.url)
-                else:
-                    self.msg(f'trying to access data for {self.path}')
-                    r2 = session.get(r1.url)
-                if r2.status_code == 200:
-                    self.msg(f'data read for {self.path}')
-                if type(r2) == requests.models.Response:
-                    self.msg(f'problem with login/read for {self.path}')
-                    return r2
-            except:
-                self.msg(f'failure reading data from {self.anchor}')
-                return None
+                r = self.session().request(method,str(url),**kwargs)
+            except (requests.exceptions.ConnectionError,requests.exceptions.Timeout) as e:
+                metrics.inc('request_errors',host=host,error=type(e).__name__)
+                if not policy.retry(attempt):
+                    raise
+                self.msg(f'failure requesting {self.path}: {e}')
+                r = None
+            if r is not None:
+                metrics.inc('requests',host=host,status=r.status_code)
+                metrics.observe('request_seconds',r.elapsed.total_seconds(),host=host)
+                if tracing.enabled():
+                    self.trace_response(method,start,r,kwargs.get('stream'))
+                if not policy.retry(attempt,r.status_code):
+                    return r
+            metrics.inc('retries',host=host,status=getattr(r,'status_code','error'))
+            delay = policy.delay(attempt,getattr(r,'headers',None))
+            if r is not None:
+                self.msg(f'status code for {self.path} {r.status_code}: ' +
+                         f'retrying in {delay:.1f} s')
+                r.close()
+                # the whole host is busy: hold back other requests too
+                bucket.pause(delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def trace_response(self,method,start,r,stream=False):
+        """
+        Record response r and any redirect hops before it in the trace
+        (see tracing), with the time to first byte (ttfb_ms) and,
+        unless streamed, the transfer rate of the body
+
+        :param method: str: HTTP method
+        :param start: float: time.perf_counter() when the request was made
+        :param r: requests.models.Response
+        :param stream: bool: r was opened with stream=True
+        :return: None
+        """
+        end = time.perf_counter()
+        t = start
+        for h in r.history:
+            tracing.event('redirect',t,h.elapsed.total_seconds(),status=h.status_code,
+                          url=h.url.split('?')[0],
+                          location=h.headers.get('Location','').split('?')[0])
+            t += h.elapsed.total_seconds()
+        ttfb = r.elapsed.total_seconds()
+        args = {'method':method.upper(),'url':r.url.split('?')[0],'status':r.status_code,
+                'redirects':len(r.history),'ttfb_ms':round(ttfb * 1e3,3)}
+        if not stream:
+            # the body has been read: time it from the last response headers
+            args['bytes'] = len(r.content)
+            transfer = end - t - ttfb
+            if transfer > 0:
+                args['MB/s'] = round(args['bytes'] / transfer / 1e6,3)
+        tracing.event('request',start,end - start,**args)
+
+    def retry_policy(self):
+        """
+        The RetryPolicy for requests from this URL
+        (see self.retries and self.backoff)
+
+        :return: session.RetryPolicy
+        """
+        return RetryPolicy(retries=self.retries,backoff=self.backoff)
+
+    def rate_limiter(self):
+        """
+        The TokenBucket limiting requests to the host of this URL
+        to self.rate_limit per second, shared within this process
+
+        :return: session.TokenBucket
+        """
+        return get_bucket(self,rate=self.rate_limit)
+
+    def host_key(self):
+        """
+        Key for the host of this URL in the CacheDatabase:
+        scheme://host[:port]
+
+        :return: str
+        """
+        return f'{self.scheme}://{self.hostinfo}'
+
+    def strategy(self):
+        """
+        How the host of this URL was last accessed successfully:
+
+            'anonymous': a plain get()
+            'basic':     get() with login and password
+            'login':     get() with login and password, following
+                         a redirect to a login server (2-pass)
+
+        Kept in memory and in the CacheDatabase, so that
+        get_response() can go straight to a login for hosts
+        that need one.
+
+        :return: str OR None if not known
+        """
+        key = self.host_key()
+        strategy = _strategies.get(key)
+        if strategy is None:
+            strategy = self.database().entry(key).get('strategy')
+            if strategy is not None:
+                _strategies[key] = strategy
+        return strategy
+
+    def set_strategy(self,strategy):
+        """
+        Record how the host of this URL was accessed (see strategy())
+
+        :param strategy: str: 'anonymous', 'basic' or 'login'
+                         OR None to forget it
+        :return: None
+        """
+        if strategy == self.strategy():
+            return
+        key = self.host_key()
+        if strategy is None:
+            _strategies.pop(key,None)
+        else:
+            self.msg(f'access strategy for {key}: {strategy}')
+            _strategies[key] = strategy
+        self.database().update_entry(key,strategy=strategy)
+
+    def has_credentials(self):
+        """
+        True if credentials() can answer without prompting.
+        This creates no Cylog key file.
+
+        :return: bool
+        """
+        if self.username and self.password:
+            return True
+        cylog = lazy_import('cylog')
+        return cylog.stored_login(cylog.key_file(),self.anchor)
+
+    def credentials(self):
+        """
+        Get (username, password) for this URL, either from the URL
+        itself or from cylog()
+
+        :return: tuple of str (username, password) OR None
+        """
+        if self.username and self.password:
+            return self.username,self.password
+        self.msg(f'getting login and password for {self.anchor} from cylog()')
+        uinfo = lazy_import('cylog').Cylog(self.anchor).login()
+        if uinfo == (None,None):
+            return None
+        return uinfo[0].decode('utf-8'),uinfo[1].decode('utf-8')
+
+    @tracing.traced('save cookies',describe)
+    def save_cookies(self):
+        """
+        With self.persist_cookies, save the cookies of the shared
+        session after a login, so later sessions can skip it.
+        They are only written if they have changed.
+
+        :return: None
+        """
+        if not self.persist_cookies:
+            return
+        try:
+            f = save_cookies(self.session(),self)
+        except OSError as e:
+            self.msg(f'failed to save cookies for {self.anchor}: {e}')
+            return
+        if f is not None:
+            self.msg(f'saved login cookies for {self.anchor} in {f}')
+
+    @tracing.traced('login',describe)
+    def get_login(self,head=True,stream=False,headers=None):
+        self.msg('getting login and password')
+        auth = self.credentials()
+        if auth is None:
+            return None
+        self.msg(f'logging in to {self.anchor}')
+        try:
+            self.msg(f'requesting get for {self.path}')
+            r1 = self.request('get',auth=auth,stream=stream,headers=headers)
+            if r1.status_code in (200,206,304):
+                self.msg(f'status good for {self.path}')
+                self.set_strategy('basic')
+                self.save_cookies()
+                return r1
+            r1.close()
+            # try encoded login
+            if head:
+                self.msg(f'trying to access head for {self.path}')
+                r2 = self.request('head',r1.url,auth=auth,headers=headers)
+            else:
+                self.msg(f'trying to access data for {self.path}')
+                r2 = self.request('get',r1.url,auth=auth,stream=stream,headers=headers)
+            if r2.status_code in (200,206):
+                self.msg(f'data read for {self.path}')
+                self.set_strategy('login')
+                self.save_cookies()
+            if type(r2) == requests.models.Response:
+                self.msg(f'problem with login/read for {self.path}')
+                return r2
+        except requests.exceptions.RequestException as e:
+            self.msg(f'failure reading data from {self.anchor}: {e}')
+            return None
         self.msg(f'failure reading data from {self.anchor}')
         return None
 
-    def pull_file(self,local_file,ftype='binary',skipper=False):
+    def get_response(self,skipper=False,stream=False,headers=None):
         """
-        try a simple get()
+        try a simple get() and if that fails, a login with get_login()
 
-        :param local_file: Path local file name for storage
-        :param ftype: str: file type ('text' or 'binary')
-        :return: data
+        The simple get() is skipped for hosts known to need a login
+        (see strategy()), if credentials are available. If that login
+        is refused, the strategy is forgotten and the simple get()
+        tried after all.
+
+        :param skipper: bool: skip the simple get()
+        :param stream: bool: open the response with stream=True
+        :param headers: dict: extra request headers
+
+        :return: requests.models.Response with status 200, 206 or 304
+                 OR None on failure
         """
-        if not skipper:
+        # the last response, kept for the caller (None if there was none)
+        self.r = None
+        memo = self.strategy()
+        if memo in ('basic','login') and (not self.has_credentials()):
+            # e.g. public data on a host that has protected data too
+            memo = None
+        if (not skipper) and (memo in ('basic','login')):
+            self.msg(f'{self.host_key()} needs a login: skipping get()')
+        elif not skipper:
             self.msg('trying get() ...')
-            r = self.get()
+            try:
+                with tracing.span('get'):
+                    r = self.request('get',stream=stream,headers=headers)
+            except requests.exceptions.RequestException as e:
+                # no response, even after retries: not a login problem
+                self.msg(f'failure reading data from {self.anchor}: {e}')
+                return None
             self.r = r
             if type(r) == requests.models.Response:
-                if r.status_code == 200:
+                if r.status_code in (200,206,304):
                     # returned ok
-                    return (ftype == 'binary' and r.content) or r.text
-                else:
-                    self.msg(f'status code for {self.path} {r.status_code}')
+                    self.set_strategy('anonymous')
+                    if r.history and self.persist_cookies and \
+                            ((self.username and self.password) or cookie_file(self).exists()):
+                        # redirected with the credentials in the URL, or cookies
+                        # from an earlier login: maybe through a login
+                        self.save_cookies()
+                    return r
+                self.msg(f'status code for {self.path} {r.status_code}')
+                r.close()
+                if (r.status_code == 416) or (r.status_code in self.retry_policy().statuses):
+                    # range not satisfiable, or server busy: not a login problem
+                    return None
         # unauthorised: try with a login
-        r = self.get_login(head=False)
-        self.r = r
-        if type(r) != requests.models.Response:
+        if not skipper:
+            metrics.inc('login_fallbacks',host=self.host_key())
+        r = self.get_login(head=False,stream=stream,headers=headers)
+        if r is not None:
+            # else keep the response to get() e.g. a 404 with no login
+            self.r = r
+        if type(r) == requests.models.Response:
+            if r.status_code in (200,206,304):
+                self.msg(f'status code good for {self.path}')
+                return r
+            self.msg(f'status code poor for {self.path}: problem logging in or other access')
+            r.close()
+        if (not skipper) and (memo in ('basic','login')) and \
+                (getattr(r,'status_code',None) in (None,401,403)):
+            # the login failed: the host may have changed, so start again
+            self.set_strategy(None)
+            return self.get_response(stream=stream,headers=headers)
+        return None
+
+    def pull_file(self,local_file,ftype='binary',skipper=False,stream=False,headers=None,
+                  expected=None):
+        """
+        try a simple get()
+
+        :param local_file: Path local file name for storage
+        :param ftype: str: file type ('text' or 'binary')
+        :param stream: bool: stream the response in chunks of
+                       self.chunk_size straight into local_file
+        :param headers: dict: extra request headers, e.g. from validators().
+                        On a 304 (not modified) response, local_file is used
+        :param expected: (algorithm, value) checksum to verify a
+                         streamed download against
+
+        :return: data
+                 OR Path to local_file if stream
+                 OR None on failure
+        """
+        r = self.get_response(skipper=skipper,stream=stream,headers=headers)
+        if r is None:
+            return None
+        return self.response_data(r,local_file,ftype,stream,expected)
+
+    def response_data(self,r,local_file,ftype='binary',stream=False,expected=None):
+        """
+        Get the data from a good response
+
+        :param r: requests.models.Response
+        :param local_file: Path local file name for storage
+        :param ftype: str: file type ('text' or 'binary')
+        :param stream: bool: stream the response to local_file
+        :param expected: (algorithm, value) checksum to verify against (stream)
+
+        :return: data OR Path to local_file if stream OR None on failure
+        """
+        if r.status_code == 304:
+            self.msg(f'{self.path} not modified: using {local_file}')
+            r.close()
+            return (stream and local_file) or self.output(local_file,ftype)
+        if stream:
+            return self.stream_to_file(r,local_file,expected)
+        metrics.inc('bytes_downloaded',len(r.content),host=self.host_key())
+        return (ftype == 'binary' and r.content) or r.text
+
+    def stream_to_file(self,r,local_file,expected=None):
+        """
+        Write the body of response r to local_file in chunks
+        of self.chunk_size bytes, so that no more than one chunk
+        is held in memory.
+
+        The data go to a partial file (local_file with .part
+        appended) which is renamed into place when complete, so
+        local_file is either complete or absent. If the transfer
+        fails, the partial file is kept so that it can be
+        resumed (see resume_headers()).
+
+        :param r: requests.models.Response opened with stream=True
+        :param local_file: Path local file name for storage
+        :param expected: (algorithm, value) checksum to verify against
+                         (see expected_checksum())
+
+        :return: Path to local_file OR None on failure
+        """
+        nbytes = 0
+        try:
+            f,hashers = self.start_partial(local_file,r.status_code,r.headers,expected)
+            if f is None:
+                return None
+            with f, tracing.span('transfer',url=self.cache_key()) as s:
+                for chunk in r.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+                    nbytes += len(chunk)
+                    for h in hashers.values():
+                        h.update(chunk)
+                s.set(bytes=nbytes)
+        except (OSError,requests.exceptions.RequestException) as e:
+            self.msg(f'failure streaming {self.path} to {local_file}: {e}')
+            self.keep_partial(local_file)
+            return None
+        finally:
+            r.close()
+            metrics.inc('bytes_downloaded',nbytes,host=self.host_key())
+        return self.finish_partial(local_file,r.status_code,r.headers,hashers,expected)
+
+    def start_partial(self,local_file,status,headers,expected=None):
+        """
+        Make room in the cache for a download and open its partial
+        file (see open_partial()), with hashers for its checksums.
+        The start of stream_to_file() and aio.stream_to_file().
+
+        :param local_file: Path local file name for storage
+        :param status: int: response status code
+        :param headers: response headers
+        :param expected: (algorithm, value) checksum to verify against
+
+        :return: (file object open for binary write, dict of {algorithm: hash object})
+                 OR (None, None) if the response does not follow on
+                 from the partial file
+        """
+        if not self.nocache:
+            self.cache_manager().make_room(self.expected_size(status,headers) or 0,
+                                           keep=self.cache_key())
+        f,part = self.open_partial(local_file,status,headers)
+        if f is None:
+            return None,None
+        hashers = self.new_hashers(expected)
+        if status == 206:
+            # hash what we already have
+            self.hash_file(part,hashers)
+        return f,hashers
+
+    def hash_file(self,f,hashers):
+        """
+        Update hashers with the contents of file f
+
+        :param f: Path of file
+        :param hashers: dict of {algorithm: hash object} (see new_hashers())
+        :return: hashers
+        """
+        with open(f,'rb') as pf:
+            for chunk in iter(lambda: pf.read(self.chunk_size),b''):
+                for h in hashers.values():
+                    h.update(chunk)
+        return hashers
+
+    def finish_partial(self,local_file,status,headers,hashers,expected=None):
+        """
+        Move a completed download into place (see commit_partial())
+        and record its checksums. The end of stream_to_file() and
+        aio.stream_to_file().
+
+        :param local_file: Path local file name for storage
+        :param status: int: response status code
+        :param headers: response headers
+        :param hashers: dict of {algorithm: hash object} from start_partial()
+        :param expected: (algorithm, value) checksum to verify against
+
+        :return: Path to local_file OR None on failure
+        """
+        digests = {k:h.hexdigest() for k,h in hashers.items()}
+        if self.commit_partial(local_file,self.expected_size(status,headers),
+                               digests=digests,expected=expected) is None:
+            return None
+        self.msg(f'streamed {self.path} to {local_file}')
+        if not self.nocache:
+            self.record_checksums(digests,local_file)
+        return local_file
+
+    def record_download(self,r,local_file):
+        """
+        Bookkeeping after a download, for download() and aio.read().
+        A failure is remembered (see record_negative()). On success,
+        any failure is forgotten and (unless self.nocache) the
+        validators of a full or partial response are recorded
+        (see record_validators()) and the cache file is tracked
+        (see cache_manager()).
+
+        :param r: requests.models.Response or aiohttp.ClientResponse
+                  (or None if there was none)
+        :param local_file: Path of the downloaded file OR None on failure
+        :return: None
+        """
+        if local_file is None:
+            self.record_negative(r)
+            return
+        self.purge()
+        if (not self.nocache) and (response_status(r) in (200,206)):
+            self.record_validators(r)
+            self.cache_manager().record(self.cache_key(),local_file)
+
+    def partial_file(self,local_file):
+        """
+        Name of the partial download file for local_file
+
+        :param local_file: Path local file name for storage
+        :return: Path
+        """
+        local_file = Path(local_file)
+        return local_file.with_name(local_file.name + '.part')
+
+    def partial_info(self,local_file):
+        """
+        Name of the file holding the validator (ETag or Last-Modified)
+        for the partial download of local_file
+
+        :param local_file: Path local file name for storage
+        :return: Path
+        """
+        local_file = Path(local_file)
+        return local_file.with_name(local_file.name + '.part.yaml')
+
+    def partial_lock(self,local_file):
+        """
+        Lock on the partial download of local_file, so that only
+        one process or thread downloads or resumes it at a time
+
+            with url.partial_lock(local_file) as lock:
+                ...
+
+        :param local_file: Path local file name for storage
+        :return: cache.PartialLock
+        """
+        return PartialLock(local_file)
+
+    def resume_headers(self,local_file):
+        """
+        Request headers to resume a partial download of local_file,
+        if there is one with a validator.
+
+        If-Range means the server sends the whole file (200) rather
+        than the rest of it (206) if it has changed.
+
+        :param local_file: Path local file name for storage
+        :return: dict of headers
+        """
+        part = self.partial_file(local_file)
+        info = self.partial_info(local_file)
+        if not (part.exists() and info.exists()):
+            return {}
+        import yaml
+        validator = yaml.safe_load(info.read_text()) or {}
+        validator = validator.get('etag') or validator.get('last_modified')
+        size = part.stat().st_size
+        if (not validator) or (size == 0):
+            return {}
+        self.msg(f'resuming {self.path} from byte {size}')
+        return {'Range':f'bytes={size}-','If-Range':validator}
+
+    def expected_size(self,status,headers):
+        """
+        Full size of the file from response headers, if known
+
+        :param status: int: response status code
+        :param headers: response headers
+        :return: int OR None
+        """
+        if status == 206:
+            total = (headers.get('Content-Range') or '').rsplit('/',1)[-1]
+            return (total.isdigit() and int(total)) or None
+        if headers.get('Content-Encoding') not in (None,'identity'):
+            # Content-Length is the encoded size
+            return None
+        length = headers.get('Content-Length')
+        return (length and length.isdigit() and int(length)) or None
+
+    @tracing.traced('open partial',describe)
+    def open_partial(self,local_file,status=200,headers=None):
+        """
+        Open the partial file next to local_file to receive a download
+
+        For a 206 (partial content) response, the partial file is
+        appended to. Otherwise it is started again, and the
+        validator from headers is stored for resuming later.
+
+        :param local_file: Path local file name for storage
+        :param status: int: response status code
+        :param headers: response headers
+        :return: (file object open for binary write, Path of partial file)
+                 OR (None, Path of partial file) if the response
+                 does not follow on from the partial file
+        """
+        headers = headers or {}
+        local_file = Path(local_file)
+        local_file.parent.mkdir(parents=True, exist_ok=True)
+        part = self.partial_file(local_file)
+        if status == 206:
+            start = (headers.get('Content-Range') or '').split(' ')[-1].split('-')[0]
+            if part.exists() and start.isdigit() and int(start) == part.stat().st_size:
+                return open(part,'ab'),part
+            self.msg(f'range response for {self.path} does not match {part}')
+            self.discard_partial(local_file)
+            return None,part
+        validator = {'etag':headers.get('ETag'),
+                     'last_modified':headers.get('Last-Modified')}
+        import yaml
+        self.partial_info(local_file).write_text(yaml.safe_dump(validator))
+        return open(part,'wb'),part
+
+    def keep_partial(self,local_file):
+        """
+        Keep a failed partial download of local_file if it can be
+        resumed, otherwise remove it
+
+        :param local_file: Path local file name for storage
+        :return: None
+        """
+        if not self.resume_headers(local_file):
+            self.discard_partial(local_file)
+
+    def discard_partial(self,local_file):
+        """
+        Remove any partial download of local_file
+
+        :param local_file: Path local file name for storage
+        :return: None
+        """
+        self.partial_file(local_file).unlink(missing_ok=True)
+        self.partial_info(local_file).unlink(missing_ok=True)
+
+    @tracing.traced('commit partial',describe)
+    def commit_partial(self,local_file,size=None,digests=None,expected=None):
+        """
+        Move a completed partial download into place as local_file
+
+        :param local_file: Path local file name for storage
+        :param size: int: expected size of the file, if known.
+                     A short file is kept for resuming.
+        :param digests: dict of {algorithm: value} for the file
+        :param expected: (algorithm, value) checksum to verify.
+                         A file that fails is removed.
+        :return: Path local_file OR None if incomplete or failed
+        """
+        part = self.partial_file(local_file)
+        if not part.exists():
+            # finished by another process or thread
+            return self.finished_elsewhere(local_file)
+        if (size is not None) and (part.stat().st_size != size):
+            self.msg(f'incomplete download of {self.path}: ' +
+                     f'{part.stat().st_size} of {size} bytes')
+            if part.stat().st_size < size:
+                self.keep_partial(local_file)
+            else:
+                self.discard_partial(local_file)
+            return None
+        if not self.verify_checksum(digests,expected):
+            self.discard_partial(local_file)
+            return None
+        if not self.nocache:
+            self.forget_checksums(local_file)
+        try:
+            os.chmod(part,0o644)
+            os.replace(part,local_file)
+        except FileNotFoundError:
+            return self.finished_elsewhere(local_file)
+        self.partial_info(local_file).unlink(missing_ok=True)
+        manifest_add(local_file)
+        return Path(local_file)
+
+    def finished_elsewhere(self,local_file):
+        """
+        local_file, if its partial file has gone because another
+        process or thread (not holding partial_lock()) finished it
+
+        :param local_file: Path local file name for storage
+        :return: Path local_file OR None if it does not exist
+        """
+        local_file = Path(local_file)
+        if local_file.exists():
+            self.msg(f'{local_file} was finished by another process or thread')
+            return local_file
+        self.msg(f'partial download of {self.path} has gone')
+        return None
+
+    def new_hashers(self,expected=None):
+        """
+        New hash objects for self.hash_name and any
+        expected checksum algorithm
+
+        :param expected: (algorithm, value) OR None
+        :return: dict of {algorithm: hash object}
+        """
+        names = [n for n in [self.hash_name,expected and expected[0]] if n]
+        return {n:checksum.new(n) for n in names}
+
+    def verify_checksum(self,digests,expected):
+        """
+        Check digests against an expected checksum
+
+        :param digests: dict of {algorithm: value}
+        :param expected: (algorithm, value) OR None
+        :return: True if OK (or nothing to check)
+        """
+        if not expected:
+            return True
+        algorithm,value = expected
+        if (digests or {}).get(algorithm) == value:
+            self.msg(f'{algorithm} checksum good for {self.path}')
+            return True
+        self.msg(f'{algorithm} checksum failed for {self.path}: ' +
+                 f'expected {value}, got {(digests or {}).get(algorithm)}')
+        return False
+
+    @tracing.traced('expected checksum',describe)
+    def expected_checksum(self,checksum_value=None):
+        """
+        The checksum a download should have: checksum_value if given,
+        else (with self.checksum_sidecar) the published one from a
+        .sha256, .md5 or .xml file next to the URL
+
+        :param checksum_value: str: e.g. 'md5:<hex>' or a hex digest
+        :return: (algorithm, value) OR None
+        """
+        expected = checksum.parse_checksum(checksum_value)
+        if expected or (not self.checksum_sidecar):
+            return expected
+        for suffix in ['.sha256','.md5','.xml']:
+            url = self.derive(str(self) + suffix)
+            try:
+                r = url.request('get')
+            except requests.exceptions.RequestException as e:
+                # as if there were no sidecar
+                self.msg(f'failure reading {url.path}: {e}')
+                continue
+            if r.status_code in (401,403):
+                r = url.get_login(head=False)
+            if (r is None) or (r.status_code != 200):
+                continue
+            if suffix == '.xml':
+                # e.g. LP DAAC metadata: <Checksum> and <ChecksumType>
+                from bs4 import BeautifulSoup
+                xml = BeautifulSoup(r.text,'html.parser')
+                value,ctype = xml.find('checksum'),xml.find('checksumtype')
+                expected = value and checksum.parse_checksum(value.text.strip(),
+                                                  ctype and ctype.text.strip())
+            else:
+                words = r.text.split()
+                expected = words and checksum.parse_checksum(words[0],suffix[1:])
+            if expected:
+                self.msg(f'published checksum for {self.path}: {expected[0]} {expected[1]}')
+                return expected
+        return None
+
+    @tracing.traced('record checksums',describe)
+    def record_checksums(self,digests,local_file):
+        """
+        Store the checksums of a cache file in the CacheDatabase.
+
+        With self.dedup, an index entry ('<algorithm>:<value>') records
+        the file holding that content (path, with its size and mtime
+        to tell if it is replaced, see indexed_file()), and if another
+        cache file already holds it, local_file is replaced by a hard
+        link to it.
+
+        :param digests: dict of {algorithm: value}
+        :param local_file: Path of cache file
+        :return: None
+        """
+        if not digests:
+            return
+        db = self.database()
+        db.update_entry(self.cache_key(),**digests)
+        if not self.dedup:
+            return
+        local_file = Path(local_file).absolute()
+        for algorithm,value in digests.items():
+            existing = self.indexed_file(f'{algorithm}:{value}')
+            if existing and (existing != str(local_file)) and \
+                    self.link_file(existing,local_file):
+                self.msg(f'{self.path} has the same content as {existing}: linked')
+                return
+        stamp = file_stamp(local_file)
+        if stamp is None:
+            return
+        for algorithm,value in digests.items():
+            db.set(f'{algorithm}:{value}',{'path':str(local_file),'size':stamp[0],'mtime':stamp[1]})
+
+    def indexed_file(self,key):
+        """
+        The cache file in the dedup index entry key ('<algorithm>:<value>',
+        see record_checksums()), if it has not been replaced or removed
+        since it was indexed. A stale entry is dropped.
+
+        :param key: str: index key
+        :return: str OR None
+        """
+        db = self.database()
+        index = db.entry(key)
+        if 'path' not in index:
             return None
-        if r.status_code == 200:
-            self.msg(f'status code good for {self.path}')
-            return (ftype == 'binary' and r.content) or r.text
-        self.msg(f'status code poor for {self.path}: problem logging in or other access')
+        if file_stamp(index['path']) == (index.get('size'),index.get('mtime')):
+            return index['path']
+        self.msg(f'{index["path"]} has changed since it was indexed as {key}')
+        db.delete(key)
         return None
 
-    def read(self,cachedir=None,ftype='binary',skipper=False):
+    def forget_checksums(self,local_file):
+        """
+        Before the cache file of this URL is replaced: forget the
+        checksums recorded for it, and any dedup index entries
+        pointing to it (see record_checksums())
+
+        :param local_file: Path of cache file
+        :return: None
+        """
+        db = self.database()
+        entry = db.entry(self.cache_key())
+        drop_index(db,entry,local_file)
+        old = {k:None for k in entry if k in checksum.ALGORITHMS}
+        if old:
+            db.update_entry(self.cache_key(),**old)
+
+    def link_file(self,existing,local_file):
+        """
+        Replace local_file by a hard link to existing (if it exists
+        and has the same size, when local_file exists)
+
+        :param existing: str: file to link to
+        :param local_file: Path
+        :return: True if linked
+        """
+        existing = Path(existing)
+        try:
+            if local_file.exists() and \
+                    (existing.stat().st_size != local_file.stat().st_size):
+                return False
+            if local_file.exists() and existing.samefile(local_file):
+                return True
+            local_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = local_file.with_name(f'.{local_file.name}.link')
+            tmp.unlink(missing_ok=True)
+            os.link(existing,tmp)
+            os.replace(tmp,local_file)
+            manifest_add(local_file)
+        except OSError:
+            # e.g. missing, or on another file system
+            return False
+        return True
+
+    @tracing.traced('link duplicate',describe)
+    def link_duplicate(self,expected,local_file):
+        """
+        If content with the expected checksum is already in the
+        cache, hard link it as local_file instead of downloading
+
+        :param expected: (algorithm, value) OR None
+        :param local_file: Path of cache file
+        :return: True if linked
+        """
+        if not (expected and self.dedup):
+            return False
+        existing = self.indexed_file(f'{expected[0]}:{expected[1]}')
+        if not existing:
+            return False
+        if Path(local_file).exists():
+            self.forget_checksums(local_file)
+        if self.link_file(existing,Path(local_file).absolute()):
+            self.msg(f'{self.path} already cached as {existing}: linked')
+            self.database().update_entry(self.cache_key(),**{expected[0]:expected[1]})
+            self.cache_manager().record(self.cache_key(),local_file)
+            return True
+        return False
+
+    def output(self,local_file,ftype='binary',output='data'):
+        """
+        Return local_file in the form requested by output
+
+        :param local_file: Path local file name
+        :param ftype: str: file type ('text' or 'binary')
+        :param output: str: 'data' for bytes/str,
+                            'path' for Path to local_file,
+                            'file' for an open file handle
+
+        :return: data, Path or file object
+        """
+        if output == 'path':
+            return local_file
+        if output == 'file':
+            return open(local_file,(ftype == 'binary' and 'rb') or 'r')
+        return (ftype == 'binary' and local_file.read_bytes()) or \
+            local_file.read_text()
+
+    @tracing.traced('read',describe)
+    def read(self,cachedir=None,ftype='binary',skipper=False,stream=None,output='data',
+             checksum=None):
         """
         Open the URL data in bytes mode, read it and return the data
 
@@ -215,28 +1497,140 @@ class URL(urlpath.URL):
         You should specify any required login/password with
         with_components(username=str,password=str)
 
+        With self.refreshcache, a cached file is only downloaded again
+        if the server reports that it has changed since the ETag /
+        Last-Modified recorded in the CacheDatabase.
+
+        A failed read (e.g. 404) is remembered for a time set by
+        self.negative_ttl, and the URL is not tried again until
+        then, unless self.refreshcache is set or purge() is called.
+
+        With stream (or any output other than 'data') the data
+        are written in chunks of self.chunk_size to the cache, so a
+        cache fill never holds the whole file in memory. An interrupted
+        streamed download is resumed with an HTTP Range request
+        next time, if the server supports it. If self.nocache
+        is set, a temporary file is used instead of the cache file.
+
+        A self.hash_name checksum of the data is computed as they
+        arrive and stored in the CacheDatabase. If an expected checksum
+        is given (or published, with self.checksum_sidecar), data that
+        do not match are not cached and None is returned. With
+        self.dedup, content already in the cache under another URL is
+        stored as a hard link to it.
+
         :param cachedir: override self.cachedir
+        :param stream: bool: stream to the cache file (default self.stream)
+        :param output: str: 'data' for bytes/str,
+                            'path' for Path to the local file,
+                            'file' for an open file handle
+        :param checksum: str: expected checksum e.g. 'md5:<hex>'
+                         or a hex digest (algorithm from its length)
 
-        :return: data from url
+        :return: data from url (or Path or file object, see output)
                  OR None                     : on failure
                  OR requests.models.Response : on connection problem
         """
-        local_file = self.local_file()
-        if (not self.nocache) and (not self.refreshcache):
-            if local_file.exists() and local_file.readable():
-                return (ftype == 'binary' and self.local_file.read_bytes()) or \
-                    self.local_file.read_text()
-        # else pull the file and try again
+        if stream is None:
+            stream = self.stream
+        stream = stream or (output != 'data')
+
+        local_file = self.local_file(cachedir)
+        headers = {}
+        if (not self.nocache) and local_file.exists() and self.readable(local_file):
+            if not self.refreshcache:
+                metrics.inc('cache_hits')
+                self.cache_manager().touch(self.cache_key())
+                return self.output(local_file,ftype,output)
+            # only download again if it has changed
+            headers = self.validators()
+        status = self.negative()
+        if status is not None:
+            metrics.inc('negative_hits')
+            self.msg(f'{self.path} recently failed ({status}): not trying again')
+            return None
+        metrics.inc('cache_misses')
+        if self.nocache:
+            return self.download(local_file,ftype,skipper,stream,output,checksum,headers)
+        # else pull the file, one process or thread at a time
+        with self.partial_lock(local_file) as lock:
+            if lock.waited and (not headers) and local_file.exists():
+                self.msg(f'{self.path} was downloaded while waiting for {lock.path}')
+                return self.output(local_file,ftype,output)
+            return self.download(local_file,ftype,skipper,stream,output,checksum,headers)
+
+    def download(self,local_file,ftype='binary',skipper=False,stream=False,output='data',
+                 checksum=None,headers=None):
+        """
+        Download the URL to local_file, for read() after it has
+        checked the cache (see read() for the arguments). Unless
+        self.nocache is set, call this holding partial_lock().
+
+        :param local_file: Path local file name for storage
+        :param headers: dict: request headers, e.g. from validators()
+
+        :return: data from url (or Path or file object, see output)
+                 OR None on failure
+        """
+        headers = dict(headers or {})
+        expected = self.expected_checksum(checksum)
         if not self.nocache:
-            local_file.parent.mkdir(parents=True, exist_ok=True)
-        data = self.pull_file(local_file,ftype='binary',skipper=skipper)
-        if (data != None) and (not self.nocache):
-            # write to local file
-            (ftype == 'binary' and local_file.write_bytes(data)) or \
-            local_file.write_text()
+            with tracing.span('mkdir',path=str(local_file.parent)):
+                local_file.parent.mkdir(parents=True, exist_ok=True)
+            if (not headers) and self.link_duplicate(expected,local_file):
+                return self.output(local_file,ftype,output)
+        elif stream:
+            # stream to a temporary file outside the cache
+            fd,tmp = tempfile.mkstemp(suffix=f'.{local_file.name}')
+            os.close(fd)
+            local_file = Path(tmp)
+        if stream and not self.nocache:
+            headers.update(self.resume_headers(local_file))
+        data = self.pull_file(local_file,ftype=ftype,skipper=skipper,
+                              stream=stream,headers=headers,expected=expected)
+        if (data is None) and ('Range' in headers) and \
+                (getattr(self.r,'status_code',None) == 416):
+            # the partial file is no use: start again
+            self.discard_partial(local_file)
+            del headers['Range'],headers['If-Range']
+            data = self.pull_file(local_file,ftype=ftype,skipper=skipper,
+                                  stream=stream,headers=headers,expected=expected)
+        if stream:
+            self.record_download(self.r,data)
+            if data is None:
+                if self.nocache:
+                    local_file.unlink(missing_ok=True)
+                return None
+            result = self.output(local_file,ftype,output)
+            if self.nocache and output != 'path':
+                # open handles and data outlive the unlink
+                local_file.unlink()
+            return result
+        if (data is not None) and (self.r.status_code == 200):
+            hashers = self.new_hashers(expected)
+            for h in hashers.values():
+                h.update(self.r.content)
+            digests = {k:h.hexdigest() for k,h in hashers.items()}
+            if not self.verify_checksum(digests,expected):
+                return None
+            if not self.nocache:
+                # write to local file
+                self.cache_manager().make_room(len(data),keep=self.cache_key())
+                with tracing.span('cache write',path=str(local_file),bytes=len(data)):
+                    # replace, not overwrite: the old file may be mapped (read_buffer())
+                    part = self.partial_file(local_file)
+                    if ftype == 'binary':
+                        part.write_bytes(data)
+                    else:
+                        part.write_text(data)
+                    self.forget_checksums(local_file)
+                    os.replace(part,local_file)
+                    manifest_add(local_file)
+                self.record_checksums(digests,local_file)
+        self.record_download(self.r,(data is not None) and local_file or None)
         return data
 
-    def read_bytes(self,cachedir=None,skipper=False):
+    def read_bytes(self,cachedir=None,skipper=False,stream=None,output='data',checksum=None):
         """
         Open the URL data in text mode, read it and return the data
 
@@ -248,14 +1642,18 @@ class URL(urlpath.URL):
         with_components(username=str,password=str)
 
         :param cachedir: override self.cachedir
+        :param stream: bool: stream to the cache file (default self.stream)
+        :param output: str: 'data', 'path' or 'file' (see read())
+        :param checksum: str: expected checksum (see read())
 
         :return: data from url
                  OR None                     : on failure
                  OR requests.models.Response : on connection problem
         """
-        return self.read(cachedir=cachedir,ftype='binary',skipper=skipper)
+        return self.read(cachedir=cachedir,ftype='binary',skipper=skipper,
+                         stream=stream,output=output,checksum=checksum)
 
-    def read_text(self,cachedir=None,skipper=False):
+    def read_text(self,cachedir=None,skipper=False,stream=None,output='data',checksum=None):
         """
         Open the URL data in text mode, read it and return the data
 
@@ -267,12 +1665,199 @@ class URL(urlpath.URL):
         with_components(username=str,password=str)
 
         :param cachedir: override self.cachedir
+        :param stream: bool: stream to the cache file (default self.stream)
+        :param output: str: 'data', 'path' or 'file' (see read())
+        :param checksum: str: expected checksum (see read())
 
         :return: data from url
                  OR None                     : on failure
                  OR requests.models.Response : on connection problem
         """
-        return self.read(cachedir=cachedir,ftype='text',skipper=skipper)
+        return self.read(cachedir=cachedir,ftype='text',skipper=skipper,
+                         stream=stream,output=output,checksum=checksum)
+
+    def read_buffer(self,cachedir=None,skipper=False,checksum=None):
+        """
+        The URL data as a read-only memoryview of the cache file,
+        memory-mapped rather than read, so the data are not copied
+        and only the pages used are loaded (and shared between
+        processes mapping the same file).
+
+        The file is fetched into the cache first if needed (see read()).
+        The mapping stays valid while the memoryview (or anything made
+        from it) is in use, even if the cache file is replaced or removed.
+
+        :param cachedir: override self.cachedir
+        :param checksum: str: expected checksum (see read())
+
+        :return: memoryview OR None on failure
+        """
+        local_file = self.read(cachedir=cachedir,skipper=skipper,output='path',checksum=checksum)
+        if local_file is None:
+            return None
+        try:
+            with open(local_file,'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    # an empty file cannot be mapped
+                    return memoryview(b'')
+                return memoryview(mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ))
+        finally:
+            if self.nocache:
+                # a temporary file: the mapping outlives it
+                Path(local_file).unlink(missing_ok=True)
+
+    def read_array(self,dtype='uint8',shape=None,offset=0,order='C',
+                   cachedir=None,skipper=False,checksum=None):
+        """
+        The URL data as a read-only numpy array over the
+        memory-mapped cache file (see read_buffer()), e.g. for
+        a raw raster of known shape
+
+        :param dtype: numpy dtype of the data
+        :param shape: int or tuple: shape of the array
+                      (default 1-d, to the end of the file)
+        :param offset: int: bytes to skip (e.g. a header)
+        :param order: str: 'C' (row-major) or 'F' (column-major)
+        :param cachedir: override self.cachedir
+        :param checksum: str: expected checksum (see read())
+
+        :return: numpy.ndarray OR None on failure
+        """
+        import numpy as np
+        buffer = self.read_buffer(cachedir=cachedir,skipper=skipper,checksum=checksum)
+        if buffer is None:
+            return None
+        count = -1
+        if shape is not None:
+            shape = (isinstance(shape,int) and (shape,)) or tuple(shape)
+            count = int(np.prod(shape))
+        array = np.frombuffer(buffer,dtype=dtype,count=count,offset=offset)
+        if shape is None:
+            return array
+        return array.reshape(shape,order=order)
+
+    def open(self,mode='rb',block_size=None,cache_blocks=32,persist=False,
+             cachedir=None,skipper=False):
+        """
+        Open the URL data as a seekable, read-only binary file object
+
+        If the file is already in the cache, the local file is opened.
+        Otherwise reads are served by HTTP Range requests of block_size
+        bytes, with the most recent cache_blocks blocks held in memory,
+        so only the parts of the file that are read get downloaded.
+        If the server does not support ranges, the whole file is
+        downloaded to the cache first.
+
+        :param mode: str: must be 'rb'
+        :param block_size: int: bytes per Range request
+                           (default self.chunk_size)
+        :param cache_blocks: int: number of blocks held in memory
+        :param persist: bool: also store fetched blocks in a sparse
+                        file in the cache (see remotefile.RemoteFile)
+        :param cachedir: override self.cachedir
+        :param skipper: bool: skip the simple get() and log in straight away
+
+        :return: file object OR None on failure
+        """
+        if mode != 'rb':
+            raise ValueError(f"URL.open() only supports mode 'rb', not {mode!r}")
+        local_file = self.local_file(cachedir)
+        if (not self.nocache) and (not self.refreshcache):
+            if local_file.exists() and self.readable(local_file):
+                return open(local_file,'rb')
+        f = RemoteFile(self,block_size=block_size or self.chunk_size,
+                       cache_blocks=cache_blocks,persist=persist and not self.nocache,
+                       cachedir=cachedir,skipper=skipper)
+        if f.size is None:
+            self.msg(f'no range support for {self.path}: downloading the whole file')
+            f.close()
+            return self.read(cachedir=cachedir,skipper=skipper,output='file')
+        return f
+
+    async def aread(self,cachedir=None,ftype='binary',skipper=False,output='data',
+                    checksum=None):
+        """
+        Awaitable version of read(), using aiohttp
+
+        Uses the same cache file and 2-pass login as read().
+        Downloads are always streamed to the cache. Call aclose()
+        when done:
+
+            async def main():
+                url = URL('https://e4ftl01.cr.usgs.gov/MOTA/MCD15A3H.006/2003.12.11/' +
+                          'MCD15A3H.A2003345.h09v06.006.2015084002115.hdf')
+                try:
+                    return await url.aread_bytes()
+                finally:
+                    await url.aclose()
+
+            data = asyncio.run(main())
+
+        :param cachedir: override self.cachedir
+        :param ftype: str: file type ('text' or 'binary')
+        :param output: str: 'data', 'path' or 'file' (see read())
+        :param checksum: str: expected checksum (see read())
+
+        :return: data from url (or Path or file object, see output)
+                 OR None                     : on failure
+        """
+        return await lazy_import('aio').read(self,cachedir=cachedir,ftype=ftype,
+                                             skipper=skipper,output=output,checksum=checksum)
+
+    async def aclose(self):
+        """
+        Close the aiohttp session shared by the awaitable methods
+        (aread() etc.) in the running event loop. Call this before
+        the loop ends, e.g. at the end of the coroutine given to
+        asyncio.run(), to avoid 'Unclosed client session' warnings.
+        A later awaitable call opens a new session.
+
+        :return: None
+        """
+        await lazy_import('aio').close_session()
+
+    async def alistdir(self):
+        """
+        Awaitable version of listdir()
+
+        :return: list of str names (empty on failure)
+        """
+        return await lazy_import('aio').listdir(self)
+
+    async def aglob(self,pattern,pre_filter=True):
+        """
+        Awaitable version of glob(). The directories at each
+        level are listed concurrently.
+
+        :return: list of URL
+        """
+        return await lazy_import('aio').glob(self,pattern,pre_filter=pre_filter)
+
+    async def aread_bytes(self,cachedir=None,skipper=False,output='data',checksum=None):
+        """
+        Awaitable version of read_bytes()
+
+        :param cachedir: override self.cachedir
+        :param output: str: 'data', 'path' or 'file' (see read())
+        :param checksum: str: expected checksum (see read())
+
+        :return: data from url OR None on failure
+        """
+        return await self.aread(cachedir=cachedir,ftype='binary',
+                                skipper=skipper,output=output,checksum=checksum)
+
+    async def aread_text(self,cachedir=None,skipper=False,output='data',checksum=None):
+        """
+        Awaitable version of read_text()
+
+        :param cachedir: override self.cachedir
+        :param output: str: 'data', 'path' or 'file' (see read())
+        :param checksum: str: expected checksum (see read())
+
+        :return: data from url OR None on failure
+        """
+        return await self.aread(cachedir=cachedir,ftype='text',
+                                skipper=skipper,output=output,checksum=checksum)
 
 def main():
     u='https://e4ftl01.cr.usgs.gov/MOTA/MCD15A3H.006/2003.12.11/MCD15A3H.A2003345.h09v06.006.2015084002115.hdf'
@@ -296,8 +1881,8 @@ def xx():
     rlist = url.glob('MOT*/MCD15A3H.006/2003.12.11/*0.hdf',pre_filter=True)
     for i,r in enumerate(rlist):
       print(i)
-      # we can save in decalring a new URL by passing old one
-      u = URL(r,**(fdict(url.__dict__.copy())))
+      # URLs from glob() share the settings of url
+      u = url.derive(r)
       data=u.read_bytes()
       # updata database
       u.flush()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+process-wide metrics for gurlpath, and bounded message storage
+
+Counters and latency histograms are kept in one registry per
+process (registry), labelled e.g. by host and HTTP status:
+
+    counters:
+        requests         host, status      HTTP responses received
+        request_errors   host, error       requests that raised
+        retries          host, status      requests retried (see RetryPolicy)
+        login_fallbacks  host              plain get() refused: login tried
+        cache_hits                         reads served from the cache
+        cache_misses                       reads that needed the network
+        negative_hits                      reads answered by the negative cache
+        bytes_downloaded host              bytes of data received
+    histograms (seconds):
+        request_seconds  host              time to response headers
+
+    from gurlpath import metrics
+    metrics.snapshot()            # dict
+    metrics.export('prometheus')  # str
+'''
+
+__author__    = "P. Lewis"
+__email__     = "p.lewis@ucl.ac.uk"
+__date__      = "28 Aug 2020"
+__copyright__ = "Copyright 2020-2022 P. Lewis"
+__license__   = "MIT License"
+
+import json
+import bisect
+import threading
+import collections
+
+# upper bounds (s) of the latency histogram buckets
+BUCKETS = (0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,float('inf'))
+
+
+class MessageLog():
+    '''
+    The most recent maxlen distinct messages, in order.
+    add() is O(1), so repeated messages cost a dict lookup.
+    '''
+    def __init__(self,maxlen=1000):
+        """
+        :param maxlen: int: number of messages kept
+        """
+        self.maxlen = maxlen
+        self.messages = collections.OrderedDict()
+
+    def add(self,msg):
+        """
+        Add msg, if it is not already held
+
+        :param msg: str
+        :return: True if msg is new
+        """
+        if msg in self.messages:
+            return False
+        self.messages[msg] = None
+        if len(self.messages) > self.maxlen:
+            self.messages.popitem(last=False)
+        return True
+
+    def __contains__(self,msg):
+        return msg in self.messages
+
+    def __iter__(self):
+        return iter(list(self.messages))
+
+    def __len__(self):
+        return len(self.messages)
+
+    def __repr__(self):
+        return repr(list(self.messages))
+
+
+class Histogram():
+    '''
+    Counts of observations in the buckets of BUCKETS
+    '''
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self,value):
+        self.counts[bisect.bisect_left(BUCKETS,value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        """
+        :return: dict of count, sum and cumulative bucket counts {le: n}
+        """
+        buckets,n = {},0
+        for le,c in zip(BUCKETS,self.counts):
+            n += c
+            buckets[str(le)] = n
+        return {'count':self.count,'sum':self.sum,'buckets':buckets}
+
+
+class Metrics():
+    '''
+    Thread-safe registry of labelled counters and histograms
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Clear all metrics
+
+        :return: None
+        """
+        with self.lock:
+            # {name: {labels: value}}, labels a sorted tuple of (key, value)
+            self.counters = collections.defaultdict(dict)
+            self.histograms = collections.defaultdict(dict)
+
+    def inc(self,name,value=1,**labels):
+        """
+        Add value to counter name
+
+        :param name: str: counter name
+        :param value: number to add
+        :param labels: labels e.g. host='https://e4ftl01.cr.usgs.gov'
+        :return: None
+        """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counter = self.counters[name]
+            counter[key] = counter.get(key,0) + value
+
+    def observe(self,name,value,**labels):
+        """
+        Record value in histogram name
+
+        :param name: str: histogram name
+        :param value: float: e.g. seconds
+        :param labels: labels
+        :return: None
+        """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            histogram = self.histograms[name].get(key)
+            if histogram is None:
+                histogram = self.histograms[name][key] = Histogram()
+            histogram.observe(value)
+
+    def value(self,name,**labels):
+        """
+        Current value of counter name, summed over any labels not given
+
+        :param name: str: counter name
+        :param labels: labels to match
+        :return: number
+        """
+        with self.lock:
+            return sum(v for k,v in self.counters.get(name,{}).items()
+                       if set(labels.items()) <= set(k))
+
+    def snapshot(self):
+        """
+        Copy of all metrics
+
+        :return: dict {'counters': {name: [{'labels':{}, 'value':n}]},
+                       'histograms': {name: [{'labels':{}, 'count':n,
+                                              'sum':s, 'buckets':{le:n}}]}}
+        """
+        with self.lock:
+            return {'counters':{name:[{'labels':dict(k),'value':v} for k,v in c.items()]
+                                for name,c in self.counters.items()},
+                    'histograms':{name:[dict(labels=dict(k),**h.snapshot()) for k,h in hs.items()]
+                                  for name,hs in self.histograms.items()}}
+
+    def export(self,format='json'):
+        """
+        All metrics as text
+
+        :param format: str: 'json' or 'prometheus' (text exposition format)
+        :return: str
+        """
+        snap = self.snapshot()
+        if format == 'json':
+            return json.dumps(snap,indent=1)
+        if format != 'prometheus':
+            raise ValueError(f'unknown metrics format {format!r}')
+
+        def labels(d,**extra):
+            d = dict(d,**extra)
+            return d and ('{' + ','.join(f'{k}="{v}"' for k,v in d.items()) + '}') or ''
+
+        lines = []
+        for name,items in snap['counters'].items():
+            lines.append(f'# TYPE gurlpath_{name} counter')
+            lines += [f"gurlpath_{name}{labels(i['labels'])} {i['value']}" for i in items]
+        for name,items in snap['histograms'].items():
+            lines.append(f'# TYPE gurlpath_{name} histogram')
+            for i in items:
+                lines += [f"gurlpath_{name}_bucket{labels(i['labels'],le=le.replace('inf','+Inf'))} {n}"
+                          for le,n in i['buckets'].items()]
+                lines.append(f"gurlpath_{name}_sum{labels(i['labels'])} {i['sum']}")
+                lines.append(f"gurlpath_{name}_count{labels(i['labels'])} {i['count']}")
+        return '\n'.join(lines) + '\n'
+
+
+# the registry for this process
+registry = Metrics()
+
+
+def inc(name,value=1,**labels):
+    registry.inc(name,value,**labels)
+
+
+def observe(name,value,**labels):
+    registry.observe(name,value,**labels)
+
+
+def snapshot():
+    """
+    Copy of all metrics (see Metrics.snapshot())
+
+    :return: dict
+    """
+    return registry.snapshot()
+
+
+def export(format='json'):
+    """
+    All metrics as text (see Metrics.export())
+
+    :param format: str: 'json' or 'prometheus'
+    :return: str
+    """
+    return registry.export(format)
+
+
+def reset():
+    """
+    Clear all metrics
+
+    :return: None
+    """
+    registry.reset()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+seekable read-only file object for URL data,
+using HTTP Range requests and a block cache
+
+Used by URL.open(), so that readers such as h5py or
+netCDF4 only download the parts of a file they touch.
+'''
+
+__author__    = "P. Lewis"
+__email__     = "p.lewis@ucl.ac.uk"
+__date__      = "28 Aug 2020"
+__copyright__ = "Copyright 2020-2022 P. Lewis"
+__license__   = "MIT License"
+
+import io
+import os
+import collections
+
+try:
+    import gurlpath.metrics as metrics
+except ModuleNotFoundError:
+    import metrics
+
+
+class RemoteFile(io.RawIOBase):
+    '''
+    Seekable file object for a URL
+
+    Data are fetched in blocks of block_size bytes with HTTP
+    Range requests (through URL.get_response(), so logins work
+    as for URL.read()). The most recently used cache_blocks
+    blocks are kept in memory.
+
+    With persist, fetched blocks are also written into a sparse
+    file next to URL.local_file() (local_file with .blocks appended),
+    with a list of the blocks held in local_file.blocks.idx. When
+    every block has been fetched, the sparse file becomes the
+    cache file, as a download by URL.read() would (see commit()).
+    Blocks from an earlier RemoteFile are only used if the file
+    has the same ETag (or Last-Modified) on the server.
+
+    If the server does not support ranges, size is None and
+    the object should not be used.
+    '''
+    def __init__(self,url,block_size=1024*1024,cache_blocks=32,persist=False,
+                 cachedir=None,skipper=False):
+        """
+        :param url: URL
+        :param block_size: int: bytes per Range request
+        :param cache_blocks: int: number of blocks held in memory
+        :param persist: bool: store fetched blocks in a sparse file
+        :param cachedir: override url.cachedir
+        :param skipper: bool: skip the simple get() and log in straight away
+        """
+        super().__init__()
+        self.url = url
+        self.block_size = int(block_size)
+        self.cache_blocks = max(1,int(cache_blocks))
+        self.skipper = skipper
+        self.blocks = collections.OrderedDict()
+        self.pos = 0
+        self.size = None
+        self.etag = None
+        self.last_modified = None
+        # the last response to a Range request
+        self.response = None
+        self.sparse = None
+        self.persisted = set()
+        self.local_file = url.local_file(cachedir)
+
+        # the first block tells us the size, and if ranges work
+        data = self.fetch_block(0)
+        if data is None:
+            return
+        if persist:
+            self.open_sparse()
+            self.store_block(0,data)
+
+    @property
+    def name(self):
+        return str(self.url)
+
+    @property
+    def nblocks(self):
+        return (self.size + self.block_size - 1) // self.block_size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self,offset,whence=io.SEEK_SET):
+        """
+        Move to offset, relative to whence (as for io.IOBase.seek())
+
+        :return: int: new position
+        """
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f'invalid whence {whence}')
+        if pos < 0:
+            raise ValueError(f'negative seek position {pos}')
+        self.pos = pos
+        return self.pos
+
+    def readinto(self,b):
+        """
+        Read into bytearray / memoryview b from the current position
+
+        :return: int: number of bytes read
+        """
+        view = memoryview(b).cast('B')
+        n = max(0,min(len(view),self.size - self.pos))
+        done = 0
+        while done < n:
+            i,start = divmod(self.pos + done,self.block_size)
+            block = self.block(i)
+            count = min(n - done,len(block) - start)
+            view[done:done+count] = block[start:start+count]
+            done += count
+        self.pos += done
+        return done
+
+    def readall(self):
+        return self.read(max(0,self.size - self.pos))
+
+    def block(self,i):
+        """
+        Get block i from memory, the sparse file or the server
+
+        :param i: int: block number
+        :return: bytes
+        """
+        data = self.blocks.get(i)
+        if data is not None:
+            self.blocks.move_to_end(i)
+            return data
+        if i in self.persisted:
+            self.sparse.seek(i * self.block_size)
+            data = self.sparse.read(min(self.block_size,self.size - i * self.block_size))
+        else:
+            data = self.fetch_block(i)
+            if data is None:
+                raise OSError(f'failed to read block {i} of {self.url}')
+            self.store_block(i,data)
+        self.remember(i,data)
+        return data
+
+    def remember(self,i,data):
+        """
+        Keep block i in the in-memory LRU cache
+
+        :return: None
+        """
+        self.blocks[i] = data
+        self.blocks.move_to_end(i)
+        while len(self.blocks) > self.cache_blocks:
+            self.blocks.popitem(last=False)
+
+    def fetch_block(self,i):
+        """
+        Fetch block i from the server with a Range request.
+        The first call sets self.size and self.etag.
+
+        :param i: int: block number
+        :return: bytes OR None on failure
+        """
+        start = i * self.block_size
+        end = start + self.block_size - 1
+        if self.size is not None:
+            end = min(end,self.size - 1)
+        self.url.msg(f'fetching bytes {start}-{end} of {self.url.path}')
+        r = self.url.get_response(skipper=self.skipper,stream=True,
+                                  headers={'Range':f'bytes={start}-{end}'})
+        if r is None:
+            return None
+        if r.status_code != 206:
+            # no range support (or the file is empty)
+            r.close()
+            return None
+        try:
+            total = r.headers.get('Content-Range','').rsplit('/',1)[-1]
+            etag = r.headers.get('ETag')
+            if self.size is None:
+                self.size = (total.isdigit() and int(total)) or None
+                self.etag = etag
+                self.last_modified = r.headers.get('Last-Modified')
+            elif etag and self.etag and (etag != self.etag):
+                raise OSError(f'{self.url} changed while reading')
+            data = r.content
+            self.response = r
+        finally:
+            r.close()
+        metrics.inc('bytes_downloaded',len(data),host=self.url.host_key())
+        data = data[:end - start + 1]
+        self.remember(i,data)
+        return data
+
+    def sparse_files(self):
+        """
+        :return: (Path of sparse file, Path of its block index)
+        """
+        lf = self.local_file
+        return lf.with_name(lf.name + '.blocks'),lf.with_name(lf.name + '.blocks.idx')
+
+    def open_sparse(self):
+        """
+        Open (or start) the sparse file of persisted blocks.
+        Blocks stored for a different ETag (or Last-Modified, if the
+        server gives no ETag) or block size are dropped, as are any
+        stored with neither.
+
+        :return: None
+        """
+        sparse,index = self.sparse_files()
+        sparse.parent.mkdir(parents=True, exist_ok=True)
+        validator = self.etag or self.last_modified
+        header = f'{validator} {self.block_size} {self.size}'
+        if validator and sparse.exists() and index.exists():
+            lines = index.read_text().splitlines()
+            if lines and lines[0] == header:
+                self.persisted = set(int(i) for i in lines[1:] if i.strip().isdigit())
+        if not self.persisted:
+            self.url.cache_manager().make_room(self.size,keep=self.url.cache_key())
+            index.write_text(header + '\n')
+            with open(sparse,'wb') as f:
+                f.truncate(self.size)
+        self.sparse = open(sparse,'r+b')
+
+    def store_block(self,i,data):
+        """
+        Write block i to the sparse file, if persisting,
+        and move the sparse file into the cache when complete
+        (see commit())
+
+        :return: None
+        """
+        if (self.sparse is None) or (i in self.persisted):
+            return
+        self.sparse.seek(i * self.block_size)
+        self.sparse.write(data)
+        self.sparse.flush()
+        sparse,index = self.sparse_files()
+        with open(index,'a') as f:
+            f.write(f'{i}\n')
+        self.persisted.add(i)
+        if len(self.persisted) == self.nblocks:
+            self.commit()
+
+    def commit(self):
+        """
+        Move the complete sparse file into the cache as local_file,
+        as the partial file of a download (see URL.finish_partial()
+        and URL.record_download()), holding URL.partial_lock()
+
+        :return: Path of local_file OR None on failure
+        """
+        url = self.url
+        sparse,index = self.sparse_files()
+        with url.partial_lock(self.local_file) as lock:
+            if lock.waited and self.local_file.exists():
+                url.msg(f'{self.local_file} was downloaded by another process or thread')
+                sparse.unlink(missing_ok=True)
+                index.unlink(missing_ok=True)
+                return self.local_file
+            url.msg(f'all blocks of {url.path} fetched: moving to {self.local_file}')
+            part = url.partial_file(self.local_file)
+            # the open self.sparse still reads the same file
+            os.replace(sparse,part)
+            index.unlink(missing_ok=True)
+            expected = url.expected_checksum()
+            hashers = url.hash_file(part,url.new_hashers(expected))
+            local_file = url.finish_partial(self.local_file,self.response.status_code,
+                                            self.response.headers,hashers,expected)
+            url.record_download(self.response,local_file)
+            return local_file
+
+    def close(self):
+        if self.sparse is not None:
+            self.sparse.close()
+            self.sparse = None
+        self.blocks.clear()
+        super().close()
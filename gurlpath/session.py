@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+process-wide registry of requests.Session objects
+
+One session is kept per scheme+host, so that all URL
+instances (and threads) talking to the same server share
+a keep-alive connection pool, and any cookies set during
+login.
+
+The cookies of a session can also be saved, encrypted with
+the Cylog key, in ~/.cylog/cookies, so that other processes
+can reuse a login until its cookies expire.
+
+Requests to a host can be rate limited by a TokenBucket,
+shared by all URL instances and threads in the process, and
+retried according to a RetryPolicy when the server is busy.
+'''
+
+__author__    = "P. Lewis"
+__email__     = "p.lewis@ucl.ac.uk"
+__date__      = "28 Aug 2020"
+__copyright__ = "Copyright 2020-2022 P. Lewis"
+__license__   = "MIT License"
+
+import os
+import json
+import time
+import random
+import threading
+import email.utils
+import tempfile
+import urllib.parse
+from pathlib import Path
+import requests
+from requests.adapters import HTTPAdapter
+
+# default number of connections kept alive per host
+POOL_SIZE = 10
+# lifetime (s) of saved cookies that have no expiry time
+COOKIE_TTL = 86400
+
+_sessions = {}
+_lock = threading.Lock()
+# one TokenBucket per scheme+host, see get_bucket()
+_buckets = {}
+# cookies last saved or loaded per scheme+host, see save_cookies()
+_saved = {}
+
+
+def session_key(url):
+    """
+    Key used for the session registry: (scheme, host)
+
+    :param url: str or URL
+    :return: tuple (scheme, netloc)
+    """
+    parts = urllib.parse.urlsplit(str(url))
+    # drop any user:password@ from the netloc
+    return parts.scheme.lower(), parts.netloc.rsplit('@',1)[-1].lower()
+
+
+def get_session(url, pool_size=None, persist_cookies=False):
+    """
+    Get the shared session for the scheme+host of url,
+    creating it if needed.
+
+    :param url: str or URL
+    :param pool_size: int: connections kept alive for this host
+                      (only used when the session is created).
+                      default POOL_SIZE
+    :param persist_cookies: bool: load any saved cookies for this
+                      host into a new session (see save_cookies())
+    :return: requests.Session
+    """
+    key = session_key(url)
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+    with _lock:
+        session = _sessions.get(key)
+        if session is None:
+            pool_size = pool_size or POOL_SIZE
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            if persist_cookies:
+                load_cookies(session,url)
+            _sessions[key] = session
+    return session
+
+
+def set_pool_size(pool_size):
+    """
+    Set the default pool size for sessions created from now on
+
+    :param pool_size: int: connections kept alive per host
+    :return: None
+    """
+    global POOL_SIZE
+    POOL_SIZE = int(pool_size)
+
+
+def close_sessions():
+    """
+    Close and forget all shared sessions
+
+    :return: None
+    """
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        _saved.clear()
+
+
+def cookie_file(url,destination_folder='.cylog'):
+    """
+    File for the saved cookies of the scheme+host of url
+
+    :param url: str or URL
+    :param destination_folder: str: Cylog folder, relative to ${HOME}
+    :return: Path
+    """
+    scheme,netloc = session_key(url)
+    name = urllib.parse.quote(f'{scheme}_{netloc}',safe='')
+    return Path.home().joinpath(destination_folder,'cookies',f'{name}.cookies')
+
+
+def cipher(destination_folder='.cylog'):
+    """
+    Fernet cipher using the Cylog key
+
+    :return: cryptography.fernet.Fernet
+    """
+    # imported here: only needed when cookies are saved
+    from cryptography.fernet import Fernet
+    try:
+        from gurlpath.cylog import cylog_key
+    except ModuleNotFoundError:
+        from cylog import cylog_key
+    return Fernet(cylog_key(destination_folder))
+
+
+def cookie_state(session,now=None):
+    """
+    The unexpired cookies of session, to tell if they have changed
+
+    :param session: requests.Session
+    :param now: float: time.time()
+    :return: frozenset of (name, value, domain, path, expires)
+    """
+    now = now or time.time()
+    return frozenset((c.name,c.value,c.domain,c.path,c.expires) for c in session.cookies
+                     if (c.expires is None) or (c.expires > now))
+
+
+def save_cookies(session,url,destination_folder='.cylog'):
+    """
+    Save the unexpired cookies of session, encrypted,
+    for the scheme+host of url, if they have changed
+    since they were last saved or loaded
+
+    Cookies without an expiry time (session cookies)
+    are given one of COOKIE_TTL seconds from now.
+
+    :param session: requests.Session
+    :param url: str or URL
+    :param destination_folder: str: Cylog folder, relative to ${HOME}
+    :return: Path of cookie file OR None if nothing saved
+    """
+    now = time.time()
+    state = cookie_state(session,now)
+    key = session_key(url)
+    if (not state) or (_saved.get(key) == state):
+        return None
+    cookies = [{'name':c.name,'value':c.value,'domain':c.domain,'path':c.path,
+                'secure':c.secure,'expires':c.expires or int(now + COOKIE_TTL),
+                'rest':{'HttpOnly':c.get_nonstandard_attr('HttpOnly')}}
+               for c in session.cookies if (c.expires is None) or (c.expires > now)]
+    f = cookie_file(url,destination_folder)
+    f.parent.mkdir(parents=True, exist_ok=True)
+    f.parent.chmod(0o700)
+    data = cipher(destination_folder).encrypt(json.dumps(cookies).encode())
+    fd,tmp = tempfile.mkstemp(dir=f.parent,prefix=f'.{f.name}.')
+    with os.fdopen(fd,'wb') as fp:
+        fp.write(data)
+    os.chmod(tmp,0o600)
+    os.replace(tmp,f)
+    _saved[key] = state
+    return f
+
+
+def load_cookies(session,url,destination_folder='.cylog'):
+    """
+    Load the unexpired saved cookies for the scheme+host
+    of url into session
+
+    :param session: requests.Session
+    :param url: str or URL
+    :param destination_folder: str: Cylog folder, relative to ${HOME}
+    :return: int: number of cookies loaded
+    """
+    f = cookie_file(url,destination_folder)
+    if not f.exists():
+        return 0
+    from cryptography.fernet import InvalidToken
+    # a cookie file that cannot be read is ignored: we just log in again
+    try:
+        cookies = json.loads(cipher(destination_folder).decrypt(f.read_bytes()))
+    except (OSError,ValueError,InvalidToken):
+        return 0
+    now = time.time()
+    n = 0
+    for c in cookies:
+        if (c['expires'] is not None) and (c['expires'] <= now):
+            continue
+        session.cookies.set_cookie(requests.cookies.create_cookie(**c))
+        n += 1
+    _saved[session_key(url)] = cookie_state(session,now)
+    return n
+
+
+def forget_cookies(url,destination_folder='.cylog'):
+    """
+    Delete the saved cookies for the scheme+host of url,
+    and those in its shared session
+
+    :param url: str or URL
+    :param destination_folder: str: Cylog folder, relative to ${HOME}
+    :return: None
+    """
+    cookie_file(url,destination_folder).unlink(missing_ok=True)
+    _saved.pop(session_key(url),None)
+    session = _sessions.get(session_key(url))
+    if session is not None:
+        session.cookies.clear()
+
+
+class TokenBucket():
+    '''
+    Token bucket rate limiter, safe to share between threads
+
+    Tokens are added at rate per second, up to burst. Each
+    request takes one, waiting until one is available, so
+    requests run steadily at rate (after an initial burst).
+    With rate None, requests are not limited, but pause()
+    still holds them back.
+    '''
+    def __init__(self,rate=None,burst=1):
+        """
+        :param rate: float: requests per second (None: no limit)
+        :param burst: int: requests that can be made at once
+        """
+        self.rate = rate
+        self.burst = max(1,burst)
+        self.lock = threading.Lock()
+        self.tokens = float(self.burst)
+        self.last = time.monotonic()
+        # no requests before this time (see pause())
+        self.resume = 0.
+
+    def reserve(self):
+        """
+        Take a token, and report how long to wait before using it
+
+        :return: float: seconds to wait (0 if none)
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = max(0.,self.resume - now)
+            if not self.rate:
+                return wait
+            self.tokens = min(self.burst,self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            if self.tokens < 0:
+                wait = max(wait,-self.tokens / self.rate)
+            return wait
+
+    def wait(self):
+        """
+        Take a token, sleeping until it can be used
+
+        :return: float: seconds waited
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def pause(self,seconds):
+        """
+        Hold back all requests for seconds from now
+        (e.g. when the server asks us to back off)
+
+        :param seconds: float
+        :return: None
+        """
+        with self.lock:
+            self.resume = max(self.resume,time.monotonic() + seconds)
+
+
+def get_bucket(url,rate=None,burst=1):
+    """
+    Get the shared TokenBucket for the scheme+host of url,
+    creating it if needed. A rate that is given replaces
+    the current one.
+
+    :param url: str or URL
+    :param rate: float: requests per second
+    :param burst: int: requests that can be made at once
+    :return: TokenBucket
+    """
+    key = session_key(url)
+    with _lock:
+        bucket = _buckets.get(key)
+        if bucket is None:
+            bucket = _buckets[key] = TokenBucket(rate,burst)
+    if rate is not None:
+        bucket.rate = rate
+    return bucket
+
+
+class RetryPolicy():
+    '''
+    When and how long to wait before retrying a request
+
+    Requests that fail to connect or time out, or get one of
+    the statuses, are retried up to retries times. The wait is
+    the server's Retry-After, if given, else exponential
+    backoff with full jitter: a random time between 0 and
+    backoff * 2**attempt, at most max_backoff seconds.
+    '''
+    def __init__(self,retries=3,backoff=1.0,max_backoff=60,
+                 statuses=(429,502,503,504)):
+        """
+        :param retries: int: maximum number of retries
+        :param backoff: float: base wait in seconds
+        :param max_backoff: float: longest wait in seconds
+        :param statuses: HTTP statuses to retry
+        """
+        self.retries = retries or 0
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.statuses = tuple(statuses)
+
+    def retry(self,attempt,status=None):
+        """
+        :param attempt: int: number of retries so far
+        :param status: int HTTP status (None: connection failure)
+        :return: True if the request should be retried
+        """
+        return (attempt < self.retries) and ((status is None) or (status in self.statuses))
+
+    def delay(self,attempt,headers=None):
+        """
+        Seconds to wait before retry attempt+1
+
+        :param attempt: int: number of retries so far
+        :param headers: response headers, for Retry-After
+        :return: float
+        """
+        after = retry_after((headers or {}).get('Retry-After'))
+        if after is not None:
+            return min(after,self.max_backoff)
+        return random.uniform(0,min(self.max_backoff,self.backoff * 2 ** attempt))
+
+
+def retry_after(value):
+    """
+    Parse a Retry-After header: seconds or an HTTP date
+
+    :param value: str OR None
+    :return: float seconds from now OR None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError,ValueError):
+        return None
+    return max(0.,when.timestamp() - time.time())
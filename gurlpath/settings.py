@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+immutable keyword settings (cachedir etc.) shared by URLs
+
+A URL holds a reference to a Settings object rather than its
+own copy of every setting, and URLs derived from it (derive(),
+glob(), /, joinpath(), parent ...) share the same object, so
+per-URL state is just the parsed URL.
+
+    s = DEFAULTS.replace(cachedir='work',verbose=True)
+    s.cachedir          # 'work'
+    s['verbose']        # True
+
+replace() with the same (hashable) settings on the same Settings
+returns the same object while it is in use.
+'''
+
+__author__    = "P. Lewis"
+__email__     = "p.lewis@ucl.ac.uk"
+__date__      = "28 Aug 2020"
+__copyright__ = "Copyright 2020-2022 P. Lewis"
+__license__   = "MIT License"
+
+import weakref
+import threading
+import collections.abc
+
+# Settings from replace(), while in use
+# {(id(base), ((name, value), ...)): Settings}
+_interned = weakref.WeakValueDictionary()
+_lock = threading.Lock()
+
+
+def same(a,b):
+    '''True if setting values a and b are the same'''
+    try:
+        return (a is b) or bool(a == b)
+    except (TypeError,ValueError):
+        return False
+
+
+class Settings(collections.abc.Mapping):
+    '''
+    Immutable mapping of settings, also readable as attributes.
+    Values are not copied, so do not change those that are
+    mutable (e.g. dicts): use replace().
+    '''
+    __slots__ = ('_data','_base','__weakref__')
+
+    def __init__(self,data=None,**kwargs):
+        """
+        :param data: dict or Settings: initial settings
+        :param kwargs: settings, overriding data
+        """
+        object.__setattr__(self,'_data',dict(data or {},**kwargs))
+        object.__setattr__(self,'_base',None)
+
+    def __getattr__(self,name):
+        try:
+            return self._data[name]
+        except KeyError:
+            raise AttributeError(f'no setting {name!r}') from None
+
+    def __setattr__(self,name,value):
+        raise AttributeError(f'Settings are immutable: use replace({name}=...)')
+
+    def __getitem__(self,name):
+        return self._data[name]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return 'Settings(' + ', '.join(f'{k}={v!r}' for k,v in self._data.items()) + ')'
+
+    def __reduce__(self):
+        return (Settings,(self._data,))
+
+    def replace(self,**kwargs):
+        """
+        These settings with kwargs changed
+
+        :param kwargs: settings to change or add
+        :return: Settings (self if nothing changes)
+        """
+        data = self._data
+        kwargs = {k:v for k,v in kwargs.items() if (k not in data) or not same(data[k],v)}
+        if not kwargs:
+            return self
+        try:
+            key = (id(self),tuple(sorted(kwargs.items(),key=lambda kv: kv[0])))
+            hash(key)
+        except TypeError:
+            # e.g. a dict value: not shared
+            key = None
+        with _lock:
+            settings = (key is not None) and _interned.get(key)
+            if not settings:
+                settings = Settings(data,**kwargs)
+                # keep self (and so its id) while settings is in use
+                object.__setattr__(settings,'_base',self)
+                if key is not None:
+                    _interned[key] = settings
+        return settings
+
+
+# default settings for URL (see the URL class docstring)
+DEFAULTS = Settings(
+    verbose = False,
+    cachedir = ".",
+    nocache = False,
+    refreshcache = False,
+    timeout = None,
+    stream = False,
+    pool_size = None,
+    db_file = None,
+    listing_ttl = 86400,
+    max_bytes = None,
+    max_files = None,
+    hash_name = 'sha256',
+    checksum_sidecar = False,
+    dedup = True,
+    chunk_size = 1024*1024,
+    persist_cookies = True,
+    negative_ttl = {'missing':86400,'denied':3600,'error':300},
+    retries = 3,
+    backoff = 1.0,
+    rate_limit = None,
+)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+opt-in tracing of the phases of URL reads, as a
+Chrome trace-event JSON file (open it in https://ui.perfetto.dev
+or chrome://tracing)
+
+    from gurlpath import tracing
+    with tracing.tracing('trace.json'):
+        URL(url).read_bytes()
+
+or set the environment variable GURLPATH_TRACE=trace.json
+to trace a whole run.
+
+Spans cover URL.read() and its phases: the first get(),
+the login (get_login()) and each request, with its redirect
+hops and time to first byte (ttfb_ms), the body transfer
+(bytes and MB/s), mkdir in the cache, the cache file write
+and the CacheDatabase updates and writes.
+
+When tracing is off, span() returns a shared no-op object,
+so the spans cost one global lookup.
+'''
+
+__author__    = "P. Lewis"
+__email__     = "p.lewis@ucl.ac.uk"
+__date__      = "28 Aug 2020"
+__copyright__ = "Copyright 2020-2022 P. Lewis"
+__license__   = "MIT License"
+
+import os
+import json
+import time
+import atexit
+import functools
+import threading
+import contextlib
+from pathlib import Path
+
+# the active Tracer, or None
+_tracer = None
+
+
+class Tracer():
+    '''
+    Collects trace events in memory until written
+    '''
+    def __init__(self,file='gurlpath_trace.json'):
+        """
+        :param file: str: trace file to write
+        """
+        self.file = Path(file)
+        self.lock = threading.Lock()
+        self.events = []
+        self.threads = set()
+
+    def add(self,name,cat,start,duration,args):
+        """
+        Record a complete ('X') event
+
+        :param name: str: span name
+        :param cat: str: category
+        :param start: float: time.perf_counter() at the start
+        :param duration: float: seconds
+        :param args: dict: shown with the event
+        :return: None
+        """
+        tid = threading.get_ident()
+        event = {'name':name,'cat':cat,'ph':'X','pid':os.getpid(),'tid':tid,
+                 'ts':start * 1e6,'dur':duration * 1e6,'args':args}
+        with self.lock:
+            if tid not in self.threads:
+                self.threads.add(tid)
+                self.events.append({'name':'thread_name','ph':'M','pid':os.getpid(),'tid':tid,
+                                    'args':{'name':threading.current_thread().name}})
+            self.events.append(event)
+
+    def write(self):
+        """
+        Write the events to self.file
+
+        :return: Path of the trace file
+        """
+        with self.lock:
+            events = list(self.events)
+        self.file.parent.mkdir(parents=True,exist_ok=True)
+        self.file.write_text(json.dumps({'traceEvents':events,'displayTimeUnit':'ms'}))
+        return self.file
+
+
+class Span():
+    '''
+    One traced phase: use as a context manager
+    '''
+    __slots__ = ('tracer','name','cat','args','start')
+
+    def __init__(self,tracer,name,cat,args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = None
+
+    def set(self,**args):
+        """
+        Add args to the span, e.g. set(bytes=n)
+
+        :return: None
+        """
+        self.args.update(args)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.args['error'] = repr(exc)
+        if ('bytes' in self.args) and ('MB/s' not in self.args) and duration > 0:
+            self.args['MB/s'] = round(self.args['bytes'] / duration / 1e6,3)
+        self.tracer.add(self.name,self.cat,self.start,duration,self.args)
+        return False
+
+
+class NullSpan():
+    '''
+    Span used when tracing is off
+    '''
+    __slots__ = ()
+
+    def set(self,**args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc,tb):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def enabled():
+    """
+    :return: True if tracing is on
+    """
+    return _tracer is not None
+
+
+def span(name,cat='gurlpath',**args):
+    """
+    Span for one phase, if tracing is on
+
+        with span('mkdir',path=str(d)) as s:
+            ...
+
+    :param name: str: span name
+    :param cat: str: category
+    :param args: shown with the event
+    :return: Span or NULL_SPAN
+    """
+    tracer = _tracer
+    if tracer is None:
+        return NULL_SPAN
+    return Span(tracer,name,cat,args)
+
+
+def event(name,start,duration,cat='gurlpath',**args):
+    """
+    Record a phase that has already happened, if tracing is on
+    (e.g. a redirect hop timed by requests)
+
+    :param name: str: event name
+    :param start: float: time.perf_counter() at the start
+    :param duration: float: seconds
+    :param cat: str: category
+    :param args: shown with the event
+    :return: None
+    """
+    tracer = _tracer
+    if tracer is not None:
+        tracer.add(name,cat,start,duration,args)
+
+
+def traced(name,describe=None,cat='gurlpath'):
+    """
+    Decorator: trace each call of a method as a span
+
+    :param name: str: span name
+    :param describe: function of the object, giving the span args (dict)
+    :param cat: str: category
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self,*args,**kwargs):
+            if _tracer is None:
+                return fn(self,*args,**kwargs)
+            with span(name,cat,**((describe and describe(self)) or {})):
+                return fn(self,*args,**kwargs)
+        return wrapper
+    return decorator
+
+
+def start(file='gurlpath_trace.json'):
+    """
+    Start tracing (replacing any active trace)
+
+    :param file: str: trace file written by stop()
+    :return: Tracer
+    """
+    global _tracer
+    _tracer = Tracer(file)
+    return _tracer
+
+
+def stop():
+    """
+    Stop tracing and write the trace file
+
+    :return: Path of the trace file OR None if not tracing
+    """
+    global _tracer
+    tracer,_tracer = _tracer,None
+    if tracer is None:
+        return None
+    return tracer.write()
+
+
+@contextlib.contextmanager
+def tracing(file='gurlpath_trace.json'):
+    """
+    Trace the body of a with statement to file
+
+    :param file: str: trace file
+    """
+    tracer = start(file)
+    try:
+        yield tracer
+    finally:
+        stop()
+
+
+if os.environ.get('GURLPATH_TRACE'):
+    start(os.environ['GURLPATH_TRACE'])
+    atexit.register(stop)
@@ -1,7 +1,885 @@
 # content of test_sample.py
+import io
+import sys
+import json
+import asyncio
+import collections
+import threading
+import time
+import hashlib
+import pickle
+import subprocess
+from pathlib import Path
+
+import pytest
+
+# the local test server, from the benchmarks
+sys.path.insert(0,str(Path(__file__).absolute().parent / 'benchmarks'))
+
+from server import BenchServer, make_files
+from gurlpath import URL
+from gurlpath import metrics
+from gurlpath.fetch import fetch_many
+from gurlpath.session import cookie_file, RetryPolicy
+from gurlpath.cache import cached_subset, cached_sizes
+from gurlpath.db import CacheDatabase
+
+
 def inc(x):
     return x + 1
 
 
 def test_answer():
     assert inc(3) == 5
+
+
+# import time of the package, see test_import_time()
+HEAVY_MODULES = ['numpy','bs4','yaml','cryptography','aiohttp']
+# seconds allowed for 'from gurlpath import URL' in a new interpreter
+IMPORT_BUDGET = 1.0
+
+
+def run_python(code):
+    return subprocess.run([sys.executable,'-c',code],capture_output=True,text=True,
+                          cwd=Path(__file__).parent,check=True).stdout
+
+
+def test_lazy_imports():
+    # a cache hit should not load the heavy dependencies
+    out = run_python(f'''
+import sys, tempfile
+from pathlib import Path
+from gurlpath import URL
+from gurlpath import metrics
+d = tempfile.mkdtemp()
+Path(d,'data').mkdir()
+Path(d,'data','x.txt').write_text('hello')
+assert URL('https://example.com/data/x.txt',cachedir=d).read_text() == 'hello'
+print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))
+''')
+    assert out.strip() == ''
+
+
+def test_import_time():
+    out = run_python('''
+import time
+import hashlib
+import pickle
+t = time.perf_counter()
+from gurlpath import URL
+from gurlpath import metrics
+print(time.perf_counter() - t)
+''')
+    assert float(out) < IMPORT_BUDGET
+
+
+# CacheDatabase shared by processes (each CacheDatabase object
+# stands for one process here)
+
+
+@pytest.mark.parametrize('name,compact_after',[('db.yaml',1000),('db.yaml',1),('db.sqlite',1000)])
+def test_database_keeps_newer_values(tmp_path,name,compact_after):
+    f = str(tmp_path / name)
+    db = CacheDatabase(f)
+    db.set('K',1)
+    db.write()
+    a = CacheDatabase(f,compact_after=compact_after).read()
+    b = CacheDatabase(f).read()
+    b.set('K',2)
+    b.flush()
+    # a holds K = 1, and changes something else
+    a.set('J',1)
+    a.flush()
+    a.write()
+    assert CacheDatabase(f).read().data == {'K':2,'J':1}
+
+
+@pytest.mark.parametrize('name',['db.yaml','db.sqlite'])
+def test_database_overwrites_values(tmp_path,name):
+    f = str(tmp_path / name)
+    db = CacheDatabase(f)
+    db.set('K',{'size':1})
+    db.write()
+    db = CacheDatabase(f).read()
+    # changed straight in data, not through set()
+    db.data['K']['size'] = 2
+    db.data['J'] = 3
+    assert db.write()
+    assert CacheDatabase(f).read().data == {'K':{'size':2},'J':3}
+
+
+def test_database_journal(tmp_path):
+    f = str(tmp_path / 'db.yaml')
+    db = CacheDatabase(f,compact_after=4)
+    db.set('K',[1,2,3])
+    db.update_entry('J',a=1)
+    assert db.flush()
+    # changes go to the journal, not the yaml file
+    journal = db.journal_file()
+    assert len(journal.read_text().splitlines()) == 2
+    assert Path(db.write_file).read_text() == ''
+    db.update_entry('J',b=2)
+    db.delete('K')
+    db.flush()
+    assert len(journal.read_text().splitlines()) == 4
+    # replayed by read()
+    assert CacheDatabase(f).read().data == {'J':{'a':1,'b':2}}
+    # a partly written last line (e.g. a crash) is skipped
+    with open(journal,'a') as jf:
+        jf.write('{"key": "I", "val')
+    assert CacheDatabase(f).read().data == {'J':{'a':1,'b':2}}
+    # compacted into the yaml file
+    db.set('L','hello')
+    db.flush()
+    assert not journal.exists()
+    assert CacheDatabase(f).read().data == {'J':{'a':1,'b':2},'L':'hello'}
+
+
+# reads from a local server (benchmarks/server.py) with files
+# /data/2003.12.0D/f000N.hdf and /data/sizes/1000000.bin, also under
+# /protected/ behind a login
+
+
+@pytest.fixture
+def server(tmp_path,monkeypatch):
+    # keep cookies and cylog files out of the real home directory
+    monkeypatch.setenv('HOME',str(tmp_path / 'home'))
+    server = BenchServer(make_files(ndirs=2,nfiles=3,size=1000,sizes=[10**6]))
+    server.start()
+    yield server
+    server.stop()
+
+
+def login_url(server,username=None,password=None):
+    return server.url.replace('http://',f'http://{username or server.username}:'
+                                        f'{password or server.password}@')
+
+
+def cached_url(url,tmp_path,**kwargs):
+    # a URL with its own cache directory and database
+    return URL(url,cachedir=str(tmp_path),db_file=str(tmp_path / 'db.yaml'),**kwargs)
+
+
+def test_failed_login_is_remembered(server,tmp_path):
+    url = cached_url(login_url(server,password='wrong') + '/protected/data/2003.12.01/f0000.hdf',
+                     tmp_path)
+    assert url.read_bytes(skipper=True) is None
+    assert url.r.status_code == 401
+    assert url.negative() == 401
+
+
+def test_failed_connection_is_remembered(server,tmp_path):
+    server.stop()
+    url = cached_url(login_url(server) + '/protected/data/2003.12.01/f0000.hdf',
+                     tmp_path,retries=0)
+    assert url.read_bytes(skipper=True) is None
+    assert url.r is None
+    assert url.negative() == 0
+
+
+def test_failed_connection_without_login(server,tmp_path):
+    server.stop()
+    url = cached_url(server.url + '/data/2003.12.01/f0000.hdf',tmp_path,retries=0)
+    assert url.read_bytes() is None
+    assert url.r is None
+    assert url.negative() == 0
+    assert url.parent.listdir() == []
+
+
+def test_failed_connection_no_sidecar(server,tmp_path):
+    server.stop()
+    url = cached_url(login_url(server) + '/protected/data/2003.12.01/f0000.hdf',
+                     tmp_path,retries=0,checksum_sidecar=True)
+    assert url.expected_checksum() is None
+    assert url.read_bytes(skipper=True) is None
+
+
+def test_pin_before_download(server,tmp_path):
+    urls = [cached_url(server.url + f'/data/2003.12.01/f000{i}.hdf',tmp_path,max_files=2)
+            for i in range(3)]
+    urls[0].pin()
+    for url in urls:
+        assert len(url.read_bytes()) == 1000
+    assert urls[0].local_file().exists()
+    assert not urls[1].local_file().exists()
+    assert urls[0].cache_manager().usage()['pinned_files'] == 1
+
+
+def test_aio_downloads_are_counted(server,tmp_path):
+    aio = pytest.importorskip('gurlpath.aio')
+    pytest.importorskip('aiohttp')
+    urls = [cached_url(server.url + f'/data/2003.12.01/f000{i}.hdf',tmp_path,max_files=2)
+            for i in range(3)]
+
+    async def main():
+        try:
+            for url in urls:
+                assert len(await aio.read(url)) == 1000
+        finally:
+            await urls[0].aclose()
+    asyncio.run(main())
+    assert [url.local_file().exists() for url in urls] == [False,True,True]
+    assert urls[0].cache_manager().usage()['files'] == 2
+
+
+def test_concurrent_downloads(server,tmp_path):
+    # the threads wait for one download, rather than sharing its .part file
+    results = []
+
+    def read():
+        url = cached_url(server.url + '/data/sizes/1000000.bin',tmp_path,chunk_size=1000)
+        results.append(url.read_bytes(stream=True))
+    threads = [threading.Thread(target=read) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert [len(r) for r in results] == [10**6] * 4
+    assert metrics.registry.value('bytes_downloaded',host=server.url) == 10**6
+    assert [f.name for f in (tmp_path / 'data' / 'sizes').iterdir()] == ['1000000.bin']
+
+
+def test_aio_read_records_as_read(server,tmp_path):
+    pytest.importorskip('aiohttp')
+    name = server.url + '/data/2003.12.01/f0000.hdf'
+    url = cached_url(name,tmp_path / 'sync')
+    aurl = cached_url(name,tmp_path / 'aio')
+    bad = cached_url(server.url + '/data/2003.12.01/f0001.hdf',tmp_path / 'aio')
+
+    async def main():
+        try:
+            return await aurl.aread_bytes(),await bad.aread_bytes(checksum='md5:' + '0' * 32)
+        finally:
+            await aurl.aclose()
+    data,missing = asyncio.run(main())
+    assert data == url.read_bytes()
+    assert missing is None and not bad.local_file().exists()
+    entry = url.database().entry(url.cache_key())
+    aentry = aurl.database().entry(aurl.cache_key())
+    for field in ['etag','content_length','sha256','size']:
+        assert aentry[field] == entry[field]
+
+
+def test_aio_refresh_and_listing(server,tmp_path):
+    pytest.importorskip('aiohttp')
+    name = server.url + '/data/2003.12.01/f0000.hdf'
+    url = cached_url(name,tmp_path)
+    refresh = cached_url(name,tmp_path,refreshcache=True)
+    missing = cached_url(login_url(server) + '/data/missing',tmp_path)
+
+    async def main():
+        try:
+            data = await url.aread_bytes()
+            ino = url.local_file().stat().st_ino
+            # not modified: the cached file is kept
+            assert await refresh.aread_bytes() == data
+            assert url.local_file().stat().st_ino == ino
+            assert await missing.alistdir() == []
+            nrequests = metrics.registry.value('requests',host=server.url)
+            assert await missing.alistdir() == []
+            return metrics.registry.value('requests',host=server.url) - nrequests
+        finally:
+            await url.aclose()
+    nbytes = metrics.registry.value('bytes_downloaded',host=server.url)
+    n304 = metrics.registry.value('requests',host=server.url,status=304)
+    assert asyncio.run(main()) == 0
+    assert metrics.registry.value('bytes_downloaded',host=server.url) - nbytes == 1000
+    assert metrics.registry.value('requests',host=server.url,status=304) - n304 == 1
+
+
+def test_fetch_many(server,tmp_path):
+    names = [server.url + f'/data/2003.12.0{d}/f000{i}.hdf' for d in (1,2) for i in range(3)]
+    cached_url(names[-1],tmp_path).read_bytes()
+    results = list(fetch_many(names,cachedir=str(tmp_path),db_file=str(tmp_path / 'db.yaml'),
+                              per_host_limit=2))
+    assert results[0].cached and str(results[0].url) == names[-1]
+    assert sorted(str(r.url) for r in results) == sorted(names)
+    assert all(r.path.stat().st_size == 1000 for r in results)
+
+
+def test_fetch_many_closed_early(server,tmp_path):
+    names = [server.url + f'/data/2003.12.0{d}/f000{i}.hdf' for d in (1,2) for i in range(3)]
+    results = fetch_many(names,cachedir=str(tmp_path),db_file=str(tmp_path / 'db.yaml'),
+                         max_workers=1,per_host_limit=1)
+    assert next(results).error is None
+    results.close()
+    # the one running when closed may finish: the rest are cancelled
+    time.sleep(0.5)
+    assert len(list(tmp_path.glob('data/*/*.hdf'))) <= 2
+
+
+def test_cookies_saved_when_changed(server,tmp_path):
+    urls = [cached_url(login_url(server) + f'/protected/data/2003.12.01/f000{i}.hdf',tmp_path)
+            for i in range(3)]
+    # each login sets the same cookie
+    assert len(urls[0].read_bytes(skipper=True)) == 1000
+    f = cookie_file(urls[0])
+    mtime = f.stat().st_mtime_ns
+    for url in urls[1:]:
+        assert len(url.read_bytes(skipper=True)) == 1000
+    assert f.stat().st_mtime_ns == mtime
+
+
+def test_no_cylog_key_without_login(server,tmp_path):
+    url = cached_url(server.url + '/data',tmp_path)
+    # e.g. a tracking cookie
+    url.session().cookies.set('visit','1')
+    # redirected to /data/
+    assert b'Index of /data/' in url.read_bytes()
+    assert not (tmp_path / 'home' / '.cylog' / '.cylog.npz').exists()
+
+
+def test_resume(server,tmp_path):
+    name = server.url + '/data/2003.12.01/f0000.hdf'
+    full = cached_url(name,tmp_path / 'full')
+    data = full.read_bytes()
+    etag = full.database().entry(full.cache_key())['etag']
+    url = cached_url(name,tmp_path / 'part')
+    local_file = url.local_file()
+    local_file.parent.mkdir(parents=True)
+    url.partial_file(local_file).write_bytes(data[:400])
+    url.partial_info(local_file).write_text(f"etag: '{etag}'\n")
+    nbytes = metrics.registry.value('bytes_downloaded',host=server.url)
+    assert url.read_bytes(stream=True) == data
+    assert metrics.registry.value('bytes_downloaded',host=server.url) - nbytes == 600
+    assert not url.partial_file(local_file).exists()
+
+
+@pytest.mark.parametrize('size,etag',[(1000,None),(400,'"changed"')])
+def test_resume_restarts(server,tmp_path,size,etag):
+    # a partial file that is complete (416), or for an older version (200)
+    name = server.url + '/data/2003.12.01/f0000.hdf'
+    full = cached_url(name,tmp_path / 'full')
+    data = full.read_bytes()
+    etag = etag or full.database().entry(full.cache_key())['etag']
+    url = cached_url(name,tmp_path / 'part')
+    local_file = url.local_file()
+    local_file.parent.mkdir(parents=True)
+    url.partial_file(local_file).write_bytes(b'x' * size)
+    url.partial_info(local_file).write_text(f"etag: '{etag}'\n")
+    assert url.read_bytes(stream=True) == data
+    assert local_file.read_bytes() == data
+
+
+def test_remote_file(server,tmp_path):
+    name = server.url + '/data/sizes/1000000.bin'
+    data = cached_url(name,tmp_path / 'full').read_bytes()
+    url = cached_url(name,tmp_path / 'ranges')
+    nbytes = metrics.registry.value('bytes_downloaded',host=server.url)
+    with url.open(block_size=4096) as f:
+        assert f.size == 10**6
+        f.seek(500000)
+        assert f.read(100) == data[500000:500100]
+        f.seek(-10,io.SEEK_END)
+        assert f.read() == data[-10:]
+        assert f.tell() == 10**6
+    # only the blocks read (and the size probe) were fetched
+    assert metrics.registry.value('bytes_downloaded',host=server.url) - nbytes <= 3 * 4096
+    assert not url.local_file().exists()
+
+
+def test_remote_file_persist(server,tmp_path):
+    name = server.url + '/data/sizes/1000000.bin'
+    data = cached_url(name,tmp_path / 'full').read_bytes()
+    url = cached_url(name,tmp_path / 'ranges')
+    with url.open(block_size=300000,persist=True) as f:
+        assert f.read(10) == data[:10]
+        f.seek(0)
+        assert f.read() == data
+    # all the blocks were fetched, so the file is in the cache
+    assert url.local_file().read_bytes() == data
+    assert [p.name for p in url.local_file().parent.iterdir()] == ['1000000.bin']
+    # as if downloaded by read()
+    entry = url.database().entry(url.cache_key())
+    assert entry['local_file'] == str(url.local_file().absolute())
+    assert entry['sha256'] == hashlib.sha256(data).hexdigest()
+    assert entry['etag'] and entry['content_length'] == 10**6
+    assert cached_subset([name],cachedir=str(tmp_path / 'ranges')) == [name]
+
+
+def test_glob(server,tmp_path):
+    url = cached_url(server.url,tmp_path)
+    expected = [server.url + f'/data/2003.12.0{d}/f000{i}.hdf' for d in (1,2) for i in (0,1)]
+    nrequests = metrics.registry.value('requests',host=server.url)
+    assert sorted(str(u) for u in url.glob('data/2003.12.0*/f000[01].hdf')) == expected
+    # /data/ and the two date directories were listed: data was not matched
+    assert metrics.registry.value('requests',host=server.url) - nrequests == 3
+    # the listings are cached
+    assert sorted(str(u) for u in url.glob('data/2003.12.0*/f000[01].hdf')) == expected
+    assert metrics.registry.value('requests',host=server.url) - nrequests == 3
+    assert [str(u) for u in url.glob('*/sizes/*.bin',pre_filter=False)] == \
+           [server.url + '/data/sizes/1000000.bin']
+
+
+def test_negative_cache(server,tmp_path):
+    url = cached_url(login_url(server) + '/data/2003.12.01/missing.hdf',tmp_path)
+    assert url.read_bytes() is None
+    assert url.negative() == 404
+    nrequests = metrics.registry.value('requests',host=server.url)
+    assert url.read_bytes() is None
+    assert metrics.registry.value('requests',host=server.url) == nrequests
+    # until forgotten, or refreshing
+    assert cached_url(str(url),tmp_path,refreshcache=True).negative() is None
+    url.purge()
+    assert url.negative() is None
+    assert url.read_bytes() is None
+    assert metrics.registry.value('requests',host=server.url) > nrequests
+
+
+def test_negative_cache_listing(server,tmp_path):
+    url = cached_url(login_url(server) + '/data/missing',tmp_path)
+    assert url.listdir() == []
+    nrequests = metrics.registry.value('requests',host=server.url)
+    assert url.listdir() == []
+    assert metrics.registry.value('requests',host=server.url) == nrequests
+
+
+def test_negative_cache_ttl(server,tmp_path):
+    url = cached_url(login_url(server) + '/data/2003.12.01/missing.hdf',tmp_path,
+                     negative_ttl={'missing':None})
+    assert url.read_bytes() is None
+    assert url.negative() is None
+
+
+def busy(server,failures,retry_after=None):
+    # /busy/<path> fails with 503 failures times, then serves <path>
+    base = server.httpd.RequestHandlerClass
+    counts = collections.Counter()
+
+    class BusyHandler(base):
+        def do_GET(self):
+            if self.path.startswith('/busy/'):
+                counts[self.path] += 1
+                if counts[self.path] <= failures:
+                    return self.send(503,headers=retry_after and {'Retry-After':retry_after})
+                self.path = self.path[len('/busy'):]
+            base.do_GET(self)
+    server.httpd.RequestHandlerClass = BusyHandler
+    return counts
+
+
+def test_retry(server,tmp_path):
+    counts = busy(server,2)
+    url = cached_url(server.url + '/busy/data/2003.12.01/f0000.hdf',tmp_path,backoff=0.01)
+    nretries = metrics.registry.value('retries',host=server.url)
+    assert len(url.read_bytes()) == 1000
+    assert sum(counts.values()) == 3
+    assert metrics.registry.value('retries',host=server.url) - nretries == 2
+
+
+def test_retry_gives_up(server,tmp_path):
+    counts = busy(server,100,retry_after='0')
+    url = cached_url(login_url(server) + '/busy/data/2003.12.01/f0000.hdf',tmp_path,retries=2)
+    assert url.read_bytes() is None
+    # no login is tried for a busy server
+    assert sum(counts.values()) == 3
+    assert url.negative() == 503
+
+
+def test_retry_delay():
+    policy = RetryPolicy(retries=3,backoff=0.5,max_backoff=3)
+    assert policy.retry(2,503) and not policy.retry(3,503)
+    assert not policy.retry(0,404)
+    assert policy.delay(0,{'Retry-After':'2'}) == 2
+    assert policy.delay(0,{'Retry-After':'100'}) == 3
+    assert all(0 <= policy.delay(2) <= 2 for i in range(100))
+    assert all(0 <= policy.delay(10) <= 3 for i in range(100))
+
+
+def test_cksum():
+    from gurlpath import checksum
+    # values printed by the POSIX cksum command
+    for data,value in [(b'','4294967295'),(b'123456789','930766865')]:
+        h = checksum.new('cksum')
+        h.update(data[:4])
+        h.update(memoryview(data)[4:])
+        assert h.hexdigest() == value
+
+
+@pytest.mark.parametrize('stream',[False,True])
+def test_checksum(server,tmp_path,stream):
+    name = server.url + '/data/2003.12.01/f0000.hdf'
+    data = cached_url(name,tmp_path / 'full').read_bytes()
+    url = cached_url(name,tmp_path / 'check')
+    assert url.read_bytes(stream=stream,checksum='md5:' + '0' * 32) is None
+    assert not url.local_file().exists()
+    assert url.read_bytes(stream=stream,checksum='md5:' + hashlib.md5(data).hexdigest()) == data
+    entry = url.database().entry(url.cache_key())
+    assert entry['sha256'] == hashlib.sha256(data).hexdigest()
+
+
+def test_checksum_sidecar(tmp_path,monkeypatch):
+    monkeypatch.setenv('HOME',str(tmp_path / 'home'))
+    files = make_files(ndirs=1,nfiles=2,size=1000)
+    good,bad = sorted(files)
+    files[good + '.sha256'] = (hashlib.sha256(files[good]).hexdigest() + '  f0000.hdf\n').encode()
+    files[bad + '.sha256'] = (hashlib.sha256(files[good]).hexdigest() + '  f0001.hdf\n').encode()
+    server = BenchServer(files)
+    server.start()
+    try:
+        # bad first: once good is cached, bad would be linked to it (see test_dedup)
+        assert cached_url(server.url + bad,tmp_path,checksum_sidecar=True).read_bytes() is None
+        assert cached_url(server.url + good,tmp_path,checksum_sidecar=True).read_bytes() == \
+               files[good]
+    finally:
+        server.stop()
+
+
+def test_dedup(server,tmp_path):
+    # f0000.hdf has the same content in each date directory
+    first,second = [cached_url(server.url + f'/data/2003.12.0{d}/f0000.hdf',tmp_path)
+                    for d in (1,2)]
+    assert first.read_bytes(stream=True) == second.read_bytes(stream=True)
+    assert first.local_file().stat().st_ino == second.local_file().stat().st_ino
+    # known content is linked, not downloaded
+    digest = hashlib.sha256(first.local_file().read_bytes()).hexdigest()
+    third = cached_url(login_url(server) + '/protected/data/2003.12.02/f0000.hdf',tmp_path)
+    nbytes = metrics.registry.value('bytes_downloaded',host=server.url)
+    assert third.read_bytes(checksum=f'sha256:{digest}') == first.local_file().read_bytes()
+    assert metrics.registry.value('bytes_downloaded',host=server.url) == nbytes
+    assert third.local_file().stat().st_ino == first.local_file().stat().st_ino
+
+
+def test_dedup_after_refresh(server,tmp_path):
+    first,second = [cached_url(server.url + f'/data/2003.12.0{d}/f0000.hdf',tmp_path)
+                    for d in (1,2)]
+    old = first.read_bytes(stream=True)
+    digest = hashlib.sha256(old).hexdigest()
+    # the first file changes on the server, and is refreshed
+    handler = server.httpd.RequestHandlerClass
+    handler.files['/data/2003.12.01/f0000.hdf'] = new = bytes(reversed(old))
+    handler.etags['/data/2003.12.01/f0000.hdf'] = '"new"'
+    refreshed = cached_url(str(first),tmp_path,refreshcache=True)
+    assert refreshed.read_bytes(stream=True) == new
+    # the second (old content) is not linked to the refreshed file
+    assert second.read_bytes(checksum=f'sha256:{digest}') == old
+    assert cached_url(str(second),tmp_path,refreshcache=True).read_bytes(stream=True) == old
+    assert second.local_file().stat().st_ino != first.local_file().stat().st_ino
+    assert first.local_file().read_bytes() == new
+
+
+def test_dedup_usage(server,tmp_path):
+    first,second = [cached_url(server.url + f'/data/2003.12.0{d}/f0000.hdf',tmp_path,max_files=10)
+                    for d in (1,2)]
+    assert first.read_bytes(stream=True) == second.read_bytes(stream=True)
+    # one file, hard linked
+    usage = first.cache_manager().usage()
+    assert (usage['files'],usage['bytes']) == (2,1000)
+    first.cache_manager().evict(first.cache_key())
+    assert first.cache_manager().usage()['bytes'] == 1000
+    second.cache_manager().evict(second.cache_key())
+    assert second.cache_manager().usage()['bytes'] == 0
+
+
+def test_no_dedup(server,tmp_path):
+    first,second = [cached_url(server.url + f'/data/2003.12.0{d}/f0000.hdf',tmp_path,dedup=False)
+                    for d in (1,2)]
+    assert first.read_bytes(stream=True) == second.read_bytes(stream=True)
+    assert first.local_file().stat().st_ino != second.local_file().stat().st_ino
+
+
+def test_manifest(server,tmp_path):
+    names = [server.url + f'/data/2003.12.01/f000{i}.hdf' for i in range(3)]
+    cachedir = str(tmp_path / 'cache')
+    cached_url(names[0],tmp_path / 'cache').read_bytes()
+    assert cached_subset(names,cachedir=cachedir,refresh=True) == names[:1]
+    # files cached, and evicted, in this process are seen without a refresh
+    urls = [cached_url(name,tmp_path / 'cache',max_files=2) for name in names]
+    urls[1].read_bytes(stream=True)
+    urls[2].read_bytes()
+    assert cached_subset(names,cachedir=cachedir) == names[1:]
+    assert cached_sizes(urls,cachedir=cachedir) == {urls[1]:1000,urls[2]:1000}
+    # partial downloads are not cached files
+    urls[0].partial_file(urls[0].local_file()).write_bytes(b'x')
+    assert cached_subset(names,cachedir=cachedir,refresh=True) == names[1:]
+
+
+def test_manifest_reads_only_needed_directories(tmp_path,monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for f in ['data/a/f0.hdf','data/b/f1.hdf','other/x/y.txt']:
+        Path(f).parent.mkdir(parents=True,exist_ok=True)
+        Path(f).write_bytes(b'x')
+    names = ['https://example.com/data/a/f0.hdf','https://example.com/data/a/f2.hdf']
+    assert cached_subset(names) == names[:1]
+    from gurlpath.cache import get_manifest
+    assert get_manifest('.').dirs == {'data/a'}
+
+
+def test_settings_shared(tmp_path):
+    url = URL('https://example.com/data',cachedir=str(tmp_path),max_files=10)
+    derived = [url / 'a.hdf',url.joinpath('b','c.hdf'),url.parent,url.with_name('x'),
+               url.derive('https://example.com/other'),url.glob('a.hdf')[0]]
+    assert all(u.settings is url.settings for u in derived)
+    assert all(u.cachedir == str(tmp_path) and u.max_files == 10 for u in derived)
+    # the same settings from the defaults are one object
+    assert URL('https://example.com/x',cachedir=str(tmp_path),max_files=10).settings \
+           is url.settings
+
+
+def test_settings_changed(tmp_path):
+    url = URL('https://example.com/data',cachedir=str(tmp_path))
+    child = url / 'a.hdf'
+    child.verbose = True
+    assert child.verbose and not url.verbose
+    # passed on to URLs derived from child
+    assert (child.parent / 'b.hdf').verbose
+    with pytest.raises(AttributeError):
+        url.settings.cachedir = 'elsewhere'
+    copy = pickle.loads(pickle.dumps(child))
+    assert copy == child and copy.verbose and copy.cachedir == str(tmp_path)
+
+
+def test_sqlite_database(server,tmp_path):
+    db_file = str(tmp_path / 'db.sqlite')
+    url = URL(server.url + '/data/2003.12.01/f0000.hdf',cachedir=str(tmp_path),db_file=db_file)
+    missing = url.derive(login_url(server) + '/data/2003.12.01/missing.hdf')
+    assert len(url.read_bytes()) == 1000
+    assert missing.read_bytes() is None
+    assert url.flush()
+    # as seen by another process
+    db = CacheDatabase(db_file)
+    entry = db.entry(url.cache_key())
+    assert entry['etag'] and entry['local_file'] == str(url.local_file().absolute())
+    assert db.entry(missing.cache_key())['negative']['status'] == 404
+
+
+def store_login(home,site,username,password):
+    # a Cylog key file holding username and password for site
+    import numpy
+    from cryptography.fernet import Fernet
+    key = Fernet.generate_key()
+    f = home / '.cylog' / '.cylog.npz'
+    f.parent.mkdir(parents=True,exist_ok=True)
+    numpy.savez(f,key=key,**{f'ciphered_user_{site}':Fernet(key).encrypt(username.encode()),
+                             f'ciphered_pass_{site}':Fernet(key).encrypt(password.encode())})
+    return f
+
+
+def test_credential_cache(server,tmp_path,monkeypatch):
+    numpy = pytest.importorskip('numpy')
+    cylog = pytest.importorskip('gurlpath.cylog')
+    store_login(tmp_path / 'home',server.url,server.username,server.password)
+    loads = []
+    load = numpy.load
+    monkeypatch.setattr(cylog.np,'load',lambda *args,**kwargs: loads.append(args) or
+                                                                load(*args,**kwargs))
+    urls = [cached_url(server.url + f'/protected/data/2003.12.01/f000{i}.hdf',tmp_path)
+            for i in range(3)]
+    assert len(urls[0].read_bytes(skipper=True)) == 1000
+    nloads = len(loads)
+    assert nloads
+    for url in urls[1:]:
+        assert len(url.read_bytes(skipper=True)) == 1000
+    assert len(loads) == nloads
+    # a changed key file is read again
+    time.sleep(0.01)
+    store_login(tmp_path / 'home',server.url,server.username,'wrong')
+    assert cylog.Cylog(server.url).login() == (server.username.encode(),b'wrong')
+
+
+def test_has_credentials(server,tmp_path,monkeypatch):
+    numpy = pytest.importorskip('numpy')
+    cylog = pytest.importorskip('gurlpath.cylog')
+    url = cached_url(server.url + '/protected/data/2003.12.01/f0000.hdf',tmp_path)
+    keyfile = tmp_path / 'home' / '.cylog' / '.cylog.npz'
+    assert not url.has_credentials()
+    assert not keyfile.exists()
+    store_login(tmp_path / 'home',server.url,server.username,server.password)
+    assert url.has_credentials()
+    # once logged in, from memory
+    assert len(url.read_bytes(skipper=True)) == 1000
+    monkeypatch.setattr(cylog.np,'load',None)
+    assert url.has_credentials()
+
+
+def test_tracing(server,tmp_path):
+    from gurlpath import tracing
+    url = cached_url(server.url + '/data/2003.12.01/f0000.hdf',tmp_path)
+    with tracing.tracing(str(tmp_path / 'trace.json')):
+        assert tracing.enabled()
+        assert len(url.read_bytes(stream=True)) == 1000
+    assert not tracing.enabled()
+    events = json.loads((tmp_path / 'trace.json').read_text())['traceEvents']
+    spans = {e['name']:e for e in events if e['ph'] == 'X'}
+    assert {'read','get','request','transfer','commit partial','cache record'} <= set(spans)
+    assert spans['read']['args']['url'] == str(url)
+    assert spans['request']['args']['status'] == 200
+    assert spans['transfer']['args']['bytes'] == 1000
+    # the phases are within the read
+    read = spans['read']
+    assert all(read['ts'] <= e['ts'] and e['ts'] + e['dur'] <= read['ts'] + read['dur']
+               for e in spans.values())
+
+
+def test_read_buffer(server,tmp_path):
+    name = server.url + '/data/2003.12.01/f0000.hdf'
+    data = cached_url(name,tmp_path / 'full').read_bytes()
+    url = cached_url(name,tmp_path / 'buffer')
+    buffer = url.read_buffer()
+    assert isinstance(buffer,memoryview) and buffer.readonly
+    assert buffer.tobytes() == data
+    # the mapping outlives the cache file
+    url.local_file().unlink()
+    assert buffer[10:20].tobytes() == data[10:20]
+    mapped = buffer.obj
+    buffer.release()
+    mapped.close()
+    assert mapped.closed
+
+
+def test_read_array(server,tmp_path):
+    numpy = pytest.importorskip('numpy')
+    name = server.url + '/data/2003.12.01/f0000.hdf'
+    data = cached_url(name,tmp_path / 'full').read_bytes()
+    url = cached_url(name,tmp_path / 'array')
+    array = url.read_array(dtype='>u2',shape=(10,45),offset=100)
+    assert array.dtype == numpy.dtype('>u2') and array.shape == (10,45)
+    assert not array.flags.writeable
+    assert (array == numpy.frombuffer(data,'>u2',count=450,offset=100).reshape(10,45)).all()
+    assert url.read_array().shape == (1000,)
+    assert (url.read_array(shape=(10,100),order='F')[:,0] ==
+            numpy.frombuffer(data,'u1')[:10]).all()
+
+
+def test_refresh_not_modified(server,tmp_path):
+    base = server.httpd.RequestHandlerClass
+    sent = []
+
+    class Handler(base):
+        def do_GET(self):
+            sent.append(self.headers.get('If-None-Match'))
+            base.do_GET(self)
+    server.httpd.RequestHandlerClass = Handler
+    name = server.url + '/data/2003.12.01/f0000.hdf'
+    url = cached_url(name,tmp_path)
+    data = url.read_bytes()
+    etag = url.database().entry(url.cache_key())['etag']
+    ino = url.local_file().stat().st_ino
+    nbytes = metrics.registry.value('bytes_downloaded',host=server.url)
+    for stream in (False,True):
+        assert cached_url(name,tmp_path,refreshcache=True).read_bytes(stream=stream) == data
+    assert sent == [None,etag,etag]
+    # not modified: the cached file is kept
+    assert metrics.registry.value('bytes_downloaded',host=server.url) == nbytes
+    assert url.local_file().stat().st_ino == ino
+    # modified: downloaded again
+    Handler.files['/data/2003.12.01/f0000.hdf'] = b'new'
+    Handler.etags['/data/2003.12.01/f0000.hdf'] = '"new"'
+    assert cached_url(name,tmp_path,refreshcache=True).read_bytes() == b'new'
+    assert url.database().entry(url.cache_key())['etag'] == '"new"'
+
+
+def test_strategy_memo(server,tmp_path,monkeypatch):
+    pytest.importorskip('gurlpath.cylog')
+    from gurlpath import gurlpath
+    store_login(tmp_path / 'home',server.url,server.username,server.password)
+    urls = [cached_url(server.url + f'/protected/data/2003.12.01/f000{i}.hdf',tmp_path)
+            for i in range(3)]
+    counts = []
+    for url in urls:
+        # no login cookie: only the memo saves the simple get()
+        url.session().cookies.clear()
+        nrequests = metrics.registry.value('requests',host=server.url)
+        assert len(url.read_bytes()) == 1000
+        counts.append(metrics.registry.value('requests',host=server.url) - nrequests)
+        # as in a new process, from the CacheDatabase
+        monkeypatch.setattr(gurlpath,'_strategies',{})
+    assert counts == [2,1,1]
+    assert urls[0].strategy() == 'basic'
+
+
+def test_metrics_export():
+    registry = metrics.Metrics()
+    registry.inc('requests',host='h',status=200)
+    registry.inc('requests',2,host='h',status=404)
+    registry.observe('request_seconds',0.02,host='h')
+    registry.observe('request_seconds',100,host='h')
+    assert registry.value('requests',host='h') == 3
+    assert registry.value('requests',status=404) == 2
+    snap = registry.snapshot()
+    assert {'labels':{'host':'h','status':200},'value':1} in snap['counters']['requests']
+    [hist] = snap['histograms']['request_seconds']
+    assert (hist['count'],hist['sum']) == (2,100.02)
+    assert (hist['buckets']['0.025'],hist['buckets']['60'],hist['buckets']['inf']) == (1,1,2)
+    assert json.loads(registry.export()) == snap
+    text = registry.export('prometheus')
+    assert '# TYPE gurlpath_requests counter\n' in text
+    assert 'gurlpath_requests{host="h",status="404"} 2\n' in text
+    assert 'gurlpath_request_seconds_bucket{host="h",le="+Inf"} 2\n' in text
+    assert 'gurlpath_request_seconds_count{host="h"} 2\n' in text
+    with pytest.raises(ValueError):
+        registry.export('xml')
+    registry.reset()
+    assert registry.snapshot() == {'counters':{},'histograms':{}}
+
+
+def test_message_log():
+    log = metrics.MessageLog(maxlen=3)
+    assert log.add('a') and log.add('b')
+    # repeats are not held twice
+    assert not log.add('a')
+    for msg in 'cde':
+        log.add(msg)
+    assert len(log) == 3 and list(log) == ['c','d','e']
+    assert 'a' not in log and 'e' in log
+    url = URL('https://example.com/data')
+    for i in range(2000):
+        url.msg(f'message {i}')
+    assert len(url.msgs) == url.msgs.maxlen
+
+
+def test_session_per_host(server,tmp_path):
+    base = server.httpd.RequestHandlerClass
+    connections = []
+
+    class Handler(base):
+        def setup(self):
+            connections.append(self.client_address)
+            base.setup(self)
+    server.httpd.RequestHandlerClass = Handler
+    urls = [cached_url(server.url + f'/data/2003.12.0{d}/f000{i}.hdf',tmp_path)
+            for d in (1,2) for i in range(3)]
+    # one session per host, with or without a login in the URL
+    assert all(url.session() is urls[0].session() for url in urls)
+    assert cached_url(login_url(server) + '/data',tmp_path).session() is urls[0].session()
+    assert URL('https://example.com/data').session() is not urls[0].session()
+    for url in urls:
+        assert len(url.read_bytes()) == 1000
+    # the connection is kept alive
+    assert len(connections) == 1
+
+
+def test_read_output(server,tmp_path):
+    name = server.url + '/data/2003.12.01/f0000.hdf'
+    data = cached_url(name,tmp_path / 'full').read_bytes()
+    url = cached_url(name,tmp_path / 'output')
+    path = url.read_bytes(output='path')
+    assert path == url.local_file() and path.read_bytes() == data
+    with url.read_bytes(output='file') as f:
+        assert f.mode == 'rb' and f.read() == data
+    # with nocache, a temporary file outside the cache
+    nocache = cached_url(name,tmp_path / 'nocache',nocache=True)
+    path = nocache.read_bytes(output='path')
+    assert path.read_bytes() == data and not nocache.local_file().exists()
+    path.unlink()
+    with nocache.read_bytes(output='file') as f:
+        assert f.read() == data
+    assert not Path(f.name).exists()
+
+
+def test_aglob(server,tmp_path):
+    pytest.importorskip('aiohttp')
+    url = cached_url(server.url,tmp_path)
+    expected = [server.url + f'/data/2003.12.0{d}/f000{i}.hdf' for d in (1,2) for i in (0,1)]
+
+    async def main():
+        try:
+            return await url.aglob('data/2003.12.0*/f000[01].hdf')
+        finally:
+            await url.aclose()
+    nrequests = metrics.registry.value('requests',host=server.url)
+    assert sorted(str(u) for u in asyncio.run(main())) == expected
+    assert metrics.registry.value('requests',host=server.url) - nrequests == 3
+    # the listings are shared with glob()
+    assert sorted(str(u) for u in url.glob('data/2003.12.0*/f000[01].hdf')) == expected
+    assert metrics.registry.value('requests',host=server.url) - nrequests == 3